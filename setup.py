@@ -131,6 +131,9 @@ setup(name="ZEO",
           'msgpack': [
               'msgpack-python'
           ],
+          'numpy': [
+              'numpy'
+          ],
           ':python_version == "2.7"': [
               'futures',
               'trollius',
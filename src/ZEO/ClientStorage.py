@@ -30,6 +30,7 @@ import weakref
 from binascii import hexlify
 
 import BTrees.OOBTree
+import collections
 
 import zc.lockfile
 import ZODB
@@ -89,6 +90,17 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                  blob_cache_size=None, blob_cache_size_check=10,
                  client_label=None,
                  cache=None,
+                 cache_segments=1, cache_shared=False,
+                 cache_policy='circular',
+                 cache_warmup=0, cache_warmup_rate=1000,
+                 cache_compact_interval=0,
+                 cache_mmap=False, cache_l1_size=0,
+                 cache_admission_small=None,
+                 cache_compress=False, cache_compress_threshold=256,
+                 cache_noncurrent_size=None, cache_compact_index=False,
+                 store_batch_count=1000, store_batch_size=1<<20,
+                 reference_prefetch_depth=0, reference_prefetch_budget=1<<20,
+                 connections=1, replicas=None,
                  ssl = None, ssl_server_hostname=None,
                  # Mostly ignored backward-compatability options
                  client=None, var=None,
@@ -137,6 +149,116 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             Defaults to None, in which case the cache is not
             persistent.  See ClientCache for more info.
 
+        cache_segments
+            The number of independent segments to divide the cache
+            into, defaulting to 1.  Each segment has its own lock, so
+            loads of objects in different segments from different
+            threads don't block each other.  See SegmentedClientCache
+            for more info.
+
+        cache_shared
+            Share the persistent cache file with other processes on
+            the same host that use the same file, defaulting to False.
+            This uses a different file format, and takes precedence
+            over cache_segments.  See SharedClientCache for more info.
+
+        cache_policy
+            The name of the cache's eviction policy: 'circular' (the
+            default), 'slru' (segmented LRU) or '2q'.  Shared caches
+            always use the circular policy.  See
+            ZEO.cache.eviction_policies for more info.
+
+        cache_warmup
+            The number of most frequently loaded objects to record
+            when the storage is closed, and to load into the cache in
+            the background when it connects, defaulting to 0, which
+            disables warm-up.  The objects are recorded in a file
+            named after the cache file, with a ``.hot`` suffix, so
+            warm-up requires a persistent cache.
+
+        cache_warmup_rate
+            The maximum number of objects per second to request from
+            the server when warming up the cache, defaulting to 1000.
+
+        cache_compact_interval
+            The number of seconds between steps of background cache
+            compaction, which gathers the free space scattered through
+            the cache file so that records needn't be evicted to reuse
+            it.  The default, 0, disables compaction.
+
+        cache_mmap
+            Memory map the cache file, so that cache hits are read
+            from the mapping rather than with separate seeks and
+            reads, defaulting to False.  Shared caches ignore this.
+
+        cache_l1_size
+            The number of bytes of recently used current object data
+            to keep in memory, in front of the cache file, defaulting
+            to 0, which disables the in-memory tier.  With
+            cache_segments, each segment gets an equal share.  Shared
+            caches ignore this.
+
+        cache_admission_small
+            If set, a TinyLFU admission filter decides whether stored
+            data is added to the cache.  Objects smaller than this many
+            bytes are always added.  Larger objects are added only if
+            they've been used often enough, more often the larger they
+            are.  The default, None, disables the filter.  Shared
+            caches ignore this.  See ZEO.cache.TinyLFUAdmission.
+
+        cache_compress, cache_compress_threshold
+            If cache_compress is true, object data of at least
+            cache_compress_threshold bytes (256 by default) is stored
+            in the cache compressed with zlib, if that makes it
+            smaller.  cache_compress defaults to False.  Shared caches
+            ignore these.
+
+        cache_noncurrent_size
+            The maximum number of bytes of non-current object
+            revisions to keep in the cache.  The least recently used
+            ones are freed to stay within the limit.  The default,
+            None, means no limit other than the cache size.  With
+            cache_segments, each segment gets an equal share.  Shared
+            caches ignore this.
+
+        cache_compact_index
+            Keep the cache's indexes in sorted arrays rather than in
+            BTrees, which uses much less memory for caches with lots of
+            objects, at some cost in speed, defaulting to False.
+            Shared caches ignore this.
+
+        store_batch_count, store_batch_size
+            The maximum number of object records, and their total size,
+            to send to the server in a single message when committing a
+            transaction, if the server supports it.  Stores are sent
+            when either limit is reached, and before voting.  The
+            defaults are 1000 records and 1MB.  A count of 1 disables
+            batching.
+
+        reference_prefetch_depth
+            When an object is loaded from the server, prefetch the
+            objects it references in the background, and the objects
+            they reference, to this depth.  The default, 0, disables
+            reference prefetching.
+
+        reference_prefetch_budget
+            The maximum number of bytes to prefetch by following
+            references from a loaded object.  The default is 1MB.
+
+        connections
+            The number of connections to make to the server.  Loads
+            are spread over the connections, so a slow load doesn't
+            hold up others.  Commits and invalidations use the first
+            connection.  The default is 1.
+
+        replicas
+            The addresses of read-only replica servers, in the same
+            forms as addr.  If given, loads (loadBefore, loadSerial
+            and blob downloads) are made from replicas that have
+            committed the transactions being read, and from the
+            primary server otherwise.  Commits, new_oids and
+            everything else use the primary server.
+
         wait_timeout
             Maximum time to wait for results, including connecting.
 
@@ -228,7 +350,41 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         self._oids = [] # List of pre-fetched oids from server
 
         cache = self._cache = open_cache(
-            cache, var, client, storage, cache_size)
+            cache, var, client, storage, cache_size, cache_segments,
+            cache_shared, cache_policy,
+            use_mmap=cache_mmap,
+            l1_size=cache_l1_size,
+            admission=(
+                ZEO.cache.TinyLFUAdmission(small=cache_admission_small)
+                if cache_admission_small else None),
+            compress=cache_compress,
+            compress_threshold=cache_compress_threshold,
+            noncurrent_size=cache_noncurrent_size,
+            compact_index=cache_compact_index,
+            )
+
+        self._warmup_size = cache_warmup
+        self._warmup_batch_size = max(min(100, cache_warmup_rate), 1)
+        self._warmup_interval = (
+            self._warmup_batch_size / float(max(cache_warmup_rate, 1)))
+        self._warmup_oids = ()
+        self._load_counts = None
+        self._cache_compact_interval = cache_compact_interval
+        self._store_batch_count = store_batch_count
+        self._store_batch_size = store_batch_size
+        self._pending_stores = []
+        self._pending_size = 0
+        self._reference_prefetch_depth = reference_prefetch_depth
+        self._reference_prefetch_budget = reference_prefetch_budget
+        self._prefetched_references = (
+            ZEO.asyncio.client.PrefetchedReferences()
+            if reference_prefetch_depth else None)
+        if cache_warmup and getattr(cache, 'path', None):
+            self._warmup_path = cache.path + '.hot'
+            self._warmup_oids = read_hot_oids(
+                self._warmup_path, cache_warmup)
+            self._load_counts = collections.Counter()
+            self._load_counts_lock = threading.Lock()
 
         # XXX need to check for POSIX-ness here
         self.blob_dir = blob_dir
@@ -266,6 +422,8 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             wait_timeout or 30,
             ssl = ssl, ssl_server_hostname=ssl_server_hostname,
             credentials=credentials,
+            connections=connections,
+            replicas=self._normalize_addr(replicas) if replicas else (),
             )
         self._call = self._server.call
         self._async = self._server.async
@@ -300,6 +458,17 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
     def close(self):
         "Storage API: finalize the storage, releasing external resources."
+        if self._load_counts is not None:
+            with self._load_counts_lock:
+                counts, self._load_counts = self._load_counts, None
+            oids = [oid for oid, count
+                    in _most_common(counts, self._warmup_size)]
+            # If we weren't open long, fill up with the objects that
+            # were hot last time.
+            seen = set(oids)
+            oids.extend(oid for oid in self._warmup_oids if oid not in seen)
+            write_hot_oids(self._warmup_path, oids[:self._warmup_size])
+
         self._server.close()
 
         if self._check_blob_size_thread is not None:
@@ -391,6 +560,18 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         if self.server_sync:
             self.sync = self.ping
 
+        if self._warmup_oids:
+            conn.warmup(self._warmup_oids, self._warmup_batch_size,
+                        self._warmup_interval)
+
+        if self._cache_compact_interval:
+            conn.start_compaction(self._cache_compact_interval)
+
+        if self._prefetched_references is not None:
+            conn.prefetch_references(self._reference_prefetch_depth,
+                                     self._reference_prefetch_budget,
+                                     self._prefetched_references)
+
     def set_server_addr(self, addr):
         # Normalize server address and convert to string
         if isinstance(addr, str):
@@ -506,7 +687,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
     def loadSerial(self, oid, serial):
         """Storage API: load a historical revision of an object."""
-        return self._call('loadSerial', oid, serial)
+        return self._server.call_load(serial, 'loadSerial', oid, serial)
 
     def load(self, oid, version=''):
         result = self.loadBefore(oid, utils.maxtid)
@@ -515,15 +696,50 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         return result[:2]
 
     def loadBefore(self, oid, tid):
+        if self._load_counts is not None:
+            self._count_load(oid)
+
         result = self._cache.loadBefore(oid, tid)
         if result:
+            if self._prefetched_references is not None:
+                self._prefetched_references.used(oid)
             return result
 
         return self._server.load_before(oid, tid)
 
+    def _count_load(self, oid):
+        # This isn't locked, as it's done for every load.  A count
+        # lost to a race with another thread just makes our idea of
+        # which objects are hot a little less accurate.
+        counts = self._load_counts
+        if counts is None:
+            return # closed
+        counts[oid] += 1
+        if len(counts) > 4 * self._warmup_size:
+            with self._load_counts_lock:
+                if counts is self._load_counts:
+                    # Only keep the most loaded objects, with their
+                    # counts halved, so that objects that used to be
+                    # popular give way to ones that are popular now.
+                    self._load_counts = collections.Counter(dict(
+                        (oid, count // 2) for oid, count
+                        in _most_common(counts, self._warmup_size)))
+
     def prefetch(self, oids, tid):
         self._server.prefetch(oids, tid)
 
+    def reference_prefetch_stats(self):
+        """Return statistics on reference prefetching
+
+        A dictionary with the numbers of objects prefetched by
+        following references, of those that were used (hits), of those
+        that were invalidated or forgotten before being used (wasted),
+        and of those that haven't been used yet (pending).  None is
+        returned if reference prefetching is disabled.
+        """
+        if self._prefetched_references is not None:
+            return self._prefetched_references.stats()
+
     def new_oid(self):
         """Storage API: return a new object identifier.
         """
@@ -564,11 +780,31 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         assert not version
 
         tbuf = self._check_trans(txn, 'store')
-        self._async('storea', oid, serial, data, id(txn))
+        if (self._store_batch_count > 1 and
+            self._info.get('supports_store_many')):
+            pending = self._pending_stores
+            pending.append((oid, serial, data))
+            self._pending_size += len(data)
+            if (len(pending) >= self._store_batch_count or
+                self._pending_size >= self._store_batch_size):
+                self._flush_stores(txn)
+        else:
+            self._async('storea', oid, serial, data, id(txn))
         tbuf.store(oid, data)
 
+    def _flush_stores(self, txn):
+        # Send stores batched by store.  This is called before sending
+        # other messages for the transaction, so the server sees
+        # everything in the order it was done.
+        if self._pending_stores:
+            stores = self._pending_stores
+            self._pending_stores = []
+            self._pending_size = 0
+            self._async('storeMany', stores, id(txn))
+
     def checkCurrentSerialInTransaction(self, oid, serial, transaction):
         self._check_trans(transaction, 'checkCurrentSerialInTransaction')
+        self._flush_stores(transaction)
         self._async(
             'checkCurrentSerialInTransaction', oid, serial, id(transaction))
 
@@ -592,6 +828,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         os.remove(target[:-1])
 
         serials = self.store(oid, serial, data, '', txn)
+        self._flush_stores(txn)
         if self.shared_blob_dir:
             self._async(
                 'storeBlobShared',
@@ -645,6 +882,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
     def deleteObject(self, oid, serial, txn):
         tbuf = self._check_trans(txn, 'deleteObject')
+        self._flush_stores(txn)
         self._async('deleteObject', oid, serial, id(txn))
         tbuf.store(oid, None)
 
@@ -691,7 +929,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             # returns, it will have been sent. (The recieving will
             # have been handled by the asyncore thread.)
 
-            self._call('sendBlob', oid, serial)
+            self._server.call_load(serial, 'sendBlob', oid, serial)
 
             if os.path.exists(blob_filename):
                 return _accessed(blob_filename)
@@ -721,7 +959,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                     # We're using a server shared cache.  If the file isn't
                     # here, it's not anywhere.
                     raise POSException.POSKeyError("No blob file", oid, serial)
-                self._call('sendBlob', oid, serial)
+                self._server.call_load(serial, 'sendBlob', oid, serial)
                 if not os.path.exists(blob_filename):
                     raise POSException.POSKeyError("No blob file", oid, serial)
 
@@ -742,6 +980,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         """
         tbuf = self._check_trans(txn, 'tpc_vote')
         try:
+            self._flush_stores(txn)
 
             conflicts = True
             vote_attempts = 0
@@ -831,6 +1070,8 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
     def tpc_end(self, txn):
         tbuf = txn.data(self)
         if tbuf is not None:
+            self._pending_stores = []
+            self._pending_size = 0
             tbuf.close()
             txn.set_data(self, None)
             self._commit_lock.release()
@@ -923,6 +1164,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
         """
         self._check_trans(txn, 'undo')
+        self._flush_stores(txn)
         self._async('undoa', trans_id, id(txn))
 
     def undoInfo(self, first=0, last=-20, specification=None):
@@ -956,6 +1198,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         """Write data already committed in a separate database."""
         assert not version
         self._check_trans(transaction, 'restore')
+        self._flush_stores(transaction)
         self._async('restorea', oid, serial, data, prev_txn, id(transaction))
 
     # Below are methods invoked by the StorageServer
@@ -1256,17 +1499,70 @@ def _lock_blob(path):
         else:
             break
 
-def open_cache(cache, var, client, storage, cache_size):
+def _most_common(counts, n):
+    # Other threads may be counting loads, so we work on a copy,
+    # which dict makes in one step.
+    return collections.Counter(dict(counts)).most_common(n)
+
+def read_hot_oids(path, size):
+    """Read up to size oids recorded by write_hot_oids
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(size * 8)
+    except (IOError, OSError):
+        return ()
+    return [data[i:i+8] for i in range(0, len(data) - 7, 8)]
+
+def write_hot_oids(path, oids):
+    """Record the oids, most frequently loaded first, for a later warm-up
+    """
+    # Processes sharing a cache file write their hot oids to the same
+    # file, so they mustn't use the same temporary file.
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(oids))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logger.warning("Couldn't save hot oids to %r", path, exc_info=True)
+
+def open_cache(cache, var, client, storage, cache_size, cache_segments=1,
+               cache_shared=False, cache_policy='circular', **options):
+    # options are passed to the ClientCache constructor
     if isinstance(cache, (None.__class__, str)):
-        from ZEO.cache import ClientCache
+        from ZEO.cache import ClientCache, SegmentedClientCache
+        from ZEO.cache import SharedClientCache
+        if cache_shared:
+            def factory(path, size):
+                if path:
+                    return SharedClientCache(path, size)
+                else:
+                    # There's nothing to share.
+                    return ClientCache(path, size, policy=cache_policy,
+                                       **options)
+        elif cache_segments > 1:
+            # Byte budgets are for the whole cache, as cache_size is.
+            for name in 'l1_size', 'noncurrent_size':
+                if options.get(name):
+                    options[name] //= cache_segments
+            def factory(path, size):
+                return SegmentedClientCache(path, size, cache_segments,
+                                            policy=cache_policy, **options)
+        else:
+            def factory(path, size):
+                return ClientCache(path, size, policy=cache_policy,
+                                   **options)
         if cache is None:
             if client:
                 cache = os.path.join(var or os.getcwd(),
                                      "%s-%s.zec" % (client, storage))
             else:
                 # ephemeral cache
-                return ClientCache(None, cache_size)
+                return factory(None, cache_size)
 
-        cache = ClientCache(cache, cache_size)
+        cache = factory(cache, cache_size)
 
     return cache
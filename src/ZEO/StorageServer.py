@@ -66,7 +66,8 @@ class StorageServerError(StorageError):
     """Error reported when an unpicklable exception is raised."""
 
 registered_methods = set(( 'get_info', 'lastTransaction',
-    'getInvalidations', 'new_oids', 'pack', 'loadBefore', 'storea',
+    'getInvalidations', 'new_oids', 'pack', 'loadBefore', 'loadBeforeMany',
+    'storea', 'storeMany',
     'checkCurrentSerialInTransaction', 'restorea', 'storeBlobStart',
     'storeBlobChunk', 'storeBlobEnd', 'storeBlobShared',
     'deleteObject', 'tpc_begin', 'vote', 'tpc_finish', 'tpc_abort',
@@ -241,6 +242,8 @@ class ZEOStorage(object):
                 'name': storage.getName(),
                 'supportsUndo': supportsUndo,
                 'supports_record_iternext': hasattr(self, 'record_iternext'),
+                'supports_load_before_many': True,
+                'supports_store_many': True,
                 'interfaces': tuple(interfaces),
                 }
 
@@ -253,6 +256,26 @@ class ZEOStorage(object):
         self.stats.loads += 1
         return self.storage.loadBefore(oid, tid)
 
+    def loadBeforeMany(self, oid_tids):
+        """Load several objects, replying separately for each.
+
+        This is called asynchronously.  Each result is sent as the
+        reply to a loadBefore call with the (oid, tid) pair as its
+        message id, as clients use for loadBefore calls, so clients can
+        collapse these loads with others for the same objects.
+        """
+        connection = self.connection
+        for oid, tid in oid_tids:
+            try:
+                result = self.loadBefore(oid, tid)
+            except Exception as exc:
+                if not isinstance(exc, connection.unlogged_exception_types):
+                    self.log("Bad loadBeforeMany request for %r" % oid,
+                             logging.ERROR, exc_info=True)
+                connection.send_error((oid, tid), exc)
+            else:
+                connection.send_reply((oid, tid), result)
+
     def getInvalidations(self, tid):
         invtid, invlist = self.server.get_invalidations(self.storage_id, tid)
         if invtid is None:
@@ -447,6 +470,13 @@ class ZEOStorage(object):
         self.stats.stores += 1
         self.txnlog.store(oid, serial, data)
 
+    def storeMany(self, stores, id):
+        # stores is a sequence of (oid, serial, data) tuples, sent by
+        # clients that batch their stores.
+        self._check_tid(id, exc=StorageTransactionError)
+        self.stats.stores += len(stores)
+        self.txnlog.store_many(stores)
+
     def checkCurrentSerialInTransaction(self, oid, serial, id):
         self._check_tid(id, exc=StorageTransactionError)
         self.txnlog.checkread(oid, serial)
@@ -540,6 +570,10 @@ class ZEOStorage(object):
             if serial != b"\0\0\0\0\0\0\0\0":
                 self.invalidated.append(oid)
 
+    def _store_many(self, stores):
+        for oid, serial, data in stores:
+            self._store(oid, serial, data)
+
     def _restore(self, oid, serial, data, prev_txn):
         self.storage.restore(oid, serial, data, '', prev_txn,
                              self.transaction)
@@ -1074,6 +1108,9 @@ class CommitLog(object):
         self.pickler = Pickler(self.file, 1)
         self.pickler.fast = 1
         self.stores = 0
+        # The number of records, which may differ from the number of
+        # stores because store_many writes a single record.
+        self.records = 0
 
     def size(self):
         return self.file.tell()
@@ -1081,27 +1118,37 @@ class CommitLog(object):
     def delete(self, oid, serial):
         self.pickler.dump(('_delete', (oid, serial)))
         self.stores += 1
+        self.records += 1
 
     def checkread(self, oid, serial):
         self.pickler.dump(('_checkread', (oid, serial)))
         self.stores += 1
+        self.records += 1
 
     def store(self, oid, serial, data):
         self.pickler.dump(('_store', (oid, serial, data)))
         self.stores += 1
+        self.records += 1
+
+    def store_many(self, stores):
+        self.pickler.dump(('_store_many', (stores, )))
+        self.stores += len(stores)
+        self.records += 1
 
     def restore(self, oid, serial, data, prev_txn):
         self.pickler.dump(('_restore', (oid, serial, data, prev_txn)))
         self.stores += 1
+        self.records += 1
 
     def undo(self, transaction_id):
         self.pickler.dump(('_undo', (transaction_id, )))
         self.stores += 1
+        self.records += 1
 
     def __iter__(self):
         self.file.seek(0)
         unpickler = Unpickler(self.file)
-        for i in range(self.stores):
+        for i in range(self.records):
             yield unpickler.load()
 
     def close(self):
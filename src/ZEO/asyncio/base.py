@@ -5,16 +5,21 @@ if PY3:
 else:
     import trollius as asyncio
 
+import collections
 import logging
 import socket
-from struct import unpack
+from struct import unpack_from
 import sys
 
 logger = logging.getLogger(__name__)
 
 INET_FAMILIES = socket.AF_INET, socket.AF_INET6
 
-class Protocol(asyncio.Protocol):
+# Where available (Python 3.7 and later), transports read into buffers
+# we provide, see get_buffer below.
+BaseProtocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+class Protocol(BaseProtocol):
     """asyncio low-level ZEO base interface
     """
 
@@ -31,7 +36,8 @@ class Protocol(asyncio.Protocol):
         self.loop = loop
         self.addr = addr
         self.input  = [] # Input buffer when assembling messages
-        self.output = [] # Output buffer when paused
+        self.buffer = None # Read buffer, see get_buffer
+        self.output = collections.deque() # Output buffer when paused
         self.paused = [] # Paused indicator, mutable to avoid attr lookup
 
         # Handle the first message, the protocol handshake, differently
@@ -45,6 +51,7 @@ class Protocol(asyncio.Protocol):
         if not self.closed:
             self.closed = True
             if self.transport is not None:
+                self._flush()
                 self.transport.close()
 
     def connection_made(self, transport):
@@ -62,20 +69,42 @@ class Protocol(asyncio.Protocol):
         output = self.output
         append = output.append
         writelines = transport.writelines
+        call_soon = self.loop.call_soon
         from struct import pack
 
+        # Messages written in an event-loop iteration are corked and
+        # written together, with one writelines call, when the loop
+        # gets around to it, rather than with a write (and usually a
+        # system call) each.
+        corked = []
+        cork = corked.extend
+
+        def flush():
+            if corked:
+                data = corked[:]
+                del corked[:]
+                writelines(data)
+
+        self._flush = flush
+
         def write(message):
             if paused:
                 append(message)
+            elif corked:
+                cork((pack(">I", len(message)), message))
             else:
-                writelines((pack(">I", len(message)), message))
+                cork((pack(">I", len(message)), message))
+                call_soon(flush)
 
         self._write = write
 
         def writeit(data):
             # Note, don't worry about combining messages.  Iters
             # will be used with blobs, in which case, the individual
-            # messages will be big to begin with.
+            # messages will be big to begin with.  We write them as
+            # we go, so we can stop when paused, after writing
+            # anything corked before them.
+            flush()
             data = iter(data)
             for message in data:
                 writelines((pack(">I", len(message)), message))
@@ -92,43 +121,121 @@ class Protocol(asyncio.Protocol):
 
         # Low-level input handler collects data into sized messages.
 
-        # Note that the logic below assume that when new data pushes
-        # us over what we want, we process it in one call until we
-        # need more, because we assume that excess data is all in the
-        # last item of self.input. This is why the exception handling
-        # in the while loop is critical.  Without it, an exception
-        # might cause us to exit before processing all of the data we
-        # should, when then causes the logic to be broken in
-        # subsequent calls.
-
-        self.got += len(data)
-        self.input.append(data)
-        while self.got >= self.want:
-            try:
-                extra = self.got - self.want
-                if extra == 0:
-                    collected = b''.join(self.input)
-                    self.input = []
-                else:
-                    input = self.input
-                    self.input = [input[-1][-extra:]]
-                    input[-1] = input[-1][:-extra]
-                    collected = b''.join(input)
-
-                self.got = extra
-
-                if self.getting_size:
-                    # we were recieving the message size
-                    assert self.want == 4
-                    self.want = unpack(">I", collected)[0]
-                    self.getting_size = False
-                else:
-                    self.want = 4
-                    self.getting_size = True
-                    self.message_received(collected)
-            except Exception:
-                logger.exception("data_received %s %s %s",
-                                 self.want, self.got, self.getting_size)
+        # Messages are sliced out of data by position, so the rest of
+        # data isn't copied for each message, and a message that's all
+        # of data isn't copied at all.  Only a message (or size) that
+        # spans calls is collected in self.input, and joined once
+        # complete.
+
+        pos = 0
+        size = len(data)
+        if self.input:
+            need = self.want - self.got
+            if size < need:
+                self.input.append(data)
+                self.got += size
+                return
+            self.input.append(data[:need] if need < size else data)
+            collected = b''.join(self.input)
+            self.input = []
+            self.got = 0
+            pos = need
+            if self.getting_size:
+                self.want = unpack_from(">I", collected)[0]
+                self.getting_size = False
+            else:
+                self.want = 4
+                self.getting_size = True
+                self._message_received(collected)
+
+        while 1:
+            if self.getting_size:
+                if size - pos < 4:
+                    break
+                self.want = unpack_from(">I", data, pos)[0]
+                self.getting_size = False
+                pos += 4
+            else:
+                want = self.want
+                if size - pos < want:
+                    break
+                message = data if want == size else data[pos:pos+want]
+                pos += want
+                self.want = 4
+                self.getting_size = True
+                self._message_received(message)
+
+        if pos < size:
+            self.input.append(data[pos:] if pos else data)
+            self.got = size - pos
+
+    def _message_received(self, message):
+        # Errors handling a message mustn't keep us from handling the
+        # ones that follow.
+        try:
+            self.message_received(message)
+        except Exception:
+            logger.exception("data_received %s %s %s",
+                             self.want, self.got, self.getting_size)
+
+    # Support for asyncio.BufferedProtocol.  The transport reads into
+    # self.buffer, from which messages are sliced.  A message too
+    # large for it is read directly into a buffer of its own, and
+    # passed on, as a bytearray, without copying.
+
+    buffer_size = 1 << 18 # The most asyncio reads at a time
+    start = end = 0 # The unprocessed data in self.buffer
+    message = None # A large message being read
+    def get_buffer(self, sizehint=-1):
+        message = self.message
+        if message is not None:
+            return memoryview(message)[self.got:]
+
+        buffer = self.buffer
+        if buffer is None:
+            buffer = self.buffer = bytearray(self.buffer_size)
+        start, end = self.start, self.end
+        if start == end:
+            start = end = 0
+        elif len(buffer) - end < 4096:
+            # Move the partial message to the front to make room
+            buffer[:end - start] = buffer[start:end]
+            start, end = 0, end - start
+        self.start, self.end = start, end
+        return memoryview(buffer)[end:]
+
+    def buffer_updated(self, nbytes):
+        message = self.message
+        if message is not None:
+            self.got += nbytes
+            if self.got == len(message):
+                self.message = None
+                self.got = 0
+                self._message_received(message)
+            return
+
+        buffer = self.buffer
+        view = memoryview(buffer)
+        start = self.start
+        end = self.end = self.end + nbytes
+        while end - start >= 4:
+            want = unpack_from(">I", buffer, start)[0]
+            if end - start - 4 >= want:
+                message = view[start+4:start+4+want].tobytes()
+                start = self.start = start + 4 + want
+                self._message_received(message)
+            elif want > len(buffer) // 2:
+                message = self.message = bytearray(want)
+                self.got = end - start - 4
+                message[:self.got] = view[start+4:end]
+                start = end
+                break
+            else:
+                break
+        self.start = start
+
+    def _flush(self):
+        pass # Replaced in connection_made
 
     def first_message_received(self, protocol_version):
         # Handler for first/handshake message, set up in __init__
@@ -152,7 +259,7 @@ class Protocol(asyncio.Protocol):
         writelines = self.transport.writelines
         from struct import pack
         while output and not paused:
-            message = output.pop(0)
+            message = output.popleft()
             if isinstance(message, bytes):
                 writelines((pack(">I", len(message)), message))
             else:
@@ -160,7 +267,7 @@ class Protocol(asyncio.Protocol):
                 for message in data:
                     writelines((pack(">I", len(message)), message))
                     if paused: # paused again. Put iter back.
-                        output.insert(0, data)
+                        output.appendleft(data)
                         break
 
     def get_peername(self):
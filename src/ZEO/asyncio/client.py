@@ -1,4 +1,5 @@
 from ZEO.Exceptions import ClientDisconnected, ServerException
+import collections
 import concurrent.futures
 import functools
 import logging
@@ -7,10 +8,13 @@ import threading
 
 import ZODB.event
 import ZODB.POSException
+from ZODB.serialize import referencesf
+from ZODB.utils import maxtid, p64, u64, z64
 
 import ZEO.Exceptions
 import ZEO.interfaces
 
+from .._compat import PY3
 from . import base
 from .compat import asyncio, new_event_loop
 from .marshal import encoder, decoder
@@ -97,6 +101,7 @@ class Protocol(base.Protocol):
             self.closed = True
             self._connecting.cancel()
             if self.transport is not None:
+                self._flush()
                 self.transport.close()
             for future in self.pop_futures():
                 future.set_exception(ClientDisconnected("Closed"))
@@ -230,6 +235,12 @@ class Protocol(base.Protocol):
                 future.set_exception(args[1])
             else:
                 future.set_result(args)
+                if args and msgid.__class__ is tuple:
+                    # A load.  The future's callbacks are called soon,
+                    # after we've handled any invalidations read with
+                    # the reply, so the data are cached now, before
+                    # they can be invalidated.
+                    self.client.loaded(msgid[0], args)
         else:
             assert async # clients only get async calls
             if name in self.client_methods:
@@ -258,6 +269,25 @@ class Protocol(base.Protocol):
                 self.encode(message_id, False, 'loadBefore', (oid, tid)))
         return future
 
+    def load_before_many(self, oid_tids):
+        # Load several objects with one loadBeforeMany message.  The
+        # server replies separately for each object, using the same
+        # message ids as load_before, so outstanding requests are
+        # collapsed with load_before's.  Return the futures for the
+        # objects, in order.
+        futures = []
+        needed = []
+        for message_id in oid_tids:
+            future = self.futures.get(message_id)
+            if future is None:
+                future = asyncio.Future(loop=self.loop)
+                self.futures[message_id] = future
+                needed.append(message_id)
+            futures.append(future)
+        if needed:
+            self.call_async('loadBeforeMany', (needed,))
+        return futures
+
     # Methods called by the server.
     # WARNING WARNING we can't call methods that call back to us
     # syncronously, as that would lead to DEADLOCK!
@@ -343,7 +373,8 @@ class Client(object):
     def __init__(self, loop,
                  addrs, client, cache, storage_key, read_only, connect_poll,
                  register_failed_poll=9,
-                 ssl=None, ssl_server_hostname=None, credentials=None):
+                 ssl=None, ssl_server_hostname=None, credentials=None,
+                 connections=1, replicas=()):
         """Create a client interface
 
         addr is either a host,port tuple or a string file name.
@@ -351,6 +382,14 @@ class Client(object):
         client is a ClientStorage. It must be thread safe.
 
         cache is a ZEO.interfaces.IClientCache.
+
+        connections is the number of connections to make to the
+        server.  Loads are spread over them.  Everything else uses
+        the first (primary) connection.
+
+        replicas is a sequence of addresses of read-only replica
+        servers.  If given, loads are made from the replicas, when
+        they're up to date, rather than from the primary connection.
         """
         self.loop = loop
         self.addrs = addrs
@@ -362,6 +401,12 @@ class Client(object):
         self.ssl = ssl
         self.ssl_server_hostname = ssl_server_hostname
         self.credentials = credentials
+        self.connections = connections
+        self.replicas = replicas
+        self.secondary_protocols = [] # connecting or connected
+        self.secondaries = [] # connected
+        self.secondary_loads = {} # {oid -> number of loads outstanding}
+        self.secondary_invalidated = {} # {oid -> tid}
         for name in Protocol.client_delegated:
             setattr(self, name, getattr(client, name))
         self.cache = cache
@@ -393,6 +438,7 @@ class Client(object):
         if not self.closed:
             self.closed = True
             self.ready = False
+            self.close_secondaries()
             if self.protocol is not None:
                 self.protocol.close()
             self.cache.close()
@@ -411,6 +457,7 @@ class Client(object):
                 self.client.notify_disconnected()
             if self.ready:
                 self.ready = False
+            self.close_secondaries()
             self.connected = concurrent.futures.Future()
             self.protocol = None
             self._clear_protocols()
@@ -420,6 +467,7 @@ class Client(object):
 
     def upgrade(self, protocol):
         self.ready = False
+        self.close_secondaries()
         self.connected = concurrent.futures.Future()
         self.protocol.close()
         self.protocol = protocol
@@ -498,8 +546,7 @@ class Client(object):
                     if vdata:
                         self.verify_result = "quick verification"
                         server_tid, oids = vdata
-                        for oid in oids:
-                            cache.invalidate(oid, None)
+                        self.cache_invalidate_many(oids, None)
                         self.client.invalidateTransaction(server_tid, oids)
                     else:
                         # cache is too old
@@ -545,9 +592,88 @@ class Client(object):
                 self.register_failed(self, exc)
 
             else:
+                self.supports_load_before_many = info.get(
+                    'supports_load_before_many', False)
+                self.start_secondaries()
                 self.client.notify_connected(self, info)
                 self.connected.set_result(None)
 
+    def start_secondaries(self):
+        """Make extra connections, used for loads, to our server and replicas
+
+        Secondary connections are registered read-only.  Messages
+        from the server on them are only used to track how up to date
+        the server is (see _load_protocol), so cache invalidations are
+        only handled, in order, by the primary connection.
+        """
+        connected = [p.addr for p in self.secondary_protocols]
+        addrs = [self.protocol.addr] * (self.connections - 1)
+        addrs.extend(self.replicas)
+        for addr in addrs:
+            if addr in connected:
+                connected.remove(addr)
+            else:
+                self.secondary_protocols.append(
+                    Protocol(self.loop, addr, SecondaryConnection(self),
+                             self.storage_key, True, self.connect_poll,
+                             ssl=self.ssl,
+                             ssl_server_hostname=self.ssl_server_hostname,
+                             credentials=self.credentials,
+                             ))
+
+    def close_secondaries(self):
+        protocols = self.secondary_protocols
+        self.secondary_protocols = []
+        self.secondaries = []
+        for protocol in protocols:
+            protocol.close()
+
+    def secondary_registered(self, protocol):
+        if protocol in self.secondary_protocols:
+            self.secondaries.append(protocol)
+        else:
+            protocol.close()
+
+    def secondary_disconnected(self, protocol):
+        if protocol in self.secondary_protocols:
+            self.secondary_protocols.remove(protocol)
+            if protocol in self.secondaries:
+                self.secondaries.remove(protocol)
+            self.loop.call_later(
+                self.connect_poll + local_random.random(),
+                self._replace_secondary)
+
+    def _replace_secondary(self):
+        if self.ready:
+            self.start_secondaries()
+
+    load_index = 0
+    def _load_protocol(self, tid):
+        # Choose a connection to load data committed by tid from.
+        # Secondary connections are only used if their servers have
+        # committed tid, so a lagging replica doesn't give us old data.
+        # Connections are chosen round robin.  If we have replicas,
+        # the primary connection is only used if none are up to date.
+        protocols = [p for p in self.secondaries if p.client.last_tid >= tid]
+        if not protocols:
+            return self.protocol
+        if not self.replicas:
+            protocols.insert(0, self.protocol)
+        self.load_index = index = (self.load_index + 1) % len(protocols)
+        return protocols[index]
+
+    def call_load_threadsafe(self, future, wait_ready, tid, method, args):
+        # Call a method that loads data committed by tid, see
+        # _load_protocol.
+        if self.ready:
+            self._load_protocol(tid).call(future, method, args)
+        elif wait_ready:
+            self._when_ready(
+                self.call_load_threadsafe, future, wait_ready,
+                tid, method, args)
+        else:
+            future.set_exception(ClientDisconnected())
+
     def get_peername(self):
         return self.protocol.get_peername()
 
@@ -603,14 +729,57 @@ class Client(object):
             future.set_result(data)
         elif self.ready:
             try:
-                data = yield self.protocol.load_before(oid, tid)
+                protocol = self._load_protocol(
+                    self.cache.getLastTid() if tid == maxtid
+                    else p64(max(u64(tid), 1) - 1))
+                retry = False
+                if protocol is self.protocol:
+                    data = yield protocol.load_before(oid, tid)
+                else:
+                    # Replies on secondary connections aren't ordered
+                    # with respect to invalidations, which arrive on
+                    # the primary connection.  If the object is
+                    # invalidated while we wait, the data may be stale
+                    # and we load it again from the primary connection.
+                    last_tid = self.cache.getLastTid()
+                    self.secondary_loads[oid] = (
+                        self.secondary_loads.get(oid, 0) + 1)
+                    try:
+                        data = yield protocol.load_before(oid, tid)
+                    except ClientDisconnected:
+                        retry = True
+                    else:
+                        retry = (self.secondary_invalidated.get(oid, last_tid)
+                                 > last_tid)
+                    finally:
+                        count = self.secondary_loads.pop(oid) - 1
+                        if count:
+                            self.secondary_loads[oid] = count
+                        else:
+                            self.secondary_invalidated.pop(oid, None)
+                    if retry:
+                        if not self.ready:
+                            raise ClientDisconnected()
+                        data = yield self.protocol.load_before(oid, tid)
             except Exception as exc:
                 future.set_exception(exc)
             else:
                 future.set_result(data)
                 if data:
                     data, start, end = data
-                    self.cache.store(oid, start, end, data)
+                    # Data from the primary connection were cached
+                    # when they arrived.  Current data from a
+                    # secondary connection that's newer than the
+                    # invalidations we've seen isn't cached, as its
+                    # invalidation may not have arrived.
+                    if (protocol is not self.protocol and not retry and
+                        (end is not None or
+                         start <= self.cache.getLastTid())):
+                        self.cache.store(oid, start, end, data)
+                    if self.reference_prefetch_depth:
+                        self._prefetch_references(
+                            data, tid, self.reference_prefetch_depth,
+                            [self.reference_prefetch_budget])
         elif wait_ready:
             self._when_ready(
                 self.load_before_threadsafe, future, wait_ready, oid, tid)
@@ -618,33 +787,152 @@ class Client(object):
             future.set_exception(ClientDisconnected())
 
     @future_generator
-    def _prefetch(self, oid, tid):
+    def _prefetch(self, oid, tid, loaded):
+        # The data are cached when they arrive, so we just log errors.
         try:
-            data = yield self.protocol.load_before(oid, tid)
-            if data:
-                data, start, end = data
-                self.cache.store(oid, start, end, data)
+            yield loaded
         except Exception:
             logger.exception("prefetch %r %r" % (oid, tid))
 
+    # Whether the server supports loadBeforeMany (ZEO 5.1.1 and later)
+    supports_load_before_many = False
+
+    def _load_many(self, oids, tid):
+        # Request oids, returning their futures.
+        if self.supports_load_before_many and len(oids) > 1:
+            return self.protocol.load_before_many(
+                [(oid, tid) for oid in oids])
+        else:
+            return [self.protocol.load_before(oid, tid) for oid in oids]
+
     def prefetch(self, future, wait_ready, oids, tid):
         if self.ready:
-            for oid in oids:
-                if self.cache.loadBefore(oid, tid) is None:
-                    self._prefetch(oid, tid)
+            oids = [oid for oid in oids
+                    if self.cache.loadBefore(oid, tid) is None]
+            for oid, loaded in zip(oids, self._load_many(oids, tid)):
+                self._prefetch(oid, tid, loaded)
 
             future.set_result(None)
         else:
             future.set_exception(ClientDisconnected())
 
+    # Reference-following prefetch, see prefetch_references.
+    reference_prefetch_depth = 0
+    reference_prefetch_budget = 0
+    prefetched_references = None
+
+    def prefetch_references(self, depth, budget, prefetched):
+        """Prefetch objects referenced by objects loaded from the server
+
+        The referenced objects that aren't in the cache are loaded in
+        the background, as are the objects they reference, and so on,
+        up to depth levels.  At most budget bytes are prefetched for
+        each load.  Prefetched objects are recorded in prefetched, a
+        PrefetchedReferences, so we can tell how useful this is.
+        """
+        self.reference_prefetch_depth = depth
+        self.reference_prefetch_budget = budget
+        self.prefetched_references = prefetched
+
+    def _prefetch_references(self, data, tid, depth, budget):
+        # budget is a one-item list holding the number of bytes left
+        # for the prefetches started by a load.  We don't know how big
+        # objects are until they're loaded, so we assume they're the
+        # size of the object referencing them until then.
+        estimate = max(len(data), 1)
+        oids = []
+        try:
+            references = referencesf(data)
+        except Exception:
+            logger.exception("Couldn't get references to prefetch")
+            return
+        for oid in set(references):
+            if budget[0] < estimate:
+                break
+            if self.cache.loadBefore(oid, tid) is None:
+                budget[0] -= estimate
+                oids.append(oid)
+        for oid, loaded in zip(oids, self._load_many(oids, tid)):
+            self._prefetch_reference(
+                oid, tid, loaded, depth - 1, budget, estimate)
+
+    @future_generator
+    def _prefetch_reference(self, oid, tid, loaded, depth, budget, estimate):
+        try:
+            data = yield loaded
+        except Exception:
+            logger.exception("prefetch %r %r" % (oid, tid))
+            return
+        if data:
+            data, start, end = data
+            self.prefetched_references.add(oid)
+            budget[0] += estimate - len(data)
+            if depth > 0 and self.ready:
+                self._prefetch_references(data, tid, depth, budget)
+
+    warmup_generation = 0
+    def warmup(self, oids, batch_size, interval):
+        """Prefetch current data for oids in the background
+
+        The oids are prefetched batch_size at a time, interval seconds
+        apart, so as not to flood the server.  Objects that are
+        already in the cache aren't loaded.  Warming up stops if we
+        disconnect or if another warm-up starts.
+        """
+        self.warmup_generation += 1
+        generation = self.warmup_generation
+        oids = list(oids)
+
+        def prefetch_batch():
+            if (self.ready and generation == self.warmup_generation and
+                oids):
+                batch = oids[:batch_size]
+                del oids[:batch_size]
+                self.prefetch(concurrent.futures.Future(), False,
+                              batch, maxtid)
+                if oids:
+                    self.loop.call_later(interval, prefetch_batch)
+
+        prefetch_batch()
+
+    compacting = False
+    def start_compaction(self, interval):
+        """Compact the cache file every interval seconds
+
+        Each step moves a limited amount of data (see
+        ZEO.cache.ClientCache.compact), so the loop isn't kept busy
+        for long.  Compaction stops when we're closed.
+        """
+        if self.compacting or not hasattr(self.cache, 'compact'):
+            return
+        self.compacting = True
+
+        def step():
+            if self.closed:
+                self.compacting = False
+                return
+            try:
+                self.cache.compact()
+            except Exception:
+                logger.exception("Compacting the cache failed")
+            self.loop.call_later(interval, step)
+
+        self.loop.call_later(interval, step)
+
     @future_generator
     def tpc_finish_threadsafe(self, future, wait_ready, tid, updates, f):
         if self.ready:
             try:
                 tid = yield self.protocol.fut('tpc_finish', tid)
+                # Read the (temp-file backed) updates once.  An oid
+                # can be stored more than once in a transaction, and
+                # the last data stored for it is what was committed.
+                updates = collections.OrderedDict(
+                    (oid, (data, resolved))
+                    for oid, data, resolved in updates)
                 cache = self.cache
-                for oid, data, resolved in updates:
-                    cache.invalidate(oid, tid)
+                self.cache_invalidate_many(updates, tid)
+                for oid, (data, resolved) in updates.items():
                     if data and not resolved:
                         cache.store(oid, tid, None, data)
                 cache.setLastTid(tid)
@@ -666,15 +954,42 @@ class Client(object):
         self.close()
         future.set_result(None)
 
+    def cache_invalidate_many(self, oids, tid):
+        cache = self.cache
+        if hasattr(cache, 'invalidate_many'):
+            cache.invalidate_many(oids, tid)
+        else:
+            # A cache written before invalidate_many was added to
+            # IClientCache.
+            for oid in oids:
+                cache.invalidate(oid, tid)
+
     def invalidateTransaction(self, tid, oids):
         if self.ready:
-            for oid in oids:
-                self.cache.invalidate(oid, tid)
+            self.cache_invalidate_many(oids, tid)
+            if self.secondary_loads:
+                for oid in oids:
+                    if oid in self.secondary_loads:
+                        self.secondary_invalidated[oid] = tid
+            if self.prefetched_references is not None:
+                self.prefetched_references.invalidated(oids)
             self.client.invalidateTransaction(tid, oids)
             self.cache.setLastTid(tid)
         else:
             self.verify_invalidation_queue.append((tid, oids))
 
+    def loaded(self, oid, data):
+        # Data loaded on the primary connection, see
+        # Protocol.message_received.
+        data, start, end = data
+        try:
+            self.cache.store(oid, start, end, data)
+        except Exception:
+            # The load is still answered.  What the cache has for the
+            # object conflicts with what we loaded, so forget it.
+            logger.exception("Couldn't cache data loaded for %r", oid)
+            self.cache.invalidate(oid, None)
+
     def serialnos(self, serials):
         # Method called by ZEO4 storage servers.
 
@@ -708,6 +1023,97 @@ class Client(object):
             else:
                 return protocol.read_only
 
+class SecondaryConnection(object):
+    """Stand-in for the client of a secondary connection
+
+    See Client.start_secondaries.
+    """
+
+    last_tid = z64 # The last transaction the server told us about
+
+    def __init__(self, client):
+        self.client = client
+
+    def registered(self, protocol, server_tid):
+        if server_tid:
+            self.last_tid = server_tid
+        self.client.secondary_registered(protocol)
+
+    def register_failed(self, protocol, exc):
+        logger.info("Secondary connection registration failed, %s", exc)
+        protocol.close()
+        self.client.secondary_disconnected(protocol)
+
+    def disconnected(self, protocol):
+        self.client.secondary_disconnected(protocol)
+
+    def invalidateTransaction(self, tid, oids):
+        self.last_tid = tid
+
+    def ignore(self, *args):
+        pass
+
+    # Client.load_before_threadsafe decides whether to cache loads
+    serialnos = info = loaded = ignore
+
+    # Blobs requested with sendBlob on this connection.
+    def receiveBlobStart(self, *args):
+        self.client.client.receiveBlobStart(*args)
+
+    def receiveBlobChunk(self, *args):
+        self.client.client.receiveBlobChunk(*args)
+
+    def receiveBlobStop(self, *args):
+        self.client.client.receiveBlobStop(*args)
+
+class PrefetchedReferences(object):
+    """Keep track of how useful reference-following prefetch is
+
+    Objects that have been prefetched, but not yet used, are
+    remembered.  An object is a hit if it's loaded from the cache
+    while remembered.  It's wasted if it's invalidated before being
+    used, or if it's forgotten because more than size newer objects
+    have been prefetched since.
+
+    Objects are added in the client networking thread and used in
+    application threads.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.oids = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.prefetched = self.hits = self.wasted = 0
+
+    def add(self, oid):
+        with self.lock:
+            if oid not in self.oids:
+                self.oids[oid] = None
+                self.prefetched += 1
+                if len(self.oids) > self.size:
+                    self.oids.popitem(False)
+                    self.wasted += 1
+
+    def used(self, oid):
+        if oid in self.oids: # Avoid locking in the common case.
+            with self.lock:
+                if self.oids.pop(oid, 1) is None:
+                    self.hits += 1
+
+    def invalidated(self, oids):
+        with self.lock:
+            for oid in oids:
+                if self.oids.pop(oid, 1) is None:
+                    self.wasted += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(prefetched=self.prefetched,
+                        hits=self.hits,
+                        wasted=self.wasted,
+                        pending=len(self.oids),
+                        )
+
 class ClientRunner(object):
 
     def set_options(self, addrs, wrapper, cache, storage_key, read_only,
@@ -724,9 +1130,50 @@ class ClientRunner(object):
         self.call_threadsafe = self.client.call_threadsafe
         self.call_async_threadsafe = self.client.call_async_threadsafe
 
-        from concurrent.futures import Future
         call_soon_threadsafe = loop.call_soon_threadsafe
 
+        # Calls from other threads are queued, and the loop is woken
+        # (through its self-pipe) only if it isn't already due to run
+        # the queued calls, so calls made while the loop is busy are
+        # run with one wakeup.  Calls are popped after the flag is
+        # cleared, so none are left behind.
+        calls = collections.deque()
+        scheduled = []
+
+        def run_calls():
+            del scheduled[:]
+            popleft = calls.popleft
+            while calls:
+                meth, args = popleft()
+                try:
+                    meth(*args)
+                except Exception:
+                    logger.exception("Calling %s", meth)
+
+        def fail_calls(exc):
+            popleft = calls.popleft
+            while calls:
+                meth, args = popleft()
+                if args and isinstance(args[0], ResultFuture):
+                    args[0].set_exception(ClientDisconnected(exc))
+
+        def submit(meth, *args):
+            calls.append((meth, args))
+            if not scheduled:
+                scheduled.append(1)
+                try:
+                    call_soon_threadsafe(run_calls)
+                except Exception as exc:
+                    # The loop is closed (or closing).  Nothing will
+                    # run the queued calls, including ones other
+                    # threads queued after the flag was set, so fail
+                    # them rather than leave their callers waiting.
+                    del scheduled[:]
+                    fail_calls(exc)
+                    raise
+
+        self.submit = submit
+
         def call(meth, *args, **kw):
             timeout = kw.pop('timeout', None)
             assert not kw
@@ -737,14 +1184,14 @@ class ClientRunner(object):
             # wait flag.  If false, and we're disconnected, we fail
             # immediately. If that happens, then we try again with the
             # wait flag set to True and wait with the default timeout.
-            result = Future()
-            call_soon_threadsafe(meth, result, timeout is not None, *args)
+            result = ResultFuture()
+            submit(meth, result, timeout is not None, *args)
             try:
                 return self.wait_for_result(result, timeout)
             except ClientDisconnected:
                 if timeout is None:
-                    result = Future()
-                    call_soon_threadsafe(meth, result, True, *args)
+                    result = ResultFuture()
+                    submit(meth, result, True, *args)
                     return self.wait_for_result(result, self.timeout)
                 else:
                     raise
@@ -776,6 +1223,9 @@ class ClientRunner(object):
     def async_iter(self, it):
         return self.__call(self.client.call_async_iter_threadsafe, it)
 
+    def call_load(self, tid, method, *args):
+        return self.__call(self.client.call_load_threadsafe, tid, method, args)
+
     def prefetch(self, oids, tid):
         return self.__call(self.client.prefetch, oids, tid)
 
@@ -835,11 +1285,12 @@ class ClientThread(ClientRunner):
     def __init__(self, addrs, client, cache,
                  storage_key='1', read_only=False, timeout=30,
                  disconnect_poll=1, ssl=None, ssl_server_hostname=None,
-                 credentials=None):
+                 credentials=None, connections=1, replicas=()):
         self.set_options(addrs, client, cache, storage_key, read_only,
                          timeout, disconnect_poll,
                          ssl=ssl, ssl_server_hostname=ssl_server_hostname,
-                         credentials=credentials)
+                         credentials=credentials, connections=connections,
+                         replicas=replicas)
         self.thread = threading.Thread(
             target=self.run,
             name="%s zeo client networking thread" % client.__name__,
@@ -887,6 +1338,68 @@ class ClientThread(ClientRunner):
             if self.exception:
                 raise self.exception
 
+class ResultFuture(object):
+    """Future for results waited for in other threads
+
+    This is a cheaper stand-in for concurrent.futures.Future, which
+    makes a condition variable for each future, and a lock for each
+    wait.  Here, waiters just acquire a lock that's released when the
+    future is done.  Only the event-loop thread may complete the future.
+    """
+
+    _done = _cancelled = False
+    _result = _exception = None
+
+    def __init__(self):
+        self._lock = lock = threading.Lock()
+        lock.acquire()
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _set(self, name, value):
+        if not self._done:
+            setattr(self, name, value)
+            self._done = True
+            self._lock.release()
+            return True
+        return False
+
+    def set_result(self, result):
+        self._set('_result', result)
+
+    def set_exception(self, exc):
+        self._set('_exception', exc)
+
+    def cancel(self):
+        return self._set('_cancelled', True)
+
+    def _wait(self, timeout):
+        if not self._done:
+            lock = self._lock
+            if not lock.acquire(True, -1 if timeout is None else timeout):
+                raise concurrent.futures.TimeoutError()
+            lock.release() # Let any other waiters through
+        if self._cancelled:
+            raise concurrent.futures.CancelledError()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+if not PY3:
+    # Python 2 locks can't be acquired with a timeout
+    ResultFuture = concurrent.futures.Future
+
 class Fut(object):
     """Lightweight future that calls it's callback immediately rather than soon
     """
@@ -42,6 +42,7 @@ class ServerProtocol(base.Protocol):
         if not self.closed:
             self.closed = True
             if self.transport is not None:
+                self._flush()
                 self.transport.close()
 
     connected = None # for tests
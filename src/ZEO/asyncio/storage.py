@@ -0,0 +1,288 @@
+"""ZEO client storage for applications with their own asyncio event loops
+
+ClientStorage runs its networking in a thread of its own, and its
+methods block the calling thread until results arrive.  An asyncio
+application would have to call it through a thread pool.
+
+AsyncClientStorage runs its networking in the application's event
+loop.  Its methods must be called from that loop, and those that
+communicate with the server return asyncio futures, which can be
+awaited (or yielded from in coroutines) rather than blocking.
+"""
+import logging
+
+from ZODB import POSException
+from ZODB.utils import maxtid
+
+from ..Exceptions import ClientDisconnected
+from ..TransactionBuffer import TransactionBuffer
+from ..cache import ClientCache
+from .client import Client, future_generator
+from .compat import asyncio
+
+logger = logging.getLogger(__name__)
+
+class AsyncClientStorage(object):
+    """ZEO client storage whose methods return asyncio futures
+
+    Loads, prefetches and new oids are as for ClientStorage.  The
+    commit methods follow the storage two-phase commit API:
+    tpc_begin, store, tpc_vote and tpc_finish or tpc_abort.  store
+    just sends data to the server and returns nothing.  The others
+    return futures.  One transaction may be committed at a time.
+    Conflicts the server doesn't resolve are reported as errors
+    rather than being resolved in the client.  Blobs aren't
+    supported.
+    """
+
+    def __init__(self, addr, storage='1', cache=None, cache_size=20 << 20,
+                 read_only=False, disconnect_poll=1, loop=None,
+                 ssl=None, ssl_server_hostname=None, credentials=None):
+        """Create a client storage
+
+        addr is a host and port tuple, a unix-domain socket path, or
+        a sequence of either.
+
+        cache is a ZEO.interfaces.IClientCache.  If omitted, an
+        in-memory cache of cache_size bytes is used.
+
+        loop is the event loop to run in, defaulting to the current
+        event loop.
+        """
+        if isinstance(addr, str) or (
+            isinstance(addr, tuple) and len(addr) == 2 and
+            isinstance(addr[1], int)):
+            addr = [addr]
+
+        self.loop = loop = loop or asyncio.get_event_loop()
+        if cache is None:
+            cache = ClientCache(None, cache_size)
+        self._cache = cache
+        self._db = None
+        self._info = {}
+        self._connection_generation = 0
+        self._transaction = self._tbuf = None
+
+        self._client = Client(
+            loop, addr, self, cache, storage, read_only, disconnect_poll,
+            ssl=ssl, ssl_server_hostname=ssl_server_hostname,
+            credentials=credentials)
+
+    def _future(self):
+        return asyncio.Future(loop=self.loop)
+
+    def _call(self, method, *args):
+        future = self._future()
+        self._client.call_threadsafe(future, True, method, args)
+        return future
+
+    def wait(self):
+        """Return a future that's done when the storage is connected
+        """
+        future = self._future()
+
+        # The client's connected future is completed in our loop, so
+        # its callbacks are too, and we needn't use wrap_future.
+        def connected(f):
+            if not future.done():
+                exc = f.exception()
+                if exc is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(exc)
+
+        self._client.connected.add_done_callback(connected)
+        return future
+
+    def is_connected(self):
+        return bool(self._client.ready)
+
+    def is_read_only(self):
+        return self._client.is_read_only()
+
+    def registerDB(self, db):
+        """Register an object to be told about invalidations
+
+        Its invalidate method is called with transaction ids and
+        the oids they modified, and its invalidateCache method is
+        called if the cache can't be brought up to date on connect.
+        """
+        self._db = db
+
+    def close(self):
+        self._client.close()
+
+    def last_transaction(self):
+        return self._cache.getLastTid()
+
+    def load_before(self, oid, tid=maxtid):
+        """Load the data for oid written before tid
+
+        The future's result is a data, start-tid, end-tid tuple, or
+        None if there was no data before tid.
+        """
+        future = self._future()
+        self._client.load_before_threadsafe(future, True, oid, tid)
+        return future
+
+    def prefetch(self, oids, tid=maxtid):
+        """Load data into the cache, without waiting for it
+
+        The future is done when the requests have been sent.
+        """
+        future = self._future()
+        self._client.prefetch(future, True, oids, tid)
+        return future
+
+    def new_oids(self):
+        """Get a sequence of new object ids from the server
+        """
+        return self._call('new_oids')
+
+    # Two-phase commit
+
+    def _check_trans(self, txn, meth):
+        if txn is not self._transaction:
+            raise POSException.StorageTransactionError(
+                "Transaction not committing", meth, txn)
+
+        if self._tbuf.connection_generation != self._connection_generation:
+            # We were disconnected, so this one is poisoned
+            raise ClientDisconnected(meth, 'on a disconnected transaction')
+
+        return self._tbuf
+
+    def tpc_begin(self, txn, tid=None, status=' '):
+        if self._transaction is not None:
+            raise POSException.StorageTransactionError(
+                "Another transaction is committing")
+        if self._client.is_read_only():
+            raise POSException.ReadOnlyError()
+
+        self._transaction = txn
+        self._tbuf = TransactionBuffer(self._connection_generation)
+        future = self._future()
+        future.add_done_callback(self._begun)
+        self._client.call_async_threadsafe(
+            future, True, 'tpc_begin',
+            (id(txn), txn.user, txn.description, txn.extension, tid, status))
+        return future
+
+    def _begun(self, future):
+        if future.exception() is not None:
+            self._tpc_end()
+
+    def store(self, oid, serial, data, txn):
+        tbuf = self._check_trans(txn, 'store')
+        if not self._client.ready:
+            raise ClientDisconnected('store')
+        self._client.protocol.call_async('storea', (oid, serial, data, id(txn)))
+        tbuf.store(oid, data)
+
+    def tpc_vote(self, txn):
+        """Vote on a transaction
+
+        The future's result is a list of the oids of objects whose
+        conflicts the server resolved, or None.
+        """
+        future = self._future()
+        self._vote(future, txn)
+        return future
+
+    @future_generator
+    def _vote(self, future, txn):
+        try:
+            tbuf = self._check_trans(txn, 'tpc_vote')
+            for oid in (yield self._call('vote', id(txn))) or ():
+                if isinstance(oid, dict):
+                    # The server was configured to leave conflict
+                    # resolution to clients.
+                    raise POSException.ConflictError(
+                        oid=oid['oid'], serials=oid['serials'])
+                tbuf.server_resolve(oid)
+            if tbuf.exception:
+                raise tbuf.exception
+        except Exception as exc:
+            oid = getattr(exc, 'oid', None)
+            if oid is not None:
+                # As in ClientStorage, assume the cached data are bad
+                self._cache.invalidate(oid, None)
+            future.set_exception(exc)
+        else:
+            future.set_result(list(tbuf.server_resolved) or None)
+
+    def tpc_finish(self, txn, f=lambda tid: None):
+        """Finish a transaction
+
+        The future's result is the id of the committed transaction.
+        f is called with it before the future is done.
+        """
+        future = self._future()
+        try:
+            tbuf = self._check_trans(txn, 'tpc_finish')
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.add_done_callback(lambda _: self._tpc_end())
+            self._client.tpc_finish_threadsafe(future, True, id(txn), tbuf, f)
+        return future
+
+    def tpc_abort(self, txn):
+        future = self._future()
+        if txn is not self._transaction:
+            future.set_result(None)
+            return future
+
+        def aborted(called):
+            self._tpc_end()
+            exc = called.exception()
+            if isinstance(exc, ClientDisconnected):
+                logger.debug("ClientDisconnected in tpc_abort() ignored")
+                exc = None
+            if exc is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exc)
+
+        # Don't wait for a connection.  The server aborts the
+        # transaction if we disconnect.
+        called = self._future()
+        called.add_done_callback(aborted)
+        self._client.call_threadsafe(called, False, 'tpc_abort', (id(txn),))
+        return future
+
+    def _tpc_end(self):
+        if self._tbuf is not None:
+            self._tbuf.close()
+        self._transaction = self._tbuf = None
+
+    # Methods called by the client (networking) object
+
+    def notify_connected(self, conn, info):
+        self._connection_generation += 1
+        self._info.update(info)
+        logger.info("Connected to %s", conn.get_peername())
+
+    def notify_disconnected(self):
+        logger.info("Disconnected from storage")
+
+    def info(self, dict):
+        self._info.update(dict)
+
+    def serialnos(self, args):
+        # ZEO 4 servers report store results
+        if self._tbuf is not None:
+            self._tbuf.serialnos(args)
+
+    def invalidateCache(self):
+        if self._db is not None:
+            self._db.invalidateCache()
+
+    def invalidateTransaction(self, tid, oids):
+        if self._db is not None:
+            self._db.invalidate(tid, oids)
+
+    def receiveBlobStart(self, *args):
+        pass # We don't load blobs
+
+    receiveBlobChunk = receiveBlobStop = receiveBlobStart
@@ -8,19 +8,26 @@ else:
 from zope.testing import setupstack
 from concurrent.futures import Future
 import mock
-from ZODB.POSException import ReadOnlyError
+from ZODB.Connection import TransactionMetaData
+from ZODB.POSException import ConflictError, ReadOnlyError
 from ZODB.utils import maxtid
 
 import collections
+import concurrent.futures
 import logging
+import random
 import struct
+import threading
 import unittest
 
+from ..cache import ClientCache
 from ..Exceptions import ClientDisconnected, ProtocolError
 
-from .testing import Loop
-from .client import ClientRunner, Fallback
+from .base import Protocol
+from .testing import Loop, Transport
+from .client import ClientRunner, Fallback, PrefetchedReferences, ResultFuture
 from .server import new_connection, best_protocol_version
+from .storage import AsyncClientStorage
 from .marshal import encoder, decoder
 
 class Base(object):
@@ -84,6 +91,7 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
               addrs=(('127.0.0.1', 8200), ), loop_addrs=None,
               read_only=False,
               finish_start=False,
+              info=None,
               ):
         # To create a client, we need to specify an address, a client
         # object and a cache.
@@ -108,7 +116,7 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
             self.respond(2, 'a'*8)
             self.pop(4)
             self.assertEqual(self.pop(), (3, False, 'get_info', ()))
-            self.respond(3, dict(length=42))
+            self.respond(3, info or dict(length=42))
 
         return (wrapper, cache, self.loop, self.client, protocol, transport)
 
@@ -689,6 +697,473 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
         protocol.connection_lost(None)
         self.assertTrue(handle.cancelled)
 
+    def test_warmup(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        del loop.later[:] # heartbeat
+        cache.store(b'2'*8, b'a'*8, None, b'2 data')
+        oids = [str(i).encode() * 8 for i in range(1, 6)]
+
+        # Objects are prefetched a batch at a time, skipping ones that
+        # are already cached:
+        client.warmup(oids, 2, .5)
+        self.assertEqual(self.pop(), ((b'1'*8, maxtid), False,
+                                      'loadBefore', (b'1'*8, maxtid)))
+        delay, func, args, handle = loop.later.pop()
+        self.assertEqual(delay, .5)
+        func()
+        self.assertEqual(self.pop(), [
+            ((oid, maxtid), False, 'loadBefore', (oid, maxtid))
+            for oid in (b'3'*8, b'4'*8)])
+        self.respond((b'3'*8, maxtid), (b'3 data', b'a'*8, None))
+        self.assertEqual(cache.load(b'3'*8), (b'3 data', b'a'*8))
+
+        # Starting another warm-up stops the first.
+        delay, func, args, handle = loop.later.pop()
+        client.warmup([b'6'*8], 2, .5)
+        self.pop()
+        func()
+        self.assertFalse(transport.data or loop.later)
+
+        # So does disconnecting.
+        client.warmup(oids, 1, .5)
+        self.pop()
+        protocol.connection_lost(None)
+        delay, func, args, handle = loop.later.pop(0)
+        func()
+        self.assertFalse(transport.data)
+
+    def test_invalidation_read_with_load_reply(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        loaded = self.load_before(b'1'*8, maxtid)
+        self.pop()
+
+        # A load reply and an invalidation of the loaded object can
+        # be read together.  The future's callbacks are called soon,
+        # after the invalidation has been handled, so the data have
+        # to be cached before then, or they'd be cached as current.
+        soon = []
+        loop.call_soon = lambda func, *args: soon.append((func, args))
+        protocol.data_received(
+            sized(self.encode((b'1'*8, maxtid), False, '.reply',
+                              (b'data', b'a'*8, None))) +
+            sized(self.encode(0, True, 'invalidateTransaction',
+                              (b'b'*8, self.seq_type([b'1'*8])))))
+        del loop.call_soon
+        for func, args in soon:
+            func(*args)
+
+        self.assertEqual(loaded.result(), (b'data', b'a'*8, None))
+        self.assertEqual(cache.load(b'1'*8), None)
+        self.assertEqual(self.load_before(b'1'*8, b'b'*8).result(),
+                         (b'data', b'a'*8, b'b'*8))
+        self.assertFalse(transport.data)
+
+    def test_cache_errors_storing_loaded_data(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        cache.store(b'1'*8, b'a'*8, None, b'data')
+        loaded = self.load_before(b'1'*8, b'a'*8)
+        self.pop()
+
+        # If the loaded data can't be cached, the load is still
+        # answered, and the cache forgets what it had for the object.
+        def store(*args):
+            raise ValueError("already have current data for oid")
+        cache.store = store
+        with mock.patch('ZEO.asyncio.client.logger') as logger:
+            self.respond((b'1'*8, b'a'*8), (b'data0', b'^'*8, None))
+        self.assertEqual(loaded.result(), (b'data0', b'^'*8, None))
+        self.assertEqual(cache.load(b'1'*8), None)
+        self.assertTrue(logger.exception.called)
+
+    def test_tpc_finish_with_repeated_stores(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        client.cache = cache = ClientCache()
+        cache.store(b'1'*8, b'a'*8, None, b'data')
+
+        # An object can be stored more than once in a transaction.
+        # The data stored last are what's committed and cached.
+        committed = self.tpc_finish(
+            b'd'*8,
+            [(b'1'*8, b'first', False),
+             (b'2'*8, b'first 2', False),
+             (b'1'*8, b'second', False),
+             ],
+            lambda tid: None)
+        msgid, async, name, args = self.pop()
+        self.assertEqual((name, args), ('tpc_finish', (b'd'*8,)))
+        self.respond(msgid, b'e'*8)
+        self.assertEqual(committed.result(), b'e'*8)
+        self.assertEqual(cache.load(b'1'*8), (b'second', b'e'*8))
+        self.assertEqual(cache.load(b'2'*8), (b'first 2', b'e'*8))
+        self.assertEqual(cache.loadBefore(b'1'*8, b'e'*8),
+                         (b'data', b'a'*8, b'e'*8))
+
+    def test_caches_without_invalidate_many(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+
+        class OldCache(object):
+            # An IClientCache written before invalidate_many was added.
+            def __init__(self, cache):
+                self.cache = cache
+            def __getattr__(self, name):
+                if name == 'invalidate_many':
+                    raise AttributeError(name)
+                return getattr(self.cache, name)
+
+        client.cache = OldCache(cache)
+        cache.store(b'1'*8, b'a'*8, None, b'data')
+        cache.store(b'2'*8, b'a'*8, None, b'data 2')
+        protocol.data_received(
+            sized(self.encode(0, True, 'invalidateTransaction',
+                              (b'b'*8, self.seq_type([b'1'*8])))))
+        self.assertEqual(cache.load(b'1'*8), None)
+        self.assertEqual(cache.loadBefore(b'1'*8, b'b'*8),
+                         (b'data', b'a'*8, b'b'*8))
+
+        committed = self.tpc_finish(
+            b'd'*8, [(b'2'*8, b'committed 2', False)], lambda tid: None)
+        msgid, async, name, args = self.pop()
+        self.respond(msgid, b'e'*8)
+        self.assertEqual(committed.result(), b'e'*8)
+        self.assertEqual(cache.load(b'2'*8), (b'committed 2', b'e'*8))
+        self.assertEqual(cache.loadBefore(b'2'*8, b'e'*8),
+                         (b'data 2', b'a'*8, b'e'*8))
+
+    def test_prefetch_with_load_before_many(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True,
+            info=dict(length=42, supports_load_before_many=True))
+        cache.store(b'2'*8, b'a'*8, None, b'2 data')
+        loaded = self.load_before(b'3'*8, maxtid)
+        self.pop()
+
+        # Objects are loaded with a single message, skipping ones that
+        # are cached or already being loaded:
+        self.prefetch([b'1'*8, b'2'*8, b'3'*8, b'4'*8], maxtid)
+        self.assertEqual(self.pop(), (0, True, 'loadBeforeMany', (
+            self.seq_type([(b'1'*8, maxtid), (b'4'*8, maxtid)]),)))
+
+        # The server replies for each object separately, as for
+        # loadBefore:
+        self.respond((b'4'*8, maxtid), (b'4 data', b'a'*8, None))
+        self.respond((b'3'*8, maxtid), (b'3 data', b'a'*8, None))
+        self.respond((b'1'*8, maxtid), (b'1 data', b'a'*8, None))
+        for oid in (b'1'*8, b'3'*8, b'4'*8):
+            self.assertEqual(cache.load(oid), (oid[:1] + b' data', b'a'*8))
+        self.assertEqual(loaded.result(), (b'3 data', b'a'*8, None))
+        self.assertFalse(protocol.futures)
+
+        # Single objects are loaded with loadBefore:
+        self.prefetch([b'5'*8], maxtid)
+        self.assertEqual(self.pop(), ((b'5'*8, maxtid), False,
+                                      'loadBefore', (b'5'*8, maxtid)))
+
+    def test_reference_prefetch(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True,
+            info=dict(length=42, supports_load_before_many=True))
+        data = referencing(b'2'*8, b'3'*8, b'4'*8)
+        prefetched = PrefetchedReferences()
+        client.prefetch_references(2, 3 * len(data), prefetched)
+
+        # When an object is loaded, the objects it references that
+        # aren't cached are prefetched:
+        cache.store(b'2'*8, b'a'*8, None, b'2 data')
+        loaded = self.load_before(b'1'*8, maxtid)
+        self.pop()
+        self.respond((b'1'*8, maxtid), (data, b'a'*8, None))
+        self.assertEqual(loaded.result(), (data, b'a'*8, None))
+        message_id, async_, method, (oid_tids,) = self.pop()
+        self.assertEqual((async_, method), (True, 'loadBeforeMany'))
+        self.assertEqual(sorted(oid_tids),
+                         [(b'3'*8, maxtid), (b'4'*8, maxtid)])
+
+        # And so on, to the given depth:
+        self.respond((b'3'*8, maxtid), (referencing(b'5'*8), b'a'*8, None))
+        self.assertEqual(self.pop(), ((b'5'*8, maxtid), False,
+                                      'loadBefore', (b'5'*8, maxtid)))
+        self.respond((b'4'*8, maxtid), (referencing(), b'a'*8, None))
+        self.respond((b'5'*8, maxtid), (referencing(b'6'*8), b'a'*8, None))
+        self.assertFalse(transport.data)
+        self.assertEqual(cache.load(b'5'*8), (referencing(b'6'*8), b'a'*8))
+
+        # We keep track of whether prefetched objects are used:
+        prefetched.used(b'3'*8)
+        prefetched.used(b'3'*8)
+        self.send('invalidateTransaction', b'b'*8, self.seq_type([b'4'*8]))
+        self.assertEqual(prefetched.stats(),
+                         dict(prefetched=3, hits=1, wasted=1, pending=1))
+
+        # Prefetching stops when the budget is spent. Objects are
+        # assumed to be the size of the objects referencing them:
+        data = referencing(b'8'*8, b'9'*8)
+        client.prefetch_references(1, len(data) * 3 // 2, prefetched)
+        loaded = self.load_before(b'7'*8, maxtid)
+        self.pop()
+        self.respond((b'7'*8, maxtid), (data, b'a'*8, None))
+        self.assertEqual(self.pop()[2], 'loadBefore')
+        self.assertFalse(transport.data)
+
+    def test_secondary_connections(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        cache.setLastTid(b'a'*8)
+
+        # With more than one connection, we make secondary connections
+        # once we're connected. They register read-only:
+        client.connections = 2
+        client.start_secondaries()
+        secondary, secondary_transport = loop.protocol, loop.transport
+        secondary.data_received(sized(self.enc + b'3101'))
+        self.assertEqual(self.pop(2, False), self.enc + b'3101')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', True)))
+        self.respond(1, None)
+        self.assertEqual(client.secondaries, [secondary])
+        self.assertFalse(secondary_transport.data)
+
+        # Invalidations on secondary connections only tell us how up
+        # to date their server is:
+        self.send('invalidateTransaction', b'b'*8, [b'1'*8], called=False)
+        self.assertEqual(secondary.client.last_tid, b'b'*8)
+        loop.protocol, loop.transport = protocol, transport
+
+        # Loads alternate between the connections:
+        def load(oid, via):
+            loop.protocol, loop.transport = via, via.transport
+            loaded = self.load_before(oid, maxtid)
+            self.assertEqual(self.pop(), ((oid, maxtid), False,
+                                          'loadBefore', (oid, maxtid)))
+            loop.protocol, loop.transport = protocol, transport
+            return loaded
+
+        loaded = load(b'1'*8, secondary)
+        secondary.data_received(sized(self.encode(
+            (b'1'*8, maxtid), False, '.reply', (b'1 data', b'a'*8, None))))
+        self.assertEqual(loaded.result(), (b'1 data', b'a'*8, None))
+        self.assertEqual(cache.load(b'1'*8), (b'1 data', b'a'*8))
+        loaded = load(b'2'*8, protocol)
+        self.respond((b'2'*8, maxtid), (b'2 data', b'a'*8, None))
+        self.assertEqual(loaded.result(), (b'2 data', b'a'*8, None))
+
+        # If an object is invalidated while it's being loaded from a
+        # secondary connection, it's loaded again from the primary:
+        loaded = load(b'3'*8, secondary)
+        self.send('invalidateTransaction', b'b'*8, self.seq_type([b'3'*8]))
+        secondary.data_received(sized(self.encode(
+            (b'3'*8, maxtid), False, '.reply', (b'3 data', b'a'*8, None))))
+        self.assertFalse(loaded.done())
+        self.assertEqual(self.pop(), ((b'3'*8, maxtid), False,
+                                      'loadBefore', (b'3'*8, maxtid)))
+        self.respond((b'3'*8, maxtid), (b'3 data', b'b'*8, None))
+        self.assertEqual(loaded.result(), (b'3 data', b'b'*8, None))
+        self.assertEqual(cache.load(b'3'*8), (b'3 data', b'b'*8))
+        self.assertEqual(client.secondary_loads, {})
+        self.assertEqual(client.secondary_invalidated, {})
+
+        # Current data newer than the last invalidation isn't cached:
+        load(b'4'*8, protocol).cancel()
+        loaded = load(b'5'*8, secondary)
+        secondary.data_received(sized(self.encode(
+            (b'5'*8, maxtid), False, '.reply', (b'5 data', b'c'*8, None))))
+        self.assertEqual(loaded.result(), (b'5 data', b'c'*8, None))
+        self.assertEqual(cache.load(b'5'*8), None)
+
+        # Secondary connections that are lost are replaced:
+        del loop.later[:]
+        secondary.connection_lost(None)
+        self.assertEqual(client.secondaries, [])
+        self.assertEqual(client._load_protocol(b'a'*8), protocol)
+        delay, func, args, handle = loop.later.pop()
+        func()
+        self.assertEqual(len(client.secondary_protocols), 1)
+        self.assertFalse(client.secondary_protocols[0] is secondary)
+
+        # They're closed when the primary connection is lost:
+        secondary = client.secondary_protocols[0]
+        protocol.connection_lost(None)
+        self.assertTrue(secondary.closed)
+        self.assertEqual(client.secondary_protocols, [])
+
+    def test_replicas(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        cache.setLastTid(b'b'*8)
+
+        # We connect to replicas once we're connected:
+        replica_addr = '127.0.0.1', 8201
+        client.replicas = [replica_addr]
+        client.start_secondaries()
+        loop.connect_connecting(replica_addr)
+        replica = loop.protocol
+        replica.data_received(sized(self.enc + b'3101'))
+        self.assertEqual(self.pop(2, False), self.enc + b'3101')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', True)))
+        self.respond(1, b'a'*8)
+        loop.protocol, loop.transport = protocol, transport
+
+        def load(method, oid, tid, via):
+            if method == 'loadBefore':
+                loaded = self.load_before(oid, tid)
+                message_id = oid, tid
+            else:
+                loaded = self.call_load(tid, method, oid, tid)
+                message_id = via.message_id
+            self.assertEqual(self.unsized(via.transport.pop(), True),
+                             (message_id, False, method, (oid, tid)))
+            return loaded
+
+        # The replica hasn't committed the last transaction we know
+        # about, so it isn't used for current data:
+        load('loadBefore', b'1'*8, maxtid, protocol)
+        load('loadSerial', b'1'*8, b'b'*8, protocol)
+        load('sendBlob', b'1'*8, b'b'*8, protocol)
+
+        # It's used for older data:
+        load('loadBefore', b'2'*8, b'a'*8, replica)
+        load('loadSerial', b'2'*8, b'a'*8, replica)
+        load('sendBlob', b'2'*8, b'a'*8, replica)
+
+        # Blobs received from replicas are passed on:
+        loop.protocol = replica
+        self.send('receiveBlobStart', b'2'*8, b'a'*8)
+        loop.protocol = protocol
+
+        # Once the replica has caught up, all loads are made from it:
+        replica.data_received(sized(self.encode(
+            0, True, 'invalidateTransaction', (b'b'*8, [b'3'*8]))))
+        self.assertFalse(wrapper.invalidateTransaction.called)
+        load('loadBefore', b'3'*8, maxtid, replica)
+        load('loadBefore', b'4'*8, maxtid, replica)
+        load('loadSerial', b'3'*8, b'b'*8, replica)
+
+    def test_compaction(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        del loop.later[:] # heartbeat
+        compactions = []
+        cache.compact = lambda : compactions.append(1)
+
+        client.start_compaction(30)
+        client.start_compaction(30) # Only one compaction loop is started
+        delay, func, args, handle = loop.later.pop()
+        self.assertEqual((delay, loop.later, compactions), (30, [], []))
+        func()
+        self.assertEqual(len(compactions), 1)
+        delay, func, args, handle = loop.later.pop()
+        self.assertEqual(delay, 30)
+
+        # Errors are logged, and don't stop compaction:
+        def compact():
+            raise ValueError
+        cache.compact = compact
+        with mock.patch('ZEO.asyncio.client.logger.exception') as exception:
+            func()
+        exception.assert_called_with("Compacting the cache failed")
+        delay, func, args, handle = loop.later.pop()
+
+        # Compaction stops when the client is closed:
+        client.close()
+        func()
+        self.assertFalse(loop.later)
+
+    def test_calls_from_other_threads_share_wakeups(self):
+        # Calls submitted from other threads are queued, and the loop
+        # is woken once to run all of the calls queued before it
+        # gets to them.
+        addrs = ('127.0.0.1', 8200),
+        loop = Loop(addrs)
+        wakeups = []
+        loop.call_soon_threadsafe = (
+            lambda func, *args: wakeups.append((func, args)))
+        self.set_options(addrs, mock.Mock(), MemoryCache(), 'TEST', False)
+        self.setup_delegation(loop)
+
+        called = []
+        def fail(i):
+            raise ValueError(i)
+        self.submit(called.append, 1)
+        self.submit(fail, 2)
+        self.submit(called.append, 3)
+        self.assertEqual(len(wakeups), 1)
+        self.assertEqual(called, [])
+
+        # Errors are logged, and don't keep other calls from running:
+        with mock.patch("ZEO.asyncio.client.logger.exception") as exception:
+            func, args = wakeups.pop()
+            func(*args)
+        self.assertEqual(called, [1, 3])
+        self.assertEqual(exception.call_count, 1)
+
+        self.submit(called.append, 4)
+        self.assertEqual(len(wakeups), 1)
+        func, args = wakeups.pop()
+        func(*args)
+        self.assertEqual(called, [1, 3, 4])
+
+    def test_submit_after_loop_closed(self):
+        # If the loop can't be woken because it's closed, no calls are
+        # left queued, the error is raised to the caller, and callers
+        # waiting for calls other threads queued meanwhile get
+        # ClientDisconnected.
+        addrs = ('127.0.0.1', 8200),
+        loop = Loop(addrs)
+        wakeups = []
+        queued = []
+        def call_soon_threadsafe(func, *args):
+            if loop.closed:
+                # Another thread queues a call before we fail:
+                queued.append(ResultFuture())
+                self.submit(called.append, queued[-1])
+                raise RuntimeError('Event loop is closed')
+            wakeups.append((func, args))
+        loop.call_soon_threadsafe = call_soon_threadsafe
+        self.set_options(addrs, mock.Mock(), MemoryCache(), 'TEST', False)
+        self.setup_delegation(loop)
+
+        called = []
+        loop.close()
+        result = ResultFuture()
+        with self.assertRaises(RuntimeError):
+            self.submit(called.append, result)
+        for future in [result] + queued:
+            self.assertTrue(future.done())
+            self.assertTrue(
+                isinstance(future.exception(), ClientDisconnected))
+
+        # Later calls try to wake the loop again, rather than being
+        # queued behind the failed wakeup:
+        with self.assertRaises(RuntimeError):
+            self.submit(called.append, 2)
+        self.assertEqual((len(queued), wakeups), (2, []))
+
+        loop.closed = False
+        self.submit(called.append, 3)
+        self.assertEqual(len(wakeups), 1)
+        func, args = wakeups.pop()
+        func(*args)
+        self.assertEqual(called, [3])
+
+class Reference(object):
+
+    def __init__(self, oid):
+        self.oid = oid
+
+def referencing(*oids):
+    # Return a database record for an object referencing oids
+    from ZODB._compat import BytesIO, PersistentPickler, _protocol
+    f = BytesIO()
+    pickler = PersistentPickler(
+        lambda ob: (ob.oid, None) if isinstance(ob, Reference) else None,
+        f, _protocol)
+    pickler.dump((None, None))
+    pickler.dump([Reference(oid) for oid in oids])
+    return f.getvalue()
+
 class MsgpackClientTests(ClientTests):
     enc = b'M'
     seq_type = tuple
@@ -740,6 +1215,10 @@ class MemoryCache(object):
                 if end is None:
                     revisions[-1] = start, tid, data
 
+    def invalidate_many(self, oids, tid):
+        for oid in oids:
+            self.invalidate(oid, tid)
+
     def getLastTid(self):
         return self.last_tid
 
@@ -853,6 +1332,308 @@ def response(*data):
 def sized(message):
     return struct.pack(">I", len(message)) + message
 
+class AsyncClientStorageTests(Base, setupstack.TestCase):
+
+    def setUp(self):
+        super(AsyncClientStorageTests, self).setUp()
+        addrs = ('127.0.0.1', 8200),
+        self.loop = Loop(addrs)
+        self.cache = MemoryCache()
+        self.storage = AsyncClientStorage(
+            addrs, 'TEST', cache=self.cache, loop=self.loop)
+        self.db = mock.Mock()
+        self.storage.registerDB(self.db)
+
+        connected = self.storage.wait()
+        self.assertFalse(connected.done())
+        self.loop.protocol.data_received(sized(self.enc + b'3101'))
+        self.assertEqual(self.pop(2, False), self.enc + b'3101')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, None)
+        self.assertEqual(self.pop(), (2, False, 'lastTransaction', ()))
+        self.respond(2, b'a'*8)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+        self.assertTrue(connected.done() and self.storage.is_connected())
+
+    def tearDown(self):
+        self.storage.close()
+        super(AsyncClientStorageTests, self).tearDown()
+
+    def respond(self, message_id, result):
+        self.loop.protocol.data_received(
+            sized(self.encode(message_id, False, '.reply', result)))
+
+    def test_loads(self):
+        storage = self.storage
+        oid = b'1'*8
+        loaded = storage.load_before(oid)
+        self.assertFalse(loaded.done())
+        self.assertEqual(self.pop(),
+                         ((oid, maxtid), False, 'loadBefore', (oid, maxtid)))
+        self.respond((oid, maxtid), (b'data', b'a'*8, None))
+        self.assertEqual(loaded.result(), (b'data', b'a'*8, None))
+
+        # The data were cached:
+        self.assertEqual(storage.load_before(oid).result(),
+                         (b'data', b'a'*8, None))
+        self.assertFalse(self.loop.transport.data)
+
+        # Prefetches just send requests:
+        prefetched = storage.prefetch([b'2'*8], b'b'*8)
+        self.assertTrue(prefetched.done())
+        self.assertEqual(self.pop()[2:],
+                         ('loadBefore', (b'2'*8, b'b'*8)))
+
+        oids = storage.new_oids()
+        self.assertEqual(self.pop(), (4, False, 'new_oids', ()))
+        self.respond(4, [b'3'*8, b'4'*8])
+        self.assertEqual(oids.result(), [b'3'*8, b'4'*8])
+
+        # Invalidations are passed on:
+        self.send('invalidateTransaction', b'b'*8, [oid], target=None)
+        self.db.invalidate.assert_called_with(b'b'*8, [oid])
+        self.assertEqual(storage.last_transaction(), b'b'*8)
+        self.assertEqual(self.cache.load(oid), None)
+
+    def test_commit(self):
+        storage = self.storage
+        oid = b'1'*8
+        txn = TransactionMetaData()
+        begun = storage.tpc_begin(txn)
+        self.assertTrue(begun.done() and begun.exception() is None)
+        self.assertEqual(
+            self.pop(),
+            (0, True, 'tpc_begin',
+             (id(txn), txn.user, txn.description, txn.extension, None, ' ')))
+        self.assertRaises(Exception, storage.tpc_begin, TransactionMetaData())
+
+        storage.store(oid, b'a'*8, b'new', txn)
+        self.assertEqual(self.pop(),
+                         (0, True, 'storea', (oid, b'a'*8, b'new', id(txn))))
+
+        voted = storage.tpc_vote(txn)
+        self.assertEqual(self.pop(), (4, False, 'vote', (id(txn), )))
+        self.assertFalse(voted.done())
+        self.respond(4, None)
+        self.assertEqual(voted.result(), None)
+
+        finished = storage.tpc_finish(txn)
+        self.assertEqual(self.pop(), (5, False, 'tpc_finish', (id(txn), )))
+        self.respond(5, b'b'*8)
+        self.assertEqual(finished.result(), b'b'*8)
+        self.assertEqual(self.cache.load(oid), (b'new', b'b'*8))
+        self.assertEqual(storage.last_transaction(), b'b'*8)
+
+        # Conflicts left to clients to resolve are errors:
+        txn = TransactionMetaData()
+        storage.tpc_begin(txn)
+        storage.store(oid, b'a'*8, b'newer', txn)
+        voted = storage.tpc_vote(txn)
+        self.pop()
+        self.respond(6, [dict(oid=oid, serials=(b'b'*8, b'a'*8),
+                              data=b'newer')])
+        self.assertRaises(ConflictError, voted.result)
+        self.assertEqual(self.cache.load(oid), None)
+
+        aborted = storage.tpc_abort(txn)
+        self.assertEqual(self.pop(), (7, False, 'tpc_abort', (id(txn), )))
+        self.respond(7, None)
+        self.assertTrue(aborted.done() and aborted.exception() is None)
+
+        # Now, we can begin another transaction:
+        txn = TransactionMetaData()
+        storage.tpc_begin(txn)
+        self.pop()
+
+        # If we're disconnected, the abort is done anyway
+        self.loop.protocol.connection_lost(None)
+        aborted = storage.tpc_abort(txn)
+        self.assertTrue(aborted.done() and aborted.exception() is None)
+        self.assertRaises(ClientDisconnected,
+                          storage.tpc_begin(TransactionMetaData()).result)
+
+class ResultFutureTests(unittest.TestCase):
+
+    # Threads wait on ResultFutures for results from the loop.
+
+    def test_result_future(self):
+        future = ResultFuture()
+        self.assertFalse(future.done())
+        self.assertRaises(concurrent.futures.TimeoutError,
+                          future.result, .01)
+
+        results = []
+        def wait():
+            results.append(future.result())
+        threads = [threading.Thread(target=wait) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        future.set_result(42)
+        future.set_result(43) # ignored
+        for thread in threads:
+            thread.join(9)
+        self.assertEqual(results, [42] * 3)
+        self.assertTrue(future.done())
+        self.assertEqual(future.exception(), None)
+
+        future = ResultFuture()
+        future.set_exception(ValueError(1))
+        self.assertRaises(ValueError, future.result)
+        self.assertEqual(future.exception().args, (1,))
+        self.assertFalse(future.cancel())
+
+        future = ResultFuture()
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(concurrent.futures.CancelledError, future.result)
+
+class FramingTests(unittest.TestCase):
+
+    # Sized messages can arrive in any chunks.  Check that both input
+    # paths reassemble them, with a small read buffer so messages are
+    # also split across buffer compactions and read into buffers of
+    # their own.
+
+    def setUp(self):
+        self.random = random.Random(42)
+        sizes = [0, 1, 3, 4, 5, 100, 1000, 3000, 5000, 20000] * 3
+        self.random.shuffle(sizes)
+        self.messages = [
+            bytes(bytearray(self.random.randrange(256) for i in range(size)))
+            for size in sizes]
+        self.data = b''.join(sized(message) for message in self.messages)
+
+    def protocol(self):
+        protocol = Protocol(None, None)
+        protocol.buffer_size = 1 << 13
+        received = []
+        protocol.message_received = received.append
+        return protocol, received
+
+    def chunks(self, maxsize):
+        data = self.data
+        pos = 0
+        while pos < len(data):
+            size = self.random.randint(1, maxsize)
+            yield data[pos:pos+size]
+            pos += size
+
+    def test_data_received(self):
+        for maxsize in 1, 7, 1000, 30000, len(self.data):
+            protocol, received = self.protocol()
+            for chunk in self.chunks(maxsize):
+                protocol.data_received(chunk)
+            self.assertEqual(received, self.messages)
+            self.assertEqual(protocol.input, [])
+
+    def test_buffer_updated(self):
+        for maxsize in 1, 7, 1000, 30000, len(self.data):
+            protocol, received = self.protocol()
+            data = self.data
+            pos = 0
+            while pos < len(data):
+                buffer = protocol.get_buffer(-1)
+                self.assertTrue(len(buffer) > 0)
+                size = min(len(buffer), len(data) - pos,
+                           self.random.randint(1, maxsize))
+                buffer[:size] = data[pos:pos+size]
+                protocol.buffer_updated(size)
+                pos += size
+            self.assertEqual([bytes(m) for m in received], self.messages)
+            self.assertEqual(protocol.start, protocol.end)
+            # Messages too large for the read buffer were read into
+            # buffers of their own:
+            self.assertEqual(
+                [m for m in received
+                 if len(m) > protocol.buffer_size
+                 and not isinstance(m, bytearray)],
+                [])
+            self.assertEqual(
+                [m for m in received
+                 if isinstance(m, bytearray)
+                 and len(m) <= protocol.buffer_size // 2],
+                [])
+
+    def test_errors_in_message_received(self):
+        protocol, received = self.protocol()
+        def message_received(message):
+            received.append(message)
+            if message == b'error':
+                raise ValueError(message)
+        protocol.message_received = message_received
+        with mock.patch("ZEO.asyncio.base.logger.exception") as exception:
+            data = sized(b'error') + sized(b'ok')
+            protocol.data_received(data + data[:6])
+            protocol.data_received(data[6:])
+            for byte in bytearray(data):
+                buffer = protocol.get_buffer(-1)
+                buffer[0] = byte
+                protocol.buffer_updated(1)
+        self.assertEqual(received, [b'error', b'ok'] * 3)
+        self.assertEqual(exception.call_count, 3)
+
+    def test_write_corking(self):
+        # Messages written in a loop iteration are written together,
+        # when the loop gets to it, in order with messages written
+        # while paused and with iterators of messages.
+        loop = Loop()
+        soon = []
+        loop.call_soon = lambda func, *args: soon.append((func, args))
+        protocol = Protocol(loop, None)
+        protocol.name = 'test'
+        transport = Transport(protocol)
+        transport.writelines = mock.Mock(side_effect=transport.writelines)
+        protocol.connection_made(transport)
+
+        for message in b'a', b'b', b'c':
+            protocol._write(message)
+        self.assertEqual(transport.data, [])
+        [(flush, args)] = soon
+        flush(*args)
+        transport.writelines.assert_called_once_with(
+            [struct.pack(">I", 1), b'a',
+             struct.pack(">I", 1), b'b',
+             struct.pack(">I", 1), b'c'])
+        del transport.data[:]
+
+        # Iterators are written as they're produced, after anything
+        # corked:
+        del soon[:]
+        protocol._write(b'd')
+        protocol._writeit(iter([b'e', b'f']))
+        self.assertEqual(transport.data, [struct.pack(">I", 1), b'd',
+                                          struct.pack(">I", 1), b'e',
+                                          struct.pack(">I", 1), b'f'])
+        [(flush, args)] = soon
+        flush(*args) # Nothing left to write
+        self.assertEqual(len(transport.data), 6)
+        del transport.data[:]
+
+        # Messages written while paused are queued and written in
+        # order when resumed:
+        transport.capacity = 1
+        del soon[:]
+        protocol._write(b'g')
+        protocol._writeit(iter([b'h', b'i']))
+        protocol._write(b'j')
+        self.assertEqual(transport.data, [struct.pack(">I", 1), b'g',
+                                          struct.pack(">I", 1), b'h'])
+        self.assertEqual(list(protocol.output)[1:], [b'j'])
+        transport.capacity = 1 << 64
+        transport.pop()
+        self.assertEqual(transport.data, [struct.pack(">I", 1), b'i',
+                                          struct.pack(">I", 1), b'j'])
+        self.assertEqual(len(protocol.output), 0)
+        del transport.data[:]
+
+        # Closing writes anything corked:
+        del soon[:]
+        protocol._write(b'k')
+        protocol.close()
+        self.assertEqual(transport.data, [struct.pack(">I", 1), b'k'])
+        self.assertTrue(transport.closed)
+
 class Logging(object):
 
     def __init__(self, level=logging.ERROR):
@@ -874,4 +1655,7 @@ def test_suite():
     suite.addTest(unittest.makeSuite(ServerTests))
     suite.addTest(unittest.makeSuite(MsgpackClientTests))
     suite.addTest(unittest.makeSuite(MsgpackServerTests))
+    suite.addTest(unittest.makeSuite(AsyncClientStorageTests))
+    suite.addTest(unittest.makeSuite(ResultFutureTests))
+    suite.addTest(unittest.makeSuite(FramingTests))
     return suite
@@ -22,20 +22,32 @@ it to map this richer API onto the simple key-based API of the lower-level
 FileCache.
 """
 from __future__ import print_function
-from struct import pack, unpack
+from collections import namedtuple, OrderedDict
+from struct import pack, unpack, unpack_from, Struct
 
+import array
+import bisect
 import BTrees.LLBTree
 import BTrees.LOBTree
+import contextlib
 import logging
+import mmap
 import os
 import tempfile
 import time
+import zlib
 
 import ZODB.fsIndex
 import zc.lockfile
-from ZODB.utils import p64, u64, z64, RLock
+from ZODB.utils import p64, u64, z64, maxtid, RLock
 import six
-from ._compat import PYPY
+from ._compat import PYPY, Unpickler, dump
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 logger = logging.getLogger("ZEO.cache")
 
@@ -114,12 +126,21 @@ max_block_size = (1<<31) - 1
 #     8 byte oid
 #     8 byte start_tid
 #     8 byte end_tid
-#     2 byte version length must be 0
+#     2 byte flags (this used to be the version length, which had to be 0)
 #     4 byte data size
 #     data
 #     8 byte redundant oid for error detection.
 allocated_record_overhead = 43
 
+# Record flags.  If record_compressed is set, the data is compressed
+# with zlib.
+record_compressed = 1
+record_flags = record_compressed
+
+# The allocated-block header, from the status byte through the data size.
+record_header_format = ">cI8s8s8sHI"
+record_header_size = 35
+
 # The cache's currentofs goes around the file, circularly, forever.
 # It's always the starting offset of some block.
 #
@@ -130,6 +151,25 @@ allocated_record_overhead = 43
 # to the end of the file that the new object can't fit in one
 # contiguous chunk, currentofs is reset to ZEC_HEADER_SIZE first.
 
+# When a persistent cache is closed cleanly, its in-memory index is
+# saved next to the cache file, in path + '.index', so that the next
+# open doesn't have to scan the whole file.  The snapshot records the
+# cache file's size, modification time, last tid and configured size.
+# It's only used if all of these still match, and it's removed as soon
+# as it's read, so a process that dies before closing the cache can't
+# leave a stale snapshot behind.
+index_snapshot_version = 2
+
+# Cache statistics, as returned by ClientCache.getStats.  The first five
+# fields were originally returned as a plain tuple and keep their order.
+CacheStats = namedtuple('CacheStats', [
+    'adds', 'added_bytes', 'evicts', 'evicted_bytes', 'accesses',
+    'l1_hits', 'l1_misses', 'rejects', 'added_logical_bytes',
+    'current_bytes', 'noncurrent_bytes', 'current_hits', 'noncurrent_hits',
+    'noncurrent_evicts', 'free_bytes', 'fragmented_bytes', 'compactions',
+    'compacted_bytes',
+    ])
+
 # Under PyPy, the available dict specializations perform significantly
 # better (faster) than the pure-Python BTree implementation. They may
 # use less memory too. And we don't require any of the special BTree features...
@@ -145,33 +185,109 @@ class ClientCache(object):
     # default of 20MB.  The default here is misleading, though, since
     # ClientStorage is the only user of ClientCache, and it always passes an
     # explicit size of its own choosing.
-    def __init__(self, path=None, size=200*1024**2, rearrange=.8):
+    def __init__(self, path=None, size=200*1024**2, rearrange=.8,
+                 use_mmap=False, l1_size=0, admission=None,
+                 compress=False, compress_threshold=256,
+                 noncurrent_size=None, compact_index=False,
+                 policy='circular'):
 
         # - `path`:  filepath for the cache file, or None (in which case
         #   a temp file will be created)
         self.path = path
 
+        # - `use_mmap`: map the cache file into memory once it's been
+        #   initialized, so loads can slice records out of the mapping
+        #   rather than seeking and reading.
+        self.use_mmap = use_mmap
+
         # - `maxsize`:  total size of the cache file
         #               We set to the minimum size of less than the minimum.
         size = max(size, ZEC_HEADER_SIZE)
         self.maxsize = size
 
         # rearrange: if we read a current record and it's more than
-        # rearrange*size from the end, then copy it forward to keep it
-        # from being evicted.
+        # rearrange*size from the end, then the eviction policy may
+        # copy it forward to keep it from being evicted.
         self.rearrange = rearrange * size
 
+        # - `policy`: the eviction policy, the name of one of
+        #   eviction_policies, or a factory that's called with the
+        #   cache size, like CircularPolicy, which decides which
+        #   current records are kept when the write position reaches
+        #   them.
+        if not callable(policy):
+            if policy not in eviction_policies:
+                raise ValueError(
+                    "unknown cache eviction policy %r" % (policy,))
+            policy = eviction_policies[policy]
+        self.policy = policy(size)
+
         # The number of records in the cache.
         self._len = 0
 
+        # - `l1_size`: the maximum number of bytes of object data to keep
+        #   in memory, in front of the cache file.  0 disables the
+        #   in-memory tier.
+        #
+        # The in-memory tier, {oid -> (data, tid)}, holds current records
+        # in least-recently-used order.  It only ever holds records that
+        # are also current in the file, so anything that removes a
+        # record from self.current has to call _l1_discard.
+        self.l1_size = l1_size
+        self._l1 = OrderedDict()
+        self._l1_bytes = 0
+
+        # - `admission`: an optional admission filter, like
+        #   TinyLFUAdmission, that's told about every access with
+        #   record(oid) and decides with admit(oid, size) whether
+        #   stored data is worth adding to the cache.
+        self.admission = admission
+
+        # - `compress`: compress the data of records with at least
+        #   `compress_threshold` bytes of data, if that makes them
+        #   smaller.  Compressed records are flagged, so a cache file
+        #   can be reopened with or without compression, but older
+        #   ZEO versions can't read them.
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+        # - `compact_index`: keep the indexes in sorted arrays, with
+        #   PackedIndex and PackedNoncurrentIndex, rather than in
+        #   BTrees (or dicts, on PyPy), which takes much less memory
+        #   for caches with lots of objects, at some cost in speed.
+        if compact_index:
+            # Offsets fit in 4 bytes, unless the file is huge.
+            typecode = 'I' if size < 1<<32 else _packed_typecode
+            self._current_index_type = lambda: PackedIndex(typecode)
+            self._noncurrent_index_type = (
+                lambda: PackedNoncurrentIndex(typecode))
+        else:
+            self._current_index_type = _current_index_type
+            self._noncurrent_index_type = _noncurrent_index_type
+
         # {oid -> pos}
-        self.current = _current_index_type()
+        self.current = self._current_index_type()
 
         # {oid -> {tid->pos}}
         # Note that caches in the wild seem to have very little non-current
         # data, so this would seem to have little impact on memory consumption.
         # I wonder if we even need to store non-current data in the cache.
-        self.noncurrent = _noncurrent_index_type()
+        self.noncurrent = self._noncurrent_index_type()
+
+        # - `noncurrent_size`: the maximum number of bytes of non-current
+        #   records to keep, or None for no limit other than the size of
+        #   the cache.
+        #
+        # If noncurrent_size is set, non-current records are also kept
+        # in least-recently-used order, {(oid, tid) -> record size}, so
+        # that the ones that haven't been used for longest can be freed
+        # when there are more than noncurrent_size bytes of them.
+        # Otherwise, _noncurrent_lru is None.
+        self.noncurrent_size = noncurrent_size
+        self._reset_noncurrent()
+
+        # The number of bytes of current records.
+        self._current_bytes = 0
 
         # tid for the most recent transaction we know about.  This is also
         # stored near the start of the file.
@@ -227,11 +343,16 @@ class ClientCache(object):
             self.f.write(magic+z64)
             self._initfile(ZEC_HEADER_SIZE)
 
+        self._map()
+
         # Statistics:  _n_adds, _n_added_bytes,
         #              _n_evicts, _n_evicted_bytes,
         #              _n_accesses
         self.clearStats()
 
+        # In case noncurrent_size is smaller than it used to be:
+        self._trim_noncurrent()
+
         self._setup_trace(path)
 
     # Backward compatibility. Client code used to have to use the fc
@@ -242,9 +363,30 @@ class ClientCache(object):
 
     def clear(self):
         with self._lock:
+            self._l1_clear()
+            self.policy.clear()
+            self._unmap()
             self.f.seek(ZEC_HEADER_SIZE)
             self.f.truncate()
             self._initfile(ZEC_HEADER_SIZE)
+            self._map()
+
+    # When use_mmap is set, self.f is replaced by a MappedFile wrapping
+    # the real file, so all the seek/read/write code below goes through
+    # the mapping and stays consistent with the fast paths in load and
+    # loadBefore, which slice self._mapped directly.  The file has to be
+    # unmapped while it's being resized.
+    _mapped = None
+
+    def _map(self):
+        if self.use_mmap and self._mapped is None:
+            self.f = MappedFile(self.f)
+            self._mapped = self.f.map
+
+    def _unmap(self):
+        if self._mapped is not None:
+            self.f = self.f.unmap()
+            self._mapped = None
 
     ##
     # Scan the current contents of the cache file, calling `install`
@@ -264,13 +406,19 @@ class ClientCache(object):
         if len(self.tid) != 8:
             raise ValueError("cache file too small -- no tid at start")
 
+        if self._load_index(fsize):
+            return
+
+        self._reset_noncurrent()
+        self._current_bytes = 0
+
         # Populate .filemap and .key2entry to reflect what's currently in the
         # file, and tell our parent about it too (via the `install` callback).
         # Remember the location of the largest free block.  That seems a
         # decent place to start currentofs.
 
-        self.current = _current_index_type()
-        self.noncurrent = _noncurrent_index_type()
+        self.current = self._current_index_type()
+        self.noncurrent = self._noncurrent_index_type()
         l = 0
         last = ofs = ZEC_HEADER_SIZE
         first_free_offset = 0
@@ -280,16 +428,18 @@ class ClientCache(object):
             seek(ofs)
             status = read(1)
             if status == b'a':
-                size, oid, start_tid, end_tid, lver = unpack(
+                size, oid, start_tid, end_tid, flags = unpack(
                     ">I8s8s8sH", read(30))
                 if ofs+size <= maxsize:
                     if end_tid == z64:
                         assert oid not in current, (ofs, f.tell())
                         current[oid] = ofs
+                        self._current_bytes += size
                     else:
                         assert start_tid < end_tid, (ofs, f.tell())
-                        self._set_noncurrent(oid, start_tid, ofs)
-                    assert lver == 0, "Versions aren't supported"
+                        self._set_noncurrent(oid, start_tid, ofs, size)
+                    assert not flags & ~record_flags, (
+                        "Versions aren't supported")
                     l += 1
             else:
                 # free block
@@ -359,33 +509,221 @@ class ClientCache(object):
         self.currentofs = first_free_offset or ZEC_HEADER_SIZE
         self._len = l
 
-    def _set_noncurrent(self, oid, tid, ofs):
+    def _index_path(self):
+        return self.path + '.index'
+
+    ##
+    # Install the index snapshot saved by a clean close, if there is
+    # one and it matches the cache file.  Return whether it was used.
+    def _load_index(self, fsize):
+        if not self.path or fsize != self.maxsize:
+            return False
+        index_path = self._index_path()
+        if not os.path.exists(index_path):
+            return False
+
+        try:
+            try:
+                with open(index_path, 'rb') as f:
+                    snapshot = Unpickler(f).load()
+            finally:
+                # Whatever happens, the snapshot is out of date as soon as
+                # we start writing to the cache file again.
+                os.remove(index_path)
+
+            stat = os.stat(self.path)
+            if (snapshot.get('version') != index_snapshot_version or
+                snapshot['maxsize'] != self.maxsize or
+                snapshot['fsize'] != stat.st_size or
+                snapshot['mtime'] != stat.st_mtime or
+                snapshot['tid'] != self.tid
+                ):
+                logger.info("ignoring stale cache index %r", index_path)
+                return False
+
+            oids = snapshot['oids']
+            offsets = snapshot['offsets']
+            noffsets = len(offsets) // 8
+            offsets = unpack(">%dQ" % noffsets, offsets)
+            current = self._current_index_type()
+            for i in range(noffsets):
+                current[oids[i*8:i*8+8]] = offsets[i]
+
+        except Exception:
+            logger.warning("couldn't read cache index %r", index_path,
+                           exc_info=True)
+            return False
+
+        self.current = current
+        self._current_bytes = snapshot['current_bytes']
+        self.noncurrent = self._noncurrent_index_type()
+        self._reset_noncurrent()
+        for oid, tid, ofs, size in snapshot['noncurrent']:
+            self._set_noncurrent(oid, tid, ofs, size)
+        self.currentofs = snapshot['currentofs']
+        self._len = snapshot['len']
+        logger.info("reusing cache index %r", index_path)
+        return True
+
+    ##
+    # Save the index for use by the next _load_index.  This must only
+    # be called after the cache file has been synced and closed.
+    def _save_index(self):
+        index_path = self._index_path()
+        tmp_path = index_path + '.tmp'
+        try:
+            current = list(six.iteritems(self.current))
+            stat = os.stat(self.path)
+            snapshot = dict(
+                version=index_snapshot_version,
+                maxsize=self.maxsize,
+                fsize=stat.st_size,
+                mtime=stat.st_mtime,
+                tid=self.tid,
+                currentofs=self.currentofs,
+                len=self._len,
+                oids=b''.join(oid for oid, ofs in current),
+                offsets=pack(">%dQ" % len(current),
+                             *[ofs for oid, ofs in current]),
+                current_bytes=self._current_bytes,
+                noncurrent=self._noncurrent_records(),
+                )
+            with open(tmp_path, 'wb') as f:
+                dump(snapshot, f, 2)
+                sync(f)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            os.rename(tmp_path, index_path)
+        except Exception:
+            logger.warning("couldn't save cache index %r", index_path,
+                           exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    ##
+    # Return [(oid, tid, ofs, size)] for the non-current records, least
+    # recently used first if that's tracked.  Otherwise, the record
+    # sizes are read from the (possibly closed) cache file.
+    def _noncurrent_records(self):
+        noncurrent = self.noncurrent
+        if self._noncurrent_lru is not None:
+            return [(oid, tid, noncurrent[u64(oid)][u64(tid)], size)
+                    for (oid, tid), size
+                    in six.iteritems(self._noncurrent_lru)]
+        records = []
+        if noncurrent:
+            with open(self.path, 'rb') as f:
+                for oid, noncurrent_for_oid in six.iteritems(noncurrent):
+                    for tid, ofs in six.iteritems(noncurrent_for_oid):
+                        f.seek(ofs + 1)
+                        size, = unpack(">I", f.read(4))
+                        records.append((p64(oid), p64(tid), ofs, size))
+        return records
+
+    def _reset_noncurrent(self):
+        self._noncurrent_lru = (
+            None if self.noncurrent_size is None else OrderedDict())
+        self._noncurrent_bytes = 0
+
+    def _set_noncurrent(self, oid, tid, ofs, size):
         noncurrent_for_oid = self.noncurrent.get(u64(oid))
         if noncurrent_for_oid is None:
-            noncurrent_for_oid = _noncurrent_bucket_type()
-            self.noncurrent[u64(oid)] = noncurrent_for_oid
+            self.noncurrent[u64(oid)] = _noncurrent_bucket_type()
+            noncurrent_for_oid = self.noncurrent[u64(oid)]
         noncurrent_for_oid[u64(tid)] = ofs
+        if self._noncurrent_lru is not None:
+            self._noncurrent_lru[oid, tid] = size
+        self._noncurrent_bytes += size
 
-    def _del_noncurrent(self, oid, tid):
+    def _del_noncurrent(self, oid, tid, size=None):
         try:
             noncurrent_for_oid = self.noncurrent[u64(oid)]
+            if size is None:
+                self.f.seek(noncurrent_for_oid[u64(tid)] + 1)
+                size, = unpack(">I", self.f.read(4))
             del noncurrent_for_oid[u64(tid)]
             if not noncurrent_for_oid:
                 del self.noncurrent[u64(oid)]
+            if self._noncurrent_lru is not None:
+                del self._noncurrent_lru[oid, tid]
+            self._noncurrent_bytes -= size
         except KeyError:
             logger.error("Couldn't find non-current %r", (oid, tid))
 
+    ##
+    # Free the least recently used non-current records until there
+    # are no more than noncurrent_size bytes of them.
+    def _trim_noncurrent(self):
+        if self.noncurrent_size is None:
+            return
+        lru = self._noncurrent_lru
+        while self._noncurrent_bytes > self.noncurrent_size:
+            oid, tid = next(iter(lru))
+            ofs = self.noncurrent[u64(oid)][u64(tid)]
+            size = lru[oid, tid]
+            self.f.seek(ofs)
+            self.f.write(b'f'+pack(">I", size))
+            self._del_noncurrent(oid, tid, size)
+            self._len -= 1
+            self._n_noncurrent_evicts += 1
+
 
     def clearStats(self):
         self._n_adds = self._n_added_bytes = 0
         self._n_evicts = self._n_evicted_bytes = 0
         self._n_accesses = 0
+        self._n_l1_hits = self._n_l1_misses = 0
+        self._n_rejects = 0
+        self._n_added_logical_bytes = 0
+        self._n_current_hits = self._n_noncurrent_hits = 0
+        self._n_noncurrent_evicts = 0
+        self._n_compactions = self._n_compacted_bytes = 0
 
+    ##
+    # Return statistics.  free_bytes is the amount of free space in
+    # the file, and fragmented_bytes is the part of it that isn't
+    # where the next record will be written, which can only be used
+    # after evicting the records around it.
     def getStats(self):
-        return (self._n_adds, self._n_added_bytes,
-                self._n_evicts, self._n_evicted_bytes,
-                self._n_accesses
-               )
+        with self._lock:
+            free_bytes = (self.maxsize - ZEC_HEADER_SIZE -
+                          self._current_bytes - self._noncurrent_bytes)
+            return CacheStats(self._n_adds, self._n_added_bytes,
+                              self._n_evicts, self._n_evicted_bytes,
+                              self._n_accesses,
+                              self._n_l1_hits, self._n_l1_misses,
+                              self._n_rejects, self._n_added_logical_bytes,
+                              self._current_bytes, self._noncurrent_bytes,
+                              self._n_current_hits, self._n_noncurrent_hits,
+                              self._n_noncurrent_evicts,
+                              free_bytes, free_bytes - self._free_run(),
+                              self._n_compactions, self._n_compacted_bytes,
+                              )
+
+    ##
+    # Add current data for oid to the in-memory tier, evicting least
+    # recently used records to stay within l1_size.
+    def _l1_add(self, oid, data, tid):
+        l1 = self._l1
+        old = l1.pop(oid, None)
+        if old is not None:
+            self._l1_bytes -= len(old[0])
+        size = len(data)
+        if size > self.l1_size:
+            return
+        l1[oid] = data, tid
+        self._l1_bytes += size
+        while self._l1_bytes > self.l1_size:
+            self._l1_bytes -= len(l1.popitem(False)[1][0])
+
+    def _l1_discard(self, oid):
+        old = self._l1.pop(oid, None)
+        if old is not None:
+            self._l1_bytes -= len(old[0])
+
+    def _l1_clear(self):
+        self._l1.clear()
+        self._l1_bytes = 0
 
     ##
     # The number of objects currently in the cache.
@@ -397,11 +735,16 @@ class ClientCache(object):
     # used after this.
     def close(self):
         self._unsetup_trace()
-        f = self.f
-        self.f = None
-        if f is not None:
-            sync(f)
-            f.close()
+        with self._lock:
+            self._l1_clear()
+            self._unmap()
+            f = self.f
+            self.f = None
+            if f is not None:
+                sync(f)
+                f.close()
+                if self.path:
+                    self._save_index()
 
         if hasattr(self,'_lock_file'):
             self._lock_file.close()
@@ -417,6 +760,9 @@ class ClientCache(object):
     # the file, and to update filemap, to account for all the space
     # freed (starting at currentofs when _makeroom returns, and
     # spanning the number of bytes retured by _makeroom).
+    #
+    # Current records that the eviction policy keeps are moved to
+    # currentofs, which is advanced past them, rather than evicted.
     def _makeroom(self, nbytes):
         assert 0 < nbytes <= self.maxsize - ZEC_HEADER_SIZE, (
             nbytes, self.maxsize)
@@ -426,17 +772,29 @@ class ClientCache(object):
         seek = self.f.seek
         read = self.f.read
         current = self.current
+        policy = self.policy
         while nbytes > 0:
             seek(ofs)
             status = read(1)
             if status == b'a':
                 size, oid, start_tid, end_tid = unpack(">I8s8s8s", read(28))
+                if end_tid == z64:
+                    # Records can only be kept if there's still room
+                    # for nbytes after them.
+                    if (ofs + size + nbytes <= self.maxsize and
+                        policy.keep(oid, size)):
+                        self._relocate(oid, ofs, size)
+                        ofs += size
+                        continue
+                    policy.evicted(oid, size)
                 self._n_evicts += 1
                 self._n_evicted_bytes += size
                 if end_tid == z64:
                     del current[oid]
+                    self._current_bytes -= size
+                    self._l1_discard(oid)
                 else:
-                    self._del_noncurrent(oid, start_tid)
+                    self._del_noncurrent(oid, start_tid, size)
                 self._len -= 1
             else:
                 if status == b'f':
@@ -448,6 +806,117 @@ class ClientCache(object):
             nbytes -= size
         return ofs - self.currentofs
 
+    ##
+    # Move the current record for oid, at ofs, to currentofs, and
+    # advance currentofs past it.  The space between them must be free.
+    def _relocate(self, oid, ofs, size):
+        start = self.currentofs
+        if ofs != start:
+            seek = self.f.seek
+            write = self.f.write
+            seek(ofs)
+            record = self.f.read(size)
+            # As in _store, the space is marked free while the record
+            # is being written.
+            seek(start)
+            write(b'f'+pack(">I", ofs + size - start))
+            write(record[5:])
+            free = ofs - start
+            if free > 4:
+                write(b'f'+pack(">I", free))
+            else:
+                write(str(free).encode())
+            seek(start)
+            write(record[:5])
+            self.current[oid] = start
+        self.currentofs = start + size
+
+    ##
+    # Return the size of the run of free blocks at currentofs.
+    def _free_run(self):
+        if self.f is None:
+            return 0
+        seek = self.f.seek
+        read = self.f.read
+        ofs = self.currentofs
+        while ofs < self.maxsize:
+            seek(ofs)
+            status = read(1)
+            if status == b'f':
+                ofs += unpack(">I", read(4))[0]
+            elif status in b'1234':
+                ofs += int(status)
+            else:
+                break
+        return ofs - self.currentofs
+
+    ##
+    # Move the live records in the (at least) nbytes following
+    # currentofs to the end of that region, so that its free space is
+    # in one block at currentofs, where it will be used by the next
+    # stores without evicting the records.  Otherwise, _makeroom evicts
+    # the records between free blocks to reclaim space that's already
+    # free.  The records keep their order, so they're evicted in the
+    # same order as they would have been.
+    #
+    # Return the number of bytes of records moved.
+    def compact(self, nbytes=1<<18):
+        with self._lock:
+            if self.f is None:
+                return 0
+            start = ofs = self.currentofs
+            seek = self.f.seek
+            read = self.f.read
+            records = []
+            gaps = free = 0
+            while ofs < self.maxsize and ofs - start < nbytes:
+                seek(ofs)
+                status = read(1)
+                if status == b'a':
+                    size, = unpack(">I", read(4))
+                    seek(ofs)
+                    records.append((ofs, read(size)))
+                else:
+                    if status == b'f':
+                        size, = unpack(">I", read(4))
+                    else:
+                        assert status in b'1234'
+                        size = int(status)
+                    free += size
+                    if records:
+                        gaps += size
+                ofs += size
+
+            if not gaps:
+                return 0
+
+            # If we're interrupted, the whole region is free:
+            write = self.f.write
+            seek(start)
+            write(b'f'+pack(">I", ofs - start))
+
+            current = self.current
+            for _, record in reversed(records):
+                ofs -= len(record)
+                seek(ofs)
+                write(record)
+                oid, start_tid, end_tid = unpack_from(">8s8s8s", record, 5)
+                if end_tid == z64:
+                    current[oid] = ofs
+                else:
+                    self.noncurrent[u64(oid)][u64(start_tid)] = ofs
+
+            seek(start)
+            if free > 4:
+                write(b'f'+pack(">I", free))
+            else:
+                write(str(free).encode())
+
+            moved = sum(len(record) for _, record in records)
+            self._n_compactions += 1
+            self._n_compacted_bytes += moved
+            return moved
+
     ##
     # Update our idea of the most recent tid.  This is stored in the
     # instance, and also written out near the start of the cache file.  The
@@ -477,6 +946,40 @@ class ClientCache(object):
         with self._lock:
             return self.tid
 
+    ##
+    # Read the header of the allocated block at `ofs`.
+    # @return (status, size, oid, start_tid, end_tid, flags, ldata)
+    def _read_header(self, ofs):
+        mapped = self._mapped
+        if mapped is None:
+            self.f.seek(ofs)
+            return unpack(record_header_format,
+                          self.f.read(record_header_size))
+        else:
+            return unpack_from(record_header_format, mapped, ofs)
+
+    ##
+    # Read the data of the allocated block at `ofs`, whose header
+    # was read with _read_header.
+    def _read_data(self, ofs, oid, ldata):
+        start = ofs + record_header_size
+        mapped = self._mapped
+        if mapped is None:
+            self.f.seek(start)
+            read = self.f.read
+            data = read(ldata)
+            assert len(data) == ldata, (ofs, oid, len(data), ldata)
+            # WARNING: The following assert changes the file position.
+            # We must not depend on this below or we'll fail in
+            # optimized mode.
+            assert read(8) == oid, (ofs, oid)
+        else:
+            end = start + ldata
+            data = mapped[start:end]
+            assert len(data) == ldata, (ofs, oid, len(data), ldata)
+            assert mapped[end:end+8] == oid, (ofs, oid)
+        return data
+
     ##
     # Return the current data record for oid.
     # @param oid object id
@@ -487,49 +990,69 @@ class ClientCache(object):
         with self._lock:
             ofs = self.current.get(oid)
             if ofs is None:
+                if self.l1_size:
+                    self._n_l1_misses += 1
                 self._trace(0x20, oid)
                 return None
-            self.f.seek(ofs)
-            read = self.f.read
-            status = read(1)
-            assert status == b'a', (ofs, self.f.tell(), oid)
-            size, saved_oid, tid, end_tid, lver, ldata = unpack(
-                ">I8s8s8sHI", read(34))
-            assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
-            assert end_tid == z64, (ofs, self.f.tell(), oid, tid, end_tid)
-            assert lver == 0, "Versions aren't supported"
-
-            if before_tid and tid >= before_tid:
-                return None
-
-            data = read(ldata)
-            assert len(data) == ldata, (
-                ofs, self.f.tell(), oid, len(data), ldata)
-
-            # WARNING: The following assert changes the file position.
-            # We must not depend on this below or we'll fail in optimized mode.
-            assert read(8) == oid, (ofs, self.f.tell(), oid)
 
+            entry = self._l1.pop(oid, None) if self.l1_size else None
+            if entry is not None:
+                data, tid = entry
+                self._l1[oid] = entry
+                if before_tid and tid >= before_tid:
+                    return None
+                self._n_l1_hits += 1
+                raw = None
+                # (Close enough, for the eviction policy.)
+                size = allocated_record_overhead + len(data)
+            else:
+                status, size, saved_oid, tid, end_tid, flags, ldata = (
+                    self._read_header(ofs))
+                assert status == b'a', (ofs, oid)
+                assert saved_oid == oid, (ofs, oid, saved_oid)
+                assert end_tid == z64, (ofs, oid, tid, end_tid)
+                assert not flags & ~record_flags, "Versions aren't supported"
+
+                if self.l1_size:
+                    self._n_l1_misses += 1
+
+                if before_tid and tid >= before_tid:
+                    return None
+
+                raw = self._read_data(ofs, oid, ldata)
+                data = _decode(raw, flags)
+                if self.l1_size:
+                    self._l1_add(oid, data, tid)
+
+            if self.admission is not None:
+                self.admission.record(oid)
             self._n_accesses += 1
-            self._trace(0x22, oid, tid, end_tid, ldata)
+            self._n_current_hits += 1
+            self._trace(0x22, oid, tid, z64, len(data))
 
             ofsofs = self.currentofs - ofs
             if ofsofs < 0:
                 ofsofs += self.maxsize
 
-            if (ofsofs > self.rearrange and
-                self.maxsize > 10*len(data) and
-                size > 4):
-                # The record is far back and might get evicted, but it's
-                # valuable, so move it forward.
+            if self.policy.accessed(oid, size, ofsofs > self.rearrange):
+                if raw is None:
+                    # We got the data from memory, but we want to copy
+                    # the record as it is in the file.
+                    _, size, _, _, _, flags, ldata = self._read_header(ofs)
+                    raw = self._read_data(ofs, oid, ldata)
 
-                # Remove fromn old loc:
-                del self.current[oid]
-                self.f.seek(ofs)
-                self.f.write(b'f'+pack(">I", size))
+                if self.maxsize > 10*ldata and size > 4:
+                    # The record is far back and might get evicted, but
+                    # it's valuable, so move it forward.
+
+                    # Remove fromn old loc:
+                    del self.current[oid]
+                    self._current_bytes -= size
+                    self.f.seek(ofs)
+                    self.f.write(b'f'+pack(">I", size))
 
-                # Write to new location:
-                self._store(oid, tid, None, data, size)
+                    # Write to new location:
+                    self._store(oid, tid, None, raw, size, flags)
 
             return data, tid
 
@@ -561,23 +1084,13 @@ class ClientCache(object):
 
             tid, ofs = items[-1]
 
-            self.f.seek(ofs)
-            read = self.f.read
-            status = read(1)
-            assert status == b'a', (ofs, self.f.tell(), oid, before_tid)
-            size, saved_oid, saved_tid, end_tid, lver, ldata = unpack(
-                ">I8s8s8sHI", read(34))
-            assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
-            assert saved_tid == p64(tid), (
-                ofs, self.f.tell(), oid, saved_tid, tid)
-            assert end_tid != z64, (ofs, self.f.tell(), oid)
-            assert lver == 0, "Versions aren't supported"
-            data = read(ldata)
-            assert len(data) == ldata, (ofs, self.f.tell())
-
-            # WARNING: The following assert changes the file position.
-            # We must not depend on this below or we'll fail in optimized mode.
-            assert read(8) == oid, (ofs, self.f.tell(), oid)
+            status, size, saved_oid, saved_tid, end_tid, flags, ldata = (
+                self._read_header(ofs))
+            assert status == b'a', (ofs, oid, before_tid)
+            assert saved_oid == oid, (ofs, oid, saved_oid)
+            assert saved_tid == p64(tid), (ofs, oid, saved_tid, tid)
+            assert end_tid != z64, (ofs, oid)
+            assert not flags & ~record_flags, "Versions aren't supported"
 
             if end_tid < before_tid:
                 result = self.load(oid, before_tid)
@@ -587,7 +1100,15 @@ class ClientCache(object):
                     self._trace(0x24, oid, "", before_tid)
                     return result
 
+            data = _decode(self._read_data(ofs, oid, ldata), flags)
+            if self._noncurrent_lru is not None:
+                self._noncurrent_lru[oid, saved_tid] = (
+                    self._noncurrent_lru.pop((oid, saved_tid)))
+
+            if self.admission is not None:
+                self.admission.record(oid)
             self._n_accesses += 1
+            self._n_noncurrent_hits += 1
             self._trace(0x26, oid, "", saved_tid)
             return data, saved_tid, end_tid
 
@@ -631,20 +1152,48 @@ class ClientCache(object):
             # only if the entire cache file is too small to hold the object.
             if size >= min(max_block_size, self.maxsize - ZEC_HEADER_SIZE):
                 return
+            if (end_tid and self.noncurrent_size is not None and
+                size > self.noncurrent_size):
+                return
+
+            # Loads that miss don't count as accesses for the admission
+            # filter.  The store that follows them does, as do stores of
+            # data written by this client.
+            admission = self.admission
+            if admission is not None:
+                admission.record(oid)
+                if not admission.admit(oid, len(data)):
+                    self._n_rejects += 1
+                    return
+
+            self._n_added_logical_bytes += size
+            flags = 0
+            raw = data
+            if self.compress and len(data) >= self.compress_threshold:
+                compressed = zlib.compress(data)
+                if len(compressed) < len(data):
+                    raw = compressed
+                    flags = record_compressed
+                    size = allocated_record_overhead + len(raw)
 
             self._n_adds += 1
             self._n_added_bytes += size
             self._len += 1
 
-            self._store(oid, start_tid, end_tid, data, size)
+            self._store(oid, start_tid, end_tid, raw, size, flags)
 
             if end_tid:
                 self._trace(0x54, oid, start_tid, end_tid, dlen=len(data))
             else:
+                self.policy.added(oid, size)
+                if self.l1_size:
+                    self._l1_add(oid, data, start_tid)
                 self._trace(0x52, oid, start_tid, dlen=len(data))
 
-    def _store(self, oid, start_tid, end_tid, data, size):
-        # Low-level store used by store and load
+    def _store(self, oid, start_tid, end_tid, data, size, flags=0):
+        # Low-level store used by store and load.  The data is written as
+        # is, so if flags includes record_compressed, it must already be
+        # compressed.
 
         # In the next line, we ask for an extra to make sure we always
         # have a free block after the new alocated block.  This free
@@ -675,7 +1224,8 @@ class ClientCache(object):
         write(b'f'+pack(">I", nfreebytes))
 
         # Now write the rest of the allocation block header and object data.
-        write(pack(">8s8s8sHI", oid, start_tid, end_tid or z64, 0, len(data)))
+        write(pack(">8s8s8sHI", oid, start_tid, end_tid or z64, flags,
+                   len(data)))
         write(data)
         write(oid)
         write(extra)
@@ -685,12 +1235,14 @@ class ClientCache(object):
         seek(ofs)
         write(b'a'+pack(">I", size))
 
+        self.currentofs += size
+
         if end_tid:
-            self._set_noncurrent(oid, start_tid, ofs)
+            self._set_noncurrent(oid, start_tid, ofs, size)
+            self._trim_noncurrent()
         else:
             self.current[oid] = ofs
-
-        self.currentofs += size
+            self._current_bytes += size
 
 
     ##
@@ -709,36 +1261,54 @@ class ClientCache(object):
     #        or None to forget all cached info about oid.
     def invalidate(self, oid, tid):
         with self._lock:
-            ofs = self.current.get(oid)
-            if ofs is None:
-                # 0x10 == invalidate (miss)
-                self._trace(0x10, oid, tid)
-                return
+            self._invalidate(oid, tid)
 
+    ##
+    # Invalidate each of `oids`, as with invalidate, while holding the
+    # lock once.  The records are updated in file order, which turns
+    # the random I/O of invalidating lots of objects (after
+    # verification, for example) into a single pass over the file.
+    def invalidate_many(self, oids, tid):
+        with self._lock:
+            current = self.current
+            for oid in sorted(set(oids), key=lambda oid: current.get(oid, 0)):
+                self._invalidate(oid, tid)
+
+    def _invalidate(self, oid, tid):
+        self._l1_discard(oid)
+        ofs = self.current.get(oid)
+        if ofs is None:
+            # 0x10 == invalidate (miss)
+            self._trace(0x10, oid, tid)
+            return
+
+        self.f.seek(ofs)
+        read = self.f.read
+        status = read(1)
+        assert status == b'a', (ofs, self.f.tell(), oid)
+        size, saved_oid, saved_tid, end_tid = unpack(">I8s8s8s", read(28))
+        assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
+        assert end_tid == z64, (ofs, self.f.tell(), oid)
+        del self.current[oid]
+        self._current_bytes -= size
+        self.policy.removed(oid, size)
+        if tid is None:
             self.f.seek(ofs)
-            read = self.f.read
-            status = read(1)
-            assert status == b'a', (ofs, self.f.tell(), oid)
-            size, saved_oid, saved_tid, end_tid = unpack(">I8s8s8s", read(28))
-            assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
-            assert end_tid == z64, (ofs, self.f.tell(), oid)
-            del self.current[oid]
-            if tid is None:
-                self.f.seek(ofs)
-                self.f.write(b'f'+pack(">I", size))
-                # 0x1E = invalidate (hit, discarding current or non-current)
-                self._trace(0x1E, oid, tid)
-                self._len -= 1
-            else:
-                if tid == saved_tid:
-                    logger.warning(
-                        "Ignoring invalidation with same tid as current")
-                    return
-                self.f.seek(ofs+21)
-                self.f.write(tid)
-                self._set_noncurrent(oid, saved_tid, ofs)
-                # 0x1C = invalidate (hit, saving non-current)
-                self._trace(0x1C, oid, tid)
+            self.f.write(b'f'+pack(">I", size))
+            # 0x1E = invalidate (hit, discarding current or non-current)
+            self._trace(0x1E, oid, tid)
+            self._len -= 1
+        else:
+            if tid == saved_tid:
+                logger.warning(
+                    "Ignoring invalidation with same tid as current")
+                return
+            self.f.seek(ofs+21)
+            self.f.write(tid)
+            self._set_noncurrent(oid, saved_tid, ofs, size)
+            # 0x1C = invalidate (hit, saving non-current)
+            self._trace(0x1C, oid, tid)
+            self._trim_noncurrent()
 
     ##
     # Generates (oid, serial) oairs for all objects in the
@@ -773,58 +1343,1238 @@ class ClientCache(object):
         print()
 
     # If `path` isn't None (== we're using a persistent cache file), and
-    # envar ZEO_CACHE_TRACE is set to a non-empty value, try to open
-    # path+'.trace' as a trace file, and store the file object in
-    # self._tracefile.  If not, or we can't write to the trace file, disable
-    # tracing by setting self._trace to a dummy function, and set
-    # self._tracefile to None.
+    # envar ZEO_CACHE_TRACE is set to a non-empty value, start tracing to
+    # path+'.trace', sampling 1 in ZEO_CACHE_TRACE_SAMPLE objects, if set.
+    # Tracing can also be started and stopped later with start_trace and
+    # stop_trace.  While not tracing, self._trace is a dummy function and
+    # self._tracefile is None.
     _tracefile = None
     def _trace(self, *a, **kw):
         pass
 
+    # Trace records are buffered and written in blocks of about this
+    # many bytes.
+    trace_buffer_size = 1 << 16
+
     def _setup_trace(self, path):
-        _tracefile = None
         if path and os.environ.get("ZEO_CACHE_TRACE"):
-            tfn = path + ".trace"
+            sample = int(os.environ.get("ZEO_CACHE_TRACE_SAMPLE") or 1)
             try:
-                _tracefile = open(tfn, "ab")
+                self.start_trace(sample=sample)
             except IOError as msg:
-                logger.warning("cannot write tracefile %r (%s)", tfn, msg)
+                logger.warning("cannot write tracefile %r (%s)",
+                               path + ".trace", msg)
+
+    def start_trace(self, sample=1, path=None):
+        """Start writing a trace of cache operations.
+
+        The trace is appended to `path`, which defaults to the cache
+        file's path with ".trace" appended.  If `sample` is greater
+        than 1, only operations on about 1 in `sample` objects, chosen
+        by a hash of their oids, are traced.  Since all of the
+        operations on the chosen objects are traced, the trace can be
+        analyzed as the trace of a cache `sample` times smaller.
+
+        Tracing is restarted if it was already started.
+        """
+        if path is None:
+            if not self.path:
+                raise ValueError("A path is needed to trace a temporary cache")
+            path = self.path + ".trace"
+        tracefile = open(path, "ab")
+        logger.info("opened tracefile %r", path)
+        with self._lock:
+            self._unsetup_trace()
+
+            now = time.time
+            crc32 = zlib.crc32
+            buffer = []
+            limit = max(self.trace_buffer_size // 34, 1)
+            def _trace(code, oid=b"", tid=z64, end_tid=z64, dlen=0):
+                # The code argument is two hex digits; bits 0 and 7 must be
+                # zero.  The first hex digit shows the operation, the second
+                # the outcome.
+                # This method has been carefully tuned to be as fast as
+                # possible.
+                # Note: when tracing is disabled, this method is hidden by a
+                # dummy.
+                if sample > 1 and oid and (crc32(oid) & 0xffffffff) % sample:
+                    return
+                encoded = (dlen << 8) + code
+                buffer.append(
+                    pack(">iiH8s8s", int(now()), encoded, len(oid),
+                         tid or z64, end_tid or z64) + oid)
+                if len(buffer) >= limit:
+                    tracefile.write(b''.join(buffer))
+                    del buffer[:]
+
+            def flush():
+                if buffer:
+                    tracefile.write(b''.join(buffer))
+                    del buffer[:]
+                tracefile.flush()
+
+            self._trace = _trace
+            self._tracefile = tracefile
+            self._flush_trace = flush
+            _trace(0x00)
+
+    def stop_trace(self):
+        """Stop tracing, writing out any buffered trace records.
+        """
+        with self._lock:
+            self._unsetup_trace()
+
+    def flush_trace(self):
+        """Write out any buffered trace records.
+        """
+        with self._lock:
+            if self._tracefile is not None:
+                self._flush_trace()
+
+    def _unsetup_trace(self):
+        if self._tracefile is not None:
+            try:
+                self._flush_trace()
+            finally:
+                del self._trace
+                self._tracefile.close()
+                del self._tracefile
+                del self._flush_trace
+
+def _decode(data, flags):
+    if flags & record_compressed:
+        return zlib.decompress(data)
+    return data
+
+_halve = bytes(bytearray(i >> 1 for i in range(256)))
+
+class TinyLFUAdmission(object):
+    """Size-aware admission filter based on access frequency.
+
+    Accesses are counted in a count-min sketch of 4-bit counters, which
+    are halved every `sample` accesses so that old popularity fades.
+    Objects smaller than `small` bytes are always admitted.  Larger
+    objects must have been accessed more often, one more time for each
+    doubling of their size, so that big objects that are read once
+    don't push lots of small, frequently used ones out of the cache.
+
+    A filter may be shared by several caches.  Updates aren't locked,
+    so concurrent updates may be lost, which only makes the estimates a
+    little less accurate.
+    """
+
+    depth = 4
+
+    def __init__(self, width=1<<16, small=1<<14, sample=None):
+        bits = max(width - 1, 1).bit_length()
+        self.width = 1 << bits
+        self._shift = 64 - bits
+        self.small = small
+        self.sample = sample or 10 * self.width
+        self._table = bytearray(self.width * self.depth)
+        self._additions = 0
+
+    def _indexes(self, oid):
+        x = unpack(">Q", oid)[0]
+        h1 = (x * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = (x * 0xC2B2AE3D27D4EB4F) & 0xFFFFFFFFFFFFFFFF | 1
+        width = self.width
+        shift = self._shift
+        return [row * width +
+                (((h1 + row * h2) & 0xFFFFFFFFFFFFFFFF) >> shift)
+                for row in range(self.depth)]
+
+    def record(self, oid):
+        table = self._table
+        indexes = self._indexes(oid)
+        # Only increment the smallest counters ("conservative update"),
+        # which reduces the overestimates caused by collisions.
+        count = min([table[i] for i in indexes])
+        if count < 15:
+            for i in indexes:
+                if table[i] == count:
+                    table[i] = count + 1
+        self._additions += 1
+        if self._additions >= self.sample:
+            self._table = table.translate(_halve)
+            self._additions //= 2
+
+    def estimate(self, oid):
+        table = self._table
+        return min([table[i] for i in self._indexes(oid)])
+
+    def admit(self, oid, size):
+        return self.estimate(oid) > (size // self.small).bit_length()
+
+class CircularPolicy(object):
+    """The traditional ZEO cache eviction policy.
+
+    Records are evicted in the order they were written, as the write
+    position goes around the file, except that current records that
+    are read when they're far behind the write position (see
+    ClientCache's `rearrange` argument) are copied forward.
+
+    Eviction policies are told about current records only: when
+    they're added, accessed, evicted, or removed because they were
+    invalidated.  When the write position reaches a current record,
+    the policy's keep method decides whether it's evicted or moved to
+    the write position and kept.  A policy has to say no eventually,
+    usually by only keeping a record once for each time it's used.
+    """
+
+    def __init__(self, size):
+        pass
+
+    def added(self, oid, size):
+        pass
+
+    ##
+    # Return whether the record should be copied forward, which is
+    # only done when `far` is true.
+    def accessed(self, oid, size, far):
+        return far
+
+    def keep(self, oid, size):
+        return False
+
+    def evicted(self, oid, size):
+        pass
+
+    def removed(self, oid, size):
+        pass
+
+    def clear(self):
+        pass
+
+class SegmentedLRUPolicy(CircularPolicy):
+    """Segmented LRU eviction.
+
+    New records are probationary.  Records that are used are promoted
+    to the protected segment, which holds at most `protected` of the
+    cache's bytes; when it's full, its least recently used records are
+    demoted.  When the write position reaches a protected record, it's
+    kept, and demoted, so it's evicted the next time around unless it's
+    used again.  Probationary records are evicted.
+    """
+
+    def __init__(self, size, protected=.8):
+        self.protected_size = protected * size
+        # {oid -> size}, in least-recently-used order
+        self._protected = OrderedDict()
+        self._protected_bytes = 0
+
+    def accessed(self, oid, size, far):
+        protected = self._protected
+        if oid in protected:
+            protected[oid] = protected.pop(oid)
+        else:
+            protected[oid] = size
+            self._protected_bytes += size
+            while self._protected_bytes > self.protected_size:
+                self._protected_bytes -= protected.popitem(False)[1]
+        return False
+
+    def keep(self, oid, size):
+        if oid in self._protected:
+            self.removed(oid, size)
+            return True
+        return False
+
+    def removed(self, oid, size):
+        size = self._protected.pop(oid, None)
+        if size is not None:
+            self._protected_bytes -= size
+
+    def clear(self):
+        self._protected.clear()
+        self._protected_bytes = 0
+
+class TwoQueuePolicy(CircularPolicy):
+    """2Q eviction.
+
+    New records are in the first queue, and are evicted when the write
+    position reaches them, however often they're used, so objects used
+    in bursts don't displace ones that are used over longer periods.
+    The oids of evicted records are remembered, up to `ghost` of the
+    cache's bytes worth of records.  Records added for remembered oids
+    go into the second queue, of hot records, which are kept when the
+    write position reaches them if they've been used since they were
+    added or last kept.
+
+    Hot records that are invalidated are remembered as if they'd been
+    evicted, so their new revisions are hot too.
+    """
+
+    def __init__(self, size, ghost=.5):
+        self.ghost_size = ghost * size
+        # {oid -> used since added or kept}
+        self._hot = {}
+        # {oid -> size}, oldest first
+        self._ghosts = OrderedDict()
+        self._ghost_bytes = 0
+
+    def _remember(self, oid, size):
+        ghosts = self._ghosts
+        self._ghost_bytes += size - ghosts.pop(oid, 0)
+        ghosts[oid] = size
+        while self._ghost_bytes > self.ghost_size:
+            self._ghost_bytes -= ghosts.popitem(False)[1]
+
+    def added(self, oid, size):
+        size = self._ghosts.pop(oid, None)
+        if size is not None:
+            self._ghost_bytes -= size
+            self._hot[oid] = False
+
+    def accessed(self, oid, size, far):
+        if oid in self._hot:
+            self._hot[oid] = True
+        return False
+
+    def keep(self, oid, size):
+        if self._hot.get(oid):
+            self._hot[oid] = False
+            return True
+        return False
+
+    def evicted(self, oid, size):
+        if self._hot.pop(oid, None) is None:
+            self._remember(oid, size)
+
+    def removed(self, oid, size):
+        if self._hot.pop(oid, None) is not None:
+            self._remember(oid, size)
+
+    def clear(self):
+        self._hot.clear()
+        self._ghosts.clear()
+        self._ghost_bytes = 0
+
+# Eviction policies that can be selected by name, for example with the
+# cache-policy client-storage option.
+eviction_policies = {
+    'circular': CircularPolicy,
+    'slru': SegmentedLRUPolicy,
+    '2q': TwoQueuePolicy,
+    }
+
+# The arrays used by the packed indexes hold oids and tids as unsigned
+# 8-byte integers.  Python 2's array module doesn't support 'Q', but
+# its 'L' is 8 bytes on the 64-bit platforms where big caches are used.
+try:
+    array.array('Q')
+except ValueError:
+    _packed_typecode = 'L'
+else:
+    _packed_typecode = 'Q'
+
+_oid_struct = Struct(">Q")
+
+# Marks delta entries for items that are in the arrays, but have been
+# deleted.
+_deleted = -1
+
+class PackedIndex(object):
+    """A compact {oid -> file offset} mapping, for ClientCache.current.
+
+    Oids and offsets are kept in parallel arrays sorted by oid, so each
+    entry takes 12 bytes, or 16 with 8-byte offsets.  Changes are made
+    to a small dict, the delta, which lookups consult first, and which
+    is merged into the arrays when it gets big enough.  The delta is
+    allowed to grow in proportion to the arrays, so merging takes
+    amortized constant time per change.
+    """
+
+    def __init__(self, value_typecode=_packed_typecode, delta_size=1024):
+        self.value_typecode = value_typecode
+        self.delta_size = delta_size
+        self._keys = array.array(_packed_typecode)
+        self._values = array.array(value_typecode)
+        # {oid as an integer -> offset, or _deleted}
+        self._delta = {}
+        self._len = 0
+
+    def _find(self, key):
+        # Return the position of key in the arrays, or -1.
+        keys = self._keys
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def _changed(self):
+        if len(self._delta) >= max(self.delta_size, len(self._keys) >> 6):
+            self._merge()
+
+    def _merge(self):
+        keys = self._keys
+        values = self._values
+        new_keys = array.array(_packed_typecode)
+        new_values = array.array(self.value_typecode)
+        i = 0
+        for key, value in sorted(six.iteritems(self._delta)):
+            j = bisect.bisect_left(keys, key, i)
+            new_keys.extend(keys[i:j])
+            new_values.extend(values[i:j])
+            if j < len(keys) and keys[j] == key:
+                j += 1          # replaced or deleted
+            if value != _deleted:
+                new_keys.append(key)
+                new_values.append(value)
+            i = j
+        new_keys.extend(keys[i:])
+        new_values.extend(values[i:])
+        self._keys = new_keys
+        self._values = new_values
+        self._delta.clear()
+
+    def get(self, oid, default=None):
+        key, = _oid_struct.unpack(oid)
+        value = self._delta.get(key)
+        if value is None:
+            i = self._find(key)
+            if i < 0:
+                return default
+            return self._values[i]
+        if value == _deleted:
+            return default
+        return value
+
+    def __getitem__(self, oid):
+        value = self.get(oid)
+        if value is None:
+            raise KeyError(oid)
+        return value
+
+    def __contains__(self, oid):
+        return self.get(oid) is not None
+
+    def __setitem__(self, oid, value):
+        key, = _oid_struct.unpack(oid)
+        old = self._delta.get(key)
+        if old is None:
+            if self._find(key) < 0:
+                self._len += 1
+        elif old == _deleted:
+            self._len += 1
+        self._delta[key] = value
+        self._changed()
+
+    def __delitem__(self, oid):
+        key, = _oid_struct.unpack(oid)
+        delta = self._delta
+        old = delta.get(key)
+        if old == _deleted:
+            raise KeyError(oid)
+        if self._find(key) < 0:
+            if old is None:
+                raise KeyError(oid)
+            del delta[key]
+        else:
+            delta[key] = _deleted
+            self._changed()
+        self._len -= 1
+
+    def __len__(self):
+        return self._len
+
+    def items(self):
+        """Generate the (oid, offset) items in oid order
+        """
+        if self._delta:
+            self._merge()
+        pack_oid = _oid_struct.pack
+        for key, value in six.moves.zip(self._keys, self._values):
+            yield pack_oid(key), value
+
+    iteritems = items
+
+    def __iter__(self):
+        for oid, _ in self.items():
+            yield oid
+
+    keys = __iter__
+
+class PackedNoncurrentIndex(object):
+    """A compact {oid -> {tid -> file offset}} mapping, for
+    ClientCache.noncurrent.
+
+    Like PackedIndex, but with oids, tids and offsets in parallel
+    arrays sorted by oid and tid.  Keys are oids and tids as integers,
+    as for the BTrees that are used otherwise, and the revisions of an
+    oid are returned as a view with the parts of the LLBucket API that
+    ClientCache uses.
+    """
+
+    def __init__(self, value_typecode=_packed_typecode, delta_size=1024):
+        self.value_typecode = value_typecode
+        self.delta_size = delta_size
+        self._oids = array.array(_packed_typecode)
+        self._tids = array.array(_packed_typecode)
+        self._values = array.array(value_typecode)
+        # {oid -> {tid -> offset, or _deleted}}
+        self._delta = {}
+        self._delta_len = 0
+
+    def _range(self, oid):
+        # The slice of the arrays holding the revisions of oid.
+        oids = self._oids
+        i = bisect.bisect_left(oids, oid)
+        j = i
+        while j < len(oids) and oids[j] == oid:
+            j += 1
+        return i, j
+
+    def _revisions(self, oid):
+        # Return the [(tid, offset)] of oid, sorted by tid.
+        i, j = self._range(oid)
+        changes = self._delta.get(oid)
+        if not changes:
+            return list(six.moves.zip(self._tids[i:j], self._values[i:j]))
+        revisions = dict(six.moves.zip(self._tids[i:j], self._values[i:j]))
+        revisions.update(changes)
+        return sorted((tid, value) for tid, value in six.iteritems(revisions)
+                      if value != _deleted)
+
+    def _get(self, oid, tid):
+        value = self._delta.get(oid, {}).get(tid)
+        if value is None:
+            i, j = self._range(oid)
+            tids = self._tids
+            k = bisect.bisect_left(tids, tid, i, j)
+            if k < j and tids[k] == tid:
+                return self._values[k]
+        elif value != _deleted:
+            return value
+        return None
+
+    def _set(self, oid, tid, value):
+        changes = self._delta.setdefault(oid, {})
+        if tid not in changes:
+            self._delta_len += 1
+        changes[tid] = value
+        if self._delta_len >= max(self.delta_size, len(self._oids) >> 6):
+            self._merge()
+
+    def _merge(self):
+        oids = self._oids
+        tids = self._tids
+        values = self._values
+        new_oids = array.array(_packed_typecode)
+        new_tids = array.array(_packed_typecode)
+        new_values = array.array(self.value_typecode)
+        i = 0
+        for oid in sorted(self._delta):
+            j, k = self._range(oid)
+            new_oids.extend(oids[i:j])
+            new_tids.extend(tids[i:j])
+            new_values.extend(values[i:j])
+            for tid, value in self._revisions(oid):
+                new_oids.append(oid)
+                new_tids.append(tid)
+                new_values.append(value)
+            i = k
+        new_oids.extend(oids[i:])
+        new_tids.extend(tids[i:])
+        new_values.extend(values[i:])
+        self._oids = new_oids
+        self._tids = new_tids
+        self._values = new_values
+        self._delta.clear()
+        self._delta_len = 0
+
+    def get(self, oid, default=None):
+        if self._revisions(oid):
+            return _PackedRevisions(self, oid)
+        return default
+
+    def __getitem__(self, oid):
+        return _PackedRevisions(self, oid)
+
+    def __contains__(self, oid):
+        return bool(self._revisions(oid))
+
+    def __setitem__(self, oid, revisions):
+        for tid, value in revisions.items():
+            self._set(oid, tid, value)
+
+    def __delitem__(self, oid):
+        for tid, _ in self._revisions(oid):
+            self._set(oid, tid, _deleted)
+
+    def items(self):
+        """Generate the (oid, revisions) items in oid order
+        """
+        if self._delta:
+            self._merge()
+        last = None
+        for oid in self._oids:
+            if oid != last:
+                yield oid, _PackedRevisions(self, oid)
+                last = oid
+
+    def __iter__(self):
+        for oid, _ in self.items():
+            yield oid
+
+class _PackedRevisions(object):
+    # The revisions of an object in a PackedNoncurrentIndex.
+
+    def __init__(self, index, oid):
+        self.index = index
+        self.oid = oid
+
+    def items(self, min=None, max=None):
+        return [(tid, value) for tid, value
+                in self.index._revisions(self.oid)
+                if (min is None or tid >= min) and
+                (max is None or tid <= max)]
+
+    def __len__(self):
+        return len(self.index._revisions(self.oid))
+
+    def keys(self, min=None, max=None):
+        return [tid for tid, _ in self.items(min, max)]
+
+    def __contains__(self, tid):
+        return self.index._get(self.oid, tid) is not None
+
+    def __getitem__(self, tid):
+        value = self.index._get(self.oid, tid)
+        if value is None:
+            raise KeyError(tid)
+        return value
+
+    def __setitem__(self, tid, value):
+        self.index._set(self.oid, tid, value)
+
+    def __delitem__(self, tid):
+        if tid not in self:
+            raise KeyError(tid)
+        self.index._set(self.oid, tid, _deleted)
+
+class SegmentedClientCache(object):
+    """A client cache partitioned into independent ClientCache segments.
+
+    Each object is kept in the segment selected by its oid, and each
+    segment has its own file, index and lock, so operations on objects
+    in different segments don't block each other.
+    """
+
+    def __init__(self, path=None, size=200*1024**2, segments=8, **kw):
+        self.path = path
+        if path:
+            # The segment count is part of the file names, because
+            # objects would end up in the wrong segments if the count
+            # changed.
+            paths = ["%s.%d-%d" % (path, i, segments)
+                     for i in range(segments)]
+        else:
+            paths = [None] * segments
+        self.segments = [ClientCache(p, size // segments, **kw)
+                         for p in paths]
+        self.maxsize = sum(segment.maxsize for segment in self.segments)
+        self._lock = RLock()
+
+        # The segments' last tids may differ if we weren't closed
+        # cleanly.  The data in each segment is valid through its own
+        # last tid, so all of it is valid through the smallest.
+        # Empty segments don't count, since they can't be out of date.
+        tids = [segment.getLastTid() for segment in self.segments
+                if len(segment)]
+        self.tid = min(tids) if tids else max(
+            segment.getLastTid() for segment in self.segments)
+
+    @property
+    def fc(self):
+        return self
+
+    def _segment(self, oid):
+        return self.segments[unpack(">Q", oid)[0] % len(self.segments)]
+
+    def clear(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.clear()
+
+    def clearStats(self):
+        for segment in self.segments:
+            segment.clearStats()
+
+    def getStats(self):
+        return CacheStats(*[sum(stats) for stats in zip(
+            *[segment.getStats() for segment in self.segments])])
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
+
+    def setLastTid(self, tid):
+        with self._lock:
+            if (not tid) or (tid == z64):
+                return
+            if (tid <= self.tid) and len(self):
+                if tid == self.tid:
+                    return                  # Be a little forgiving
+                raise ValueError("new last tid (%s) must be greater than "
+                                 "previous one (%s)"
+                                 % (u64(tid), u64(self.tid)))
+            for segment in self.segments:
+                if tid > segment.getLastTid():
+                    segment.setLastTid(tid)
+            self.tid = tid
+
+    def getLastTid(self):
+        return self.tid
+
+    def load(self, oid, before_tid=None):
+        return self._segment(oid).load(oid, before_tid)
+
+    def loadBefore(self, oid, before_tid):
+        return self._segment(oid).loadBefore(oid, before_tid)
+
+    def store(self, oid, start_tid, end_tid, data):
+        self._segment(oid).store(oid, start_tid, end_tid, data)
+
+    def invalidate(self, oid, tid):
+        self._segment(oid).invalidate(oid, tid)
+
+    def invalidate_many(self, oids, tid):
+        by_segment = {}
+        for oid in oids:
+            by_segment.setdefault(self._segment(oid), []).append(oid)
+        for segment, segment_oids in six.iteritems(by_segment):
+            segment.invalidate_many(segment_oids, tid)
+
+    def compact(self, nbytes=1<<18):
+        return sum(segment.compact(nbytes // len(self.segments) or 1)
+                   for segment in self.segments)
+
+    def start_trace(self, sample=1):
+        """Start tracing each segment to its own trace file.
+        """
+        for segment in self.segments:
+            segment.start_trace(sample)
+
+    def stop_trace(self):
+        for segment in self.segments:
+            segment.stop_trace()
+
+    def flush_trace(self):
+        for segment in self.segments:
+            segment.flush_trace()
+
+    def contents(self):
+        for segment in self.segments:
+            for item in segment.contents():
+                yield item
+
+# Shared cache files, used by SharedClientCache, hold the same blocks
+# as ordinary cache files, after a 28-byte header: the magic number,
+# ZES1, the shared last tid (see below), and the lap number and offset
+# at which the next record will be written.  Processes sharing the
+# file find out about records written by others by following the write
+# offset around the file.
+shared_magic = b"ZES1"
+shared_header_format = ">4s8sQQ"
+SHARED_HEADER_SIZE = 28
+
+class SharedClientCache(object):
+    """A client cache file shared by the processes on a host.
+
+    Any number of processes can open the same file.  Access is
+    serialized with fcntl locks: shared ones for loads, exclusive ones
+    for anything that writes.  Each process keeps its own index of the
+    file, and brings it up to date, before each operation, by reading
+    the records written by other processes since it last looked.
+
+    The processes sharing a file may have seen different transactions.
+    Each process has its own last tid, as returned by getLastTid, and
+    the file has a shared last tid, through which current records
+    (records without an end tid) are known to be current.  Records with
+    an end tid are facts about the database's history, and can be used
+    by any process.  Current records are only used by processes that
+    aren't ahead of the shared last tid, and are only stored by
+    processes that aren't behind it.  A process that is in step with
+    the file applies its invalidations to the file and advances the
+    shared last tid, as part of setLastTid, so invalidations are only
+    applied once, however many processes receive them.
+    """
+
+    def __init__(self, path, size=200*1024**2):
+        if fcntl is None:
+            raise ValueError("Shared client caches require fcntl")
+        self.path = path
+        self.maxsize = max(size, SHARED_HEADER_SIZE + 5)
+        self._lock = RLock()
+
+        # {oid -> {start_tid -> ofs}}, and {ofs -> (oid, start_tid)} so
+        # that we can forget about records that have been overwritten.
+        self._index = {}
+        self._by_ofs = BTrees.LOBTree.LOBTree()
+
+        # The position, (lap, ofs), up to which we've read records.  It
+        # starts more than a lap behind, so that the whole file is read.
+        self._lap = -2
+        self._ofs = SHARED_HEADER_SIZE
+
+        # The shared last tid, as of our last look at the header.
+        self._shared_tid = z64
+
+        # Invalidations (oid, tid) to be applied to the file by the next
+        # setLastTid.
+        self._pending = []
+
+        # The file is unbuffered, so we never see stale data that other
+        # processes have since overwritten.
+        self.f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b', 0)
+        with self._locked(fcntl.LOCK_EX):
+            fsize = os.fstat(self.f.fileno()).st_size
+            self.f.seek(0)
+            if (fsize < SHARED_HEADER_SIZE or
+                self.f.read(4) != shared_magic):
+                self._initfile(z64, 0)
+                logger.info("created shared cache file %r", path)
             else:
-                logger.info("opened tracefile %r", tfn)
+                if fsize != self.maxsize:
+                    logger.info("using the size of shared cache file %r, "
+                                "%d, rather than %d",
+                                path, fsize, self.maxsize)
+                    self.maxsize = fsize
+                logger.info("reusing shared cache file %r", path)
+            self._sync()
 
-        if _tracefile is None:
-            return
+        # We start out knowing what the file knows.
+        self.tid = self._shared_tid if self._shared_tid != maxtid else z64
 
-        now = time.time
-        def _trace(code, oid=b"", tid=z64, end_tid=z64, dlen=0):
-            # The code argument is two hex digits; bits 0 and 7 must be zero.
-            # The first hex digit shows the operation, the second the outcome.
-            # This method has been carefully tuned to be as fast as possible.
-            # Note: when tracing is disabled, this method is hidden by a dummy.
-            encoded = (dlen << 8) + code
-            if tid is None:
-                tid = z64
-            if end_tid is None:
-                end_tid = z64
+        self.clearStats()
+
+    @property
+    def fc(self):
+        return self
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        with self._lock:
+            fcntl.lockf(self.f, operation)
             try:
-                _tracefile.write(
-                    pack(">iiH8s8s",
-                         int(now()), encoded, len(oid), tid, end_tid) + oid,
-                    )
-            except:
-                print(repr(tid), repr(end_tid))
-                raise
-
-        self._trace = _trace
-        self._tracefile = _tracefile
-        _trace(0x00)
+                yield
+            finally:
+                fcntl.lockf(self.f, fcntl.LOCK_UN)
 
-    def _unsetup_trace(self):
-        if self._tracefile is not None:
-            del self._trace
-            self._tracefile.close()
-            del self._tracefile
+    def _initfile(self, tid, lap):
+        f = self.f
+        f.seek(0)
+        f.truncate()
+        f.write(pack(shared_header_format,
+                     shared_magic, tid, lap, SHARED_HEADER_SIZE))
+        f.seek(self.maxsize - 1)
+        f.write(b'x')
+        f.seek(SHARED_HEADER_SIZE)
+        nfree = self.maxsize - SHARED_HEADER_SIZE
+        for i in range(0, nfree, max_block_size):
+            block_size = min(max_block_size, nfree-i)
+            f.write(b'f' + pack(">I", block_size))
+            f.seek(block_size-5, 1)
+        sync(f)
+
+    def _write_position(self):
+        self.f.seek(12)
+        self.f.write(pack(">QQ", self._lap, self._ofs))
+
+    ##
+    # Read the header and index the records written since we last
+    # looked.  This must be called with the file locked.
+    def _sync(self):
+        f = self.f
+        f.seek(0)
+        _, self._shared_tid, lap, ofs = unpack(
+            shared_header_format, f.read(SHARED_HEADER_SIZE))
+        if lap == self._lap:
+            if ofs != self._ofs:
+                self._scan(self._ofs, ofs)
+        elif lap == self._lap + 1 and ofs < self._ofs:
+            self._scan(self._ofs, self.maxsize)
+            self._scan(SHARED_HEADER_SIZE, ofs)
+        else:
+            # We've been lapped, so everything may have been replaced.
+            self._index.clear()
+            self._by_ofs.clear()
+            self._scan(SHARED_HEADER_SIZE, self.maxsize)
+        self._lap = lap
+        self._ofs = ofs
+
+    def _scan(self, start, end):
+        for ofs in list(self._by_ofs.keys(start, end - 1)):
+            self._forget_at(ofs)
+        seek = self.f.seek
+        read = self.f.read
+        ofs = start
+        while ofs < end:
+            seek(ofs)
+            status = read(1)
+            if status == b'a':
+                size, oid, start_tid = unpack(">I8s8s", read(20))
+                self._index.setdefault(oid, {})[start_tid] = ofs
+                self._by_ofs[ofs] = oid, start_tid
+            elif status == b'f':
+                size, = unpack(">I", read(4))
+            elif status in b'1234':
+                size = int(status)
+            else:
+                raise ValueError("unknown status byte value %s in shared "
+                                 "cache file" % hex(ord(status)))
+            ofs += size
+
+        # Writers free a little more space than they use, so the records
+        # just past the end may be gone too.
+        while ofs < self.maxsize:
+            seek(ofs)
+            status = read(1)
+            if status == b'f':
+                size, = unpack(">I", read(4))
+            elif status in b'1234':
+                size = int(status)
+            else:
+                break
+            ofs += size
+        for ofs in list(self._by_ofs.keys(end, ofs - 1)):
+            self._forget_at(ofs)
+
+    def _forget_at(self, ofs):
+        oid, start_tid = self._by_ofs.pop(ofs)
+        revisions = self._index[oid]
+        del revisions[start_tid]
+        if not revisions:
+            del self._index[oid]
+
+    ##
+    # Return the header of the indexed record for oid with the largest
+    # start tid less than before_tid, as (ofs, size, start_tid, end_tid,
+    # ldata), or None.  Records that have been freed in place by other
+    # processes are forgotten.
+    def _find(self, oid, before_tid):
+        revisions = self._index.get(oid)
+        if not revisions:
+            return None
+        tids = [tid for tid in revisions if tid < before_tid]
+        if not tids:
+            return None
+        start_tid = max(tids)
+        ofs = revisions[start_tid]
+        self.f.seek(ofs)
+        status, size, saved_oid, saved_tid, end_tid, flags, ldata = unpack(
+            record_header_format, self.f.read(record_header_size))
+        if status != b'a' or saved_oid != oid or saved_tid != start_tid:
+            self._forget_at(ofs)
+            return None
+        assert not flags & ~record_flags, "Versions aren't supported"
+        return ofs, size, start_tid, end_tid, flags, ldata
+
+    def _read_data(self, ofs, flags, ldata):
+        self.f.seek(ofs + record_header_size)
+        data = self.f.read(ldata)
+        assert len(data) == ldata, (ofs, len(data), ldata)
+        return _decode(data, flags)
+
+    def clear(self):
+        # Other processes may have been storing data without the
+        # invalidations that made us clear our cache, so we empty the
+        # file.  Its shared last tid is left unknown (maxtid), so that no
+        # current data is stored until a process sets it.
+        with self._locked(fcntl.LOCK_EX):
+            self._sync()
+            self._initfile(maxtid, self._lap + 2)
+            self._sync()
+            self._pending = []
+
+    def clearStats(self):
+        self._n_adds = self._n_added_bytes = 0
+        self._n_evicts = self._n_evicted_bytes = 0
+        self._n_accesses = 0
+        self._n_current_hits = self._n_noncurrent_hits = 0
+
+    def getStats(self):
+        return CacheStats(self._n_adds, self._n_added_bytes,
+                          self._n_evicts, self._n_evicted_bytes,
+                          self._n_accesses, 0, 0, 0, self._n_added_bytes,
+                          0, 0, self._n_current_hits, self._n_noncurrent_hits,
+                          0, 0, 0, 0, 0)
+
+    ##
+    # The number of records in the file, as of our last look.
+    def __len__(self):
+        return len(self._by_ofs)
+
+    def close(self):
+        with self._lock:
+            f = self.f
+            self.f = None
+            if f is not None:
+                f.close()
+
+    def setLastTid(self, tid):
+        with self._locked(fcntl.LOCK_EX):
+            if (not tid) or (tid == z64):
+                return
+            if (tid <= self.tid) and len(self):
+                if tid == self.tid:
+                    return                  # Be a little forgiving
+                raise ValueError("new last tid (%s) must be greater than "
+                                 "previous one (%s)"
+                                 % (u64(tid), u64(self.tid)))
+            assert isinstance(tid, bytes) and len(tid) == 8, tid
+            self._sync()
+            shared_tid = self._shared_tid
+            # If we're in step with the file, we apply our
+            # invalidations to it, unless another process got there
+            # first.  Records stored by processes that were in step
+            # since our invalidate calls were made are stale, so the
+            # invalidations have to be applied here, rather than in
+            # invalidate.
+            in_step = self.tid <= shared_tid
+            for oid, invalidated_tid in self._pending:
+                if invalidated_tid is None:
+                    self._drop(oid)
+                elif in_step and invalidated_tid > shared_tid:
+                    self._end(oid, invalidated_tid)
+            self._pending = []
+            if shared_tid == maxtid or in_step and tid > shared_tid:
+                self._shared_tid = tid
+                self.f.seek(4)
+                self.f.write(tid)
+            self.tid = tid
+
+    def getLastTid(self):
+        with self._lock:
+            return self.tid
+
+    def load(self, oid, before_tid=None):
+        with self._locked(fcntl.LOCK_SH):
+            self._sync()
+            found = self._find_current(oid)
+            if found is not None:
+                ofs, size, start_tid, end_tid, flags, ldata = found
+                if not (before_tid and start_tid >= before_tid):
+                    self._n_accesses += 1
+                    self._n_current_hits += 1
+                    return self._read_data(ofs, flags, ldata), start_tid
+            return None
+
+    # Find the record for oid that's current as of our last tid.
+    def _find_current(self, oid):
+        tid = self.tid
+        found = self._find(oid, p64(u64(tid) + 1))
+        if found is not None:
+            end_tid = found[3]
+            if end_tid == z64:
+                # Current as of the shared last tid.
+                if tid <= self._shared_tid:
+                    return found
+            elif tid < end_tid:
+                return found
+
+    def loadBefore(self, oid, before_tid):
+        with self._locked(fcntl.LOCK_SH):
+            self._sync()
+            # We know nothing after our last tid, so, as with load,
+            # loads before later tids (like maxtid, for current data)
+            # get the data as of our last tid.
+            before_tid = min(before_tid, p64(u64(self.tid) + 1))
+            found = self._find(oid, before_tid)
+            if found is not None:
+                ofs, size, start_tid, end_tid, flags, ldata = found
+                if end_tid == z64:
+                    if u64(before_tid) - 1 <= u64(self._shared_tid):
+                        self._n_accesses += 1
+                        self._n_current_hits += 1
+                        return (self._read_data(ofs, flags, ldata),
+                                start_tid, None)
+                elif before_tid <= end_tid:
+                    self._n_accesses += 1
+                    self._n_noncurrent_hits += 1
+                    return (self._read_data(ofs, flags, ldata),
+                            start_tid, end_tid)
+            return None
+
+    def store(self, oid, start_tid, end_tid, data):
+        with self._locked(fcntl.LOCK_EX):
+            self._sync()
+            if end_tid is None and self.tid < self._shared_tid:
+                # We're behind the file, so our idea of what's current
+                # may already be out of date.
+                return
+            if start_tid in self._index.get(oid, ()):
+                return
+
+            size = allocated_record_overhead + len(data)
+            if size >= min(max_block_size,
+                           self.maxsize - SHARED_HEADER_SIZE):
+                return
+
+            nfreebytes = self._makeroom(size+1)
+            excess = nfreebytes - size
+            if excess == 0:
+                extra = b''
+            elif excess < 5:
+                extra = "01234"[excess].encode()
+            else:
+                extra = b'f' + pack(">I", excess)
+
+            ofs = self._ofs
+            write = self.f.write
+            self.f.seek(ofs)
+            write(b'f'+pack(">I", nfreebytes))
+            write(pack(">8s8s8sHI", oid, start_tid, end_tid or z64, 0,
+                       len(data)))
+            write(data)
+            write(oid)
+            write(extra)
+            self.f.seek(ofs)
+            write(b'a'+pack(">I", size))
+
+            self._index.setdefault(oid, {})[start_tid] = ofs
+            self._by_ofs[ofs] = oid, start_tid
+            self._ofs += size
+            self._write_position()
+            self._n_adds += 1
+            self._n_added_bytes += size
+
+    ##
+    # Like ClientCache._makeroom, but lets other processes know when
+    # we wrap around to the start of the file.  This must be called with
+    # the file locked exclusively, after _sync.
+    def _makeroom(self, nbytes):
+        if self._ofs + nbytes > self.maxsize:
+            self._lap += 1
+            self._ofs = SHARED_HEADER_SIZE
+        ofs = self._ofs
+        seek = self.f.seek
+        read = self.f.read
+        while nbytes > 0:
+            seek(ofs)
+            status = read(1)
+            if status == b'a':
+                size, = unpack(">I", read(4))
+                self._forget_at(ofs)
+                self._n_evicts += 1
+                self._n_evicted_bytes += size
+            elif status == b'f':
+                size, = unpack(">I", read(4))
+            else:
+                assert status in b'1234'
+                size = int(status)
+            ofs += size
+            nbytes -= size
+        return ofs - self._ofs
+
+    ##
+    # Invalidations are queued and applied to the file by the next
+    # setLastTid, except that data for oids invalidated without a tid
+    # is dropped right away, as well.
+    def invalidate(self, oid, tid):
+        self.invalidate_many((oid, ), tid)
+
+    def invalidate_many(self, oids, tid):
+        with self._lock:
+            self._pending.extend((oid, tid) for oid in oids)
+            if tid is None:
+                with self._locked(fcntl.LOCK_EX):
+                    self._sync()
+                    for oid in oids:
+                        self._drop(oid)
+
+    # Free all the records for oid.
+    def _drop(self, oid):
+        for start_tid, ofs in list(self._index.get(oid, {}).items()):
+            self.f.seek(ofs)
+            status, size, saved_oid, saved_tid = unpack(
+                ">cI8s8s", self.f.read(21))
+            if (status, saved_oid, saved_tid) == (b'a', oid, start_tid):
+                self.f.seek(ofs)
+                self.f.write(b'f'+pack(">I", size))
+            self._forget_at(ofs)
+
+    # Set the end tid of the current record for oid written before tid.
+    def _end(self, oid, tid):
+        found = self._find(oid, tid)
+        if found is not None:
+            ofs, size, start_tid, end_tid, flags, ldata = found
+            if end_tid == z64:
+                self.f.seek(ofs+21)
+                self.f.write(tid)
+
+    def contents(self):
+        with self._locked(fcntl.LOCK_SH):
+            self._sync()
+            contents = []
+            for oid in list(self._index):
+                found = self._find_current(oid)
+                if found is not None:
+                    contents.append((oid, found[2]))
+        return iter(contents)
+
+class MappedFile(object):
+    """Minimal file interface on top of a memory-mapped cache file.
+
+    Reads and writes go to the mapping, so there are no system calls
+    and no buffering to keep consistent with the mapping.
+    """
+
+    def __init__(self, file):
+        file.flush()
+        self.file = file
+        self.map = mmap.mmap(file.fileno(), 0)
+        self.pos = 0
+
+    @property
+    def name(self):
+        return self.file.name
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.map)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size):
+        pos = self.pos
+        data = self.map[pos:pos+size]
+        self.pos = pos + len(data)
+        return data
+
+    def write(self, data):
+        pos = self.pos
+        end = pos + len(data)
+        self.map[pos:end] = data
+        self.pos = end
+
+    def flush(self):
+        # Writes to the mapping are already visible to the file.
+        pass
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def unmap(self):
+        """Close the mapping and return the underlying file
+        """
+        self.map.flush()
+        self.map.close()
+        self.file.seek(self.pos)
+        return self.file
+
+    def close(self):
+        self.unmap().close()
 
 def sync(f):
     f.flush()
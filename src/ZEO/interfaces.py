@@ -69,6 +69,16 @@ class IClientCache(zope.interface.Interface):
         nothing.
         """
 
+    def invalidate_many(oids, tid):
+        """Invalidate data for each of the objects in ``oids``
+
+        This is equivalent to calling ``invalidate`` for each object,
+        but lets the cache do the work more efficiently.
+
+        This method is optional.  If a cache doesn't provide it, the
+        client calls ``invalidate`` for each object.
+        """
+
     def getLastTid():
         """Get the last tid seen by the cache
 
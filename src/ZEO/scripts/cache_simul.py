@@ -56,18 +56,50 @@ def main(args=None):
     parser.add_argument("--rearrange", "-r",
                         default=0.8, type=float,
                         help="rearrange factor")
+    parser.add_argument("--admission-small", "-a",
+                        default=None, dest="admission_small",
+                        type=lambda s: int(float(s)*1024),
+                        help="simulate a TinyLFU admission filter that"
+                        " always admits objects smaller than this many KB")
+    parser.add_argument("--admission-width",
+                        default=1<<16, type=int,
+                        help="number of counters per row of the admission"
+                        " filter's frequency sketch (default 65536)")
+    parser.add_argument("--policy", "-p",
+                        default='circular', choices=sorted(simulations),
+                        help="eviction policy to simulate"
+                        " (default circular)")
+    parser.add_argument("--sizes", "-S",
+                        default=None,
+                        type=lambda s: [int(float(size)*MB)
+                                        for size in s.split(',')],
+                        help="rather than simulating the cache, compute"
+                        " the hit rates of LRU caches of each of these"
+                        " comma-separated sizes in MB, in one pass"
+                        " (requires numpy)")
     add_tracefile_argument(parser)
 
-    simclass = CircularCacheSimulation
-
     options = parser.parse_args(args)
 
+    if options.sizes:
+        print_hit_rate_curve(options.tracefile, options.sizes)
+        return
+
+    simclass = simulations[options.policy]
+
     f = options.tracefile
     interval_step = options.interval
 
+    def admission():
+        if options.admission_small is None:
+            return None
+        return ZEO.cache.TinyLFUAdmission(options.admission_width,
+                                          options.admission_small)
+
     # Create simulation object.
-    sim = simclass(options.cachelimit, options.rearrange)
-    interval_sim = simclass(options.cachelimit, options.rearrange)
+    sim = simclass(options.cachelimit, options.rearrange, admission())
+    interval_sim = simclass(options.cachelimit, options.rearrange,
+                            admission())
 
     # Print output header.
     sim.printheader()
@@ -283,12 +315,29 @@ class CircularCacheSimulation(Simulation):
     extras = "evicts", "inuse"
 
     evicts = 0
+    rejects = 0
+    kept = 0
 
-    def __init__(self, cachelimit, rearrange):
+    # The name of the ZEO.cache eviction policy to simulate.
+    policy_name = 'circular'
+
+    def __init__(self, cachelimit, rearrange, admission=None):
         from ZEO import cache
 
+        # An optional admission filter, as in ZEO.cache.ClientCache.
+        self.admission = admission
+        if admission is not None:
+            self.extras = self.extras + ("rejects",)
+
+        # The same eviction policy object ClientCache would use.
+        self.policy = cache.eviction_policies[self.policy_name](cachelimit)
+        if self.policy_name != 'circular':
+            self.extras = self.extras + ("kept",)
+
         Simulation.__init__(self, cachelimit, rearrange)
         self.total_evicts = 0  # number of cache evictions
+        self.total_rejects = 0  # number of stores the filter rejected
+        self.total_kept = 0  # number of records the policy kept
 
         # Current offset in file.
         self.offset = ZEC_HEADER_SIZE
@@ -319,6 +368,8 @@ class CircularCacheSimulation(Simulation):
         if self.evicts:
             self.warm = True
         self.evicts = 0
+        self.rejects = 0
+        self.kept = 0
         self.evicted_hit = self.evicted_miss = 0
 
     evicted_hit = evicted_miss = 0
@@ -328,6 +379,7 @@ class CircularCacheSimulation(Simulation):
             if oid in self.current: # else it's a cache miss
                 self.hits += 1
                 self.total_hits += 1
+                self.accessed(oid)
 
                 tid = self.current[oid]
                 entry = self.key2entry[(oid, tid)]
@@ -336,9 +388,11 @@ class CircularCacheSimulation(Simulation):
                     offset_offset += self.cachelimit
                     assert offset_offset >= 0
 
-                if offset_offset > self.rearrange * self.cachelimit:
+                size = self.filemap[entry.offset][0]
+                if self.policy.accessed(
+                    oid, size,
+                    offset_offset > self.rearrange * self.cachelimit):
                     # we haven't accessed it in a while.  Move it forward
-                    size = self.filemap[entry.offset][0]
                     self._remove(*entry.key)
                     self.add(oid, size, tid)
 
@@ -356,6 +410,7 @@ class CircularCacheSimulation(Simulation):
         if cur_tid == tid:
             self.hits += 1
             self.total_hits += 1
+            self.accessed(oid)
             return
 
         # It's a load for non-current data.  Do we know about this oid?
@@ -374,6 +429,23 @@ class CircularCacheSimulation(Simulation):
         # Cache hit.
         self.hits += 1
         self.total_hits += 1
+        self.accessed(oid)
+
+    # As in ClientCache, hits and stores count as accesses for the
+    # admission filter, but misses don't.
+    def accessed(self, oid):
+        if self.admission is not None:
+            self.admission.record(oid)
+
+    def admit(self, oid, size):
+        if self.admission is None:
+            return True
+        self.admission.record(oid)
+        if self.admission.admit(oid, size):
+            return True
+        self.rejects += 1
+        self.total_rejects += 1
+        return False
 
     # (oid, tid) is in the cache.  Remove it:  take it out of key2entry,
     # and in `filemap` mark the space it occupied as being free.  The
@@ -413,6 +485,8 @@ class CircularCacheSimulation(Simulation):
         self.invals += 1
         self.total_invals += 1
         del self.current[oid]
+        e = self.key2entry[oid, cur_tid]
+        self.policy.removed(oid, self.filemap[e.offset][0])
         if tid == z64:
             # Startup cache verification:  forget this oid entirely.
             self._remove(oid, cur_tid)
@@ -436,10 +510,13 @@ class CircularCacheSimulation(Simulation):
                     import pdb; pdb.set_trace()
                     raise ValueError('WTF')
                 return
+            if not self.admit(oid, size):
+                return
             self.current[oid] = start_tid
             self.writes += 1
             self.total_writes += 1
             self.add(oid, size, start_tid)
+            self.policy.added(oid, size + self.overhead)
             return
         if evhit:
             import pdb; pdb.set_trace()
@@ -449,6 +526,10 @@ class CircularCacheSimulation(Simulation):
         p = start_tid, end_tid
         if p in L:
             return  # we already have it in cache
+        if not self.admit(oid, size):
+            if not L:
+                del self.noncurrent[oid]
+            return
         bisect.insort_left(L, p)
         self.writes += 1
         self.total_writes += 1
@@ -476,7 +557,9 @@ class CircularCacheSimulation(Simulation):
     # `filemap`, `key2entry`, `current` and `noncurrent`.  The caller is
     # responsible for adding new entries to `filemap` to account for all
     # the freed bytes, and for advancing `self.offset`.  The number of bytes
-    # freed is the return value, and will be >= need.
+    # freed is the return value, and will be >= need.  As in ClientCache,
+    # current objects the eviction policy keeps are moved to `self.offset`,
+    # which is advanced past them, rather than evicted.
     def makeroom(self, need):
         if self.offset + need > self.cachelimit:
             self.offset = ZEC_HEADER_SIZE
@@ -484,6 +567,18 @@ class CircularCacheSimulation(Simulation):
         while need > 0:
             assert pos < self.cachelimit
             size, e = self.filemap.pop(pos)
+            if e and e.end_tid == z64:
+                oid = e.key[0]
+                if (pos + size + need <= self.cachelimit and
+                    self.policy.keep(oid, size)):
+                    e.offset = self.offset
+                    self.filemap[self.offset] = size, e
+                    self.offset += size
+                    self.kept += 1
+                    self.total_kept += 1
+                    pos += size
+                    continue
+                self.policy.evicted(oid, size)
             if e:   # there is an object here (else it's already free space)
                 self.evicts += 1
                 self.total_evicts += 1
@@ -537,6 +632,194 @@ class CircularCacheSimulation(Simulation):
             print(k, v[0], repr(v[1]))
 
 
+class SegmentedLRUCacheSimulation(CircularCacheSimulation):
+    """Simulate the ZEO cache with the segmented LRU eviction policy."""
+
+    policy_name = 'slru'
+
+class TwoQueueCacheSimulation(CircularCacheSimulation):
+    """Simulate the ZEO cache with the 2Q eviction policy."""
+
+    policy_name = '2q'
+
+# Simulations of the eviction policies in ZEO.cache.eviction_policies.
+simulations = {
+    'circular': CircularCacheSimulation,
+    'slru': SegmentedLRUCacheSimulation,
+    '2q': TwoQueueCacheSimulation,
+    }
+
+# Multi-size analysis.
+#
+# Rather than simulating a cache of each size, a trace can be analyzed
+# for all sizes at once, for caches whose contents for a given size
+# are always a subset of their contents for a bigger size (the "stack
+# property").  LRU caches have it: an object is in an LRU cache of size
+# C just after it's been referenced if it, and the distinct objects
+# referenced since, fit in C bytes.  So a load is a hit for sizes of
+# at least its "stack distance", the bytes of the object and of the
+# distinct objects referenced since the last reference to it.
+#
+# The eviction policies in ZEO.cache don't have the stack property, so
+# this gives the hit rates of LRU caches, which approximate them.  Use
+# the simulations to compare policies at particular sizes.
+
+def read_trace_arrays(f):
+    """Read a trace file into numpy arrays
+
+    Return (code, dlen, oid) arrays, with the codes masked as in the
+    simulations and oids as 64-bit integers.
+    """
+    import numpy
+    data = f.read()
+    f.close()
+    record = numpy.dtype([('ts', '>i4'), ('code', '>i4'), ('oidlen', '>u2'),
+                          ('start_tid', '>u8'), ('end_tid', '>u8'),
+                          ('oid', '>u8')])
+    records = None
+    if len(data) % record.itemsize == 0:
+        records = numpy.frombuffer(data, record)
+        if not ((records['oidlen'] == 8).all() and records['ts'].all()):
+            records = None
+
+    if records is not None:
+        code = records['code'].astype(numpy.int64)
+        oid = records['oid'].astype(numpy.uint64)
+    else:
+        # Odd oids or misaligned records, which are skipped as in main.
+        codes = []
+        oids = []
+        pos = 0
+        while pos + 26 <= len(data):
+            ts, c, oidlen = struct.unpack_from(">iiH", data, pos)
+            if ts == 0:
+                pos += 8
+                continue
+            o = data[pos+26:pos+26+oidlen]
+            if len(o) < oidlen:
+                break
+            pos += 26 + oidlen
+            codes.append(c)
+            oids.append(struct.unpack(">Q", o.rjust(8, b'\0')[-8:])[0])
+        code = numpy.array(codes, numpy.int64)
+        oid = numpy.array(oids, numpy.uint64)
+
+    return code & 0x7e, (code & 0x7fffff00) >> 8, oid
+
+def _prefix_dominance(values, weights, k, bound):
+    """Sum weights[j] for j < k[i] and values[j] < bound[i], for each i
+
+    This uses a merge-sort tree: at level L, values are sorted within
+    blocks of 2**L, and each prefix is the union of at most one block
+    per level, given by the bits of its length.
+    """
+    import numpy
+    n = len(values)
+    result = numpy.zeros(len(k), numpy.int64)
+    index = numpy.arange(n, dtype=numpy.int64)
+    # Block numbers and values are combined into sortable keys.
+    scale = numpy.int64(int(values.max()) + 2 if n else 1)
+    level = 0
+    while k.size and (1 << level) <= k.max():
+        keys = (index >> level) * scale + values
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        cumulative = numpy.concatenate(
+            ([0], numpy.cumsum(weights[order])))
+        queries = numpy.nonzero((k >> level) & 1)[0]
+        start = (k[queries] >> (level + 1)) << (level + 1)
+        pos = numpy.searchsorted(
+            keys, (start >> level) * scale + bound[queries], 'left')
+        result[queries] += cumulative[pos] - cumulative[start]
+        level += 1
+    return result
+
+def lru_hit_rates(code, dlen, oid, sizes):
+    """Return the number of loads and the numbers of hits for each size
+
+    Loads and stores of current data are references.  Invalidations
+    end an object's run of references, as references after them can't
+    use the data cached before them.
+    """
+    import numpy
+    n_events = len(code)
+    time = numpy.arange(n_events, dtype=numpy.int64)
+
+    # Number each object's invalidations, so that (oid, generation)
+    # identifies the data that can be reused.
+    by_oid = numpy.lexsort((time, oid))
+    invalidation = (code[by_oid] & 0x70) == 0x10
+    invalidations_before = numpy.cumsum(invalidation) - invalidation
+    first = numpy.ones(n_events, bool)
+    first[1:] = oid[by_oid][1:] != oid[by_oid][:-1]
+    oid_start = numpy.maximum.accumulate(numpy.where(first, time, 0))
+    generation = numpy.empty(n_events, numpy.int64)
+    generation[by_oid] = (invalidations_before -
+                          invalidations_before[oid_start])
+
+    referenced = (code == 0x20) | (code == 0x22) | (code == 0x52)
+    is_load = ((code == 0x20) | (code == 0x22))[referenced]
+    oid = oid[referenced]
+    generation = generation[referenced]
+    dlen = dlen[referenced]
+    n = len(oid)
+    position = numpy.arange(n, dtype=numpy.int64)
+
+    # Link each reference to the previous and next references to the
+    # same data.
+    order = numpy.lexsort((position, generation, oid))
+    same = ((oid[order][1:] == oid[order][:-1]) &
+            (generation[order][1:] == generation[order][:-1]))
+    prev = numpy.full(n, -1, numpy.int64)
+    prev[order[1:][same]] = order[:-1][same]
+    following = numpy.full(n, n, numpy.int64)
+    following[order[:-1][same]] = order[1:][same]
+
+    # Each reference weighs as much as the object's biggest record.
+    starts = numpy.nonzero(numpy.concatenate(([True], ~same)))[0]
+    weight = numpy.empty(n, numpy.int64)
+    if n:
+        biggest = numpy.maximum.reduceat(dlen[order], starts)
+        weight[order] = numpy.repeat(biggest, numpy.diff(
+            numpy.concatenate((starts, [n]))))
+    weight += ZEO.cache.allocated_record_overhead
+
+    # For a load at t of data last referenced at p, the distinct data
+    # referenced in between is that referenced at the j in (p, t) with
+    # following[j] >= t.  Its weight is that of all the references in
+    # (p, t), less that of the j > p with following[j] < t (which are
+    # all in (p, t)), which is that of all the j with following[j] < t,
+    # less that of the j <= p with following[j] < t.
+    loads = numpy.nonzero(is_load)[0]
+    t = loads[prev[loads] >= 0]
+    p = prev[t]
+    cumulative = numpy.concatenate(([0], numpy.cumsum(weight)))
+    by_following = numpy.argsort(following, kind='mergesort')
+    following_cumulative = numpy.concatenate(
+        ([0], numpy.cumsum(weight[by_following])))
+    ending_before = following_cumulative[
+        numpy.searchsorted(following[by_following], t, 'left')]
+    distance = (cumulative[t] - cumulative[p + 1] - ending_before +
+                _prefix_dominance(following, weight, p + 1, t) +
+                weight[t])
+
+    distance.sort()
+    hits = numpy.searchsorted(distance, numpy.array(sizes), 'right')
+    return len(loads), [int(h) for h in hits]
+
+def print_hit_rate_curve(f, sizes):
+    try:
+        import numpy
+    except ImportError:
+        sys.exit("Computing hit rates for several sizes requires numpy")
+    sizes = sorted(sizes)
+    loads, hits = lru_hit_rates(*read_trace_arrays(f), sizes=sizes)
+    print("LRU hit rates by cache size, from %s loads" % addcommas(loads))
+    print("%12s %10s %7s" % ("SIZE", "HITS", "HITRATE"))
+    for size, h in zip(sizes, hits):
+        print("%12s %10s %7s" % (addcommas(size), addcommas(h),
+                                 hitrate(loads, h)))
+
 def roundup(size):
     k = MINSIZE
     while k < size:
@@ -48,6 +48,10 @@ i.e. the low bit is always zero.
 import sys
 import time
 import argparse
+import collections
+import csv
+import json
+import multiprocessing
 import struct
 import gzip
 
@@ -111,6 +115,14 @@ def main(args=None):
                         default=False, action="store_true", dest="heuristic",
                         help=" enable heuristic checking for misaligned records: oids > 2**32"
                         " will be rejected; this requires the tracefile to be seekable")
+    parser.add_argument("--jobs", "-j",
+                        default=None, type=int,
+                        help="read the trace in chunks and analyze them in"
+                        " this many worker processes")
+    parser.add_argument("--format", "-f",
+                        default="text", choices=("text", "json", "csv"),
+                        help="output format; csv writes only the per-interval"
+                        " statistics (default text)")
     add_interval_argument(parser)
     add_tracefile_argument(parser)
 
@@ -120,6 +132,11 @@ def main(args=None):
 
     options = parser.parse_args(args)
 
+    if options.jobs is not None or options.format != 'text':
+        if options.verbose:
+            parser.error("--verbose can't be used with --jobs or --format")
+        return main_chunked(options)
+
     f = options.tracefile
 
     rt0 = time.time()
@@ -228,19 +245,315 @@ def main(args=None):
         print("No records processed", file=sys.stderr)
         return 1
 
+    stats = TraceStats()
+    (stats.records, stats.versions, stats.datarecords, stats.datasize,
+     stats.total_loads, stats.t0, stats.te) = (
+         records, versions, datarecords, datasize, total_loads, t0, te)
+    stats.bycode, stats.oids = bycode, oids
+    stats.bysize, stats.bysizew = bysize, bysizew
+    print_stats(options, stats, end_pos, rte-rt0)
+
+def main_chunked(options):
+    """Analyze the trace in chunks, possibly in parallel.
+
+    The output is the same as the record-at-a-time analysis in main,
+    or its JSON or CSV equivalent.
+    """
+    rt0 = time.time()
+    stats = TraceStats()
+    histograms = options.print_histogram, options.print_size_histogram
+    chunks = read_chunks(options.tracefile)
+    jobs = options.jobs or 1
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                # Keep a few chunks per worker in flight, rather than
+                # reading the whole trace into memory up front.
+                pending = collections.deque()
+                for data in chunks:
+                    pending.append(pool.apply_async(
+                        analyze_chunk, (data, options.interval) + histograms))
+                    if len(pending) > 2 * jobs:
+                        stats.update(pending.popleft().get())
+                while pending:
+                    stats.update(pending.popleft().get())
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for data in chunks:
+                stats.update(
+                    analyze_chunk(data, options.interval, *histograms))
+    except KeyboardInterrupt:
+        print("\nInterrupted.  Stats so far:\n", file=sys.stderr)
+
+    end_pos = chunks.bytes_read
+    options.tracefile.close()
+    rte = time.time()
+
+    if not stats.records:
+        print("No records processed", file=sys.stderr)
+        return 1
+
+    if options.format == 'json':
+        write_json(options, stats, end_pos)
+    elif options.format == 'csv':
+        write_csv(stats)
+    else:
+        print(' '*16, "%7s %7s %7s %7s" % ('loads', 'hits', 'inv(h)', 'writes'),
+              end=' ')
+        print('hitrate')
+        if not options.quiet:
+            for interval, h0, he, byinterval, restart in stats.intervals:
+                dumpbyinterval(byinterval, h0, he)
+                if restart is not None:
+                    print(ctime(restart)[4:-5], end=' ')
+                    print('='*20, "Restart", '='*20)
+        print_stats(options, stats, end_pos, rte-rt0)
+
+# Most trace records have an 8-byte oid.  These are decoded in bulk; any
+# other records (restarts have no oid) and misaligned data left by a
+# crash are handled one at a time.
+HEADER = struct.Struct(">iiH")
+FIXED = struct.Struct(">iiH8s8s8s")
+FIXED_SIZE = FIXED.size
+CHUNK_SIZE = FIXED_SIZE << 15
+
+def fixed_records(data, pos):
+    """Count the consecutive 8-byte-oid records in data starting at pos.
+
+    Rather than unpacking each header, the high timestamp byte and the
+    oid length of every record are checked at once using strided
+    slices, in growing windows so that short runs stay cheap.
+    """
+    limit = (len(data) - pos) // FIXED_SIZE
+    count = 0
+    window = 16
+    while count < limit:
+        n = min(window, limit - count)
+        start = pos + count * FIXED_SIZE
+        end = start + n * FIXED_SIZE
+        good = data[start:end:FIXED_SIZE].find(b'\0')
+        if good < 0:
+            good = n
+        for offset, byte in ((8, b'\0'), (9, b'\x08')):
+            s = data[start+offset:end:FIXED_SIZE]
+            good = min(good, len(s) - len(s.lstrip(byte)))
+        count += good
+        if good < n:
+            break
+        window <<= 1
+    return count
+
+if hasattr(FIXED, 'iter_unpack'):
+    def unpack_fixed(data, start, end):
+        return FIXED.iter_unpack(memoryview(data)[start:end])
+else:
+    def unpack_fixed(data, start, end):
+        unpack_from = FIXED.unpack_from
+        return (unpack_from(data, pos)
+                for pos in six.moves.range(start, end, FIXED_SIZE))
+
+def iter_records(data):
+    """Generate (ts, code, oidlen, start_tid, end_tid, oid) from data.
+
+    data must end at a record boundary, as the chunks produced by
+    read_chunks do.
+    """
+    pos = 0
+    size = len(data)
+    while pos < size:
+        n = fixed_records(data, pos)
+        if n:
+            end = pos + n * FIXED_SIZE
+            for record in unpack_fixed(data, pos, end):
+                yield record
+            pos = end
+            continue
+        if pos + 26 > size:
+            # Misaligned bytes skipped at the end of the chunk.
+            break
+        ts, code, oidlen = HEADER.unpack_from(data, pos)
+        if ts == 0:
+            # Must be a misaligned record caused by a crash.
+            pos += 8
+            continue
+        start_tid = data[pos+10:pos+18]
+        end_tid = data[pos+18:pos+26]
+        oid = data[pos+26:pos+26+oidlen]
+        pos += 26 + oidlen
+        yield ts, code, oidlen, start_tid, end_tid, oid
+
+class read_chunks(object):
+    """Iterate over a trace file in chunks of whole records.
+
+    Misaligned records are reported on stderr, so as not to get mixed
+    up with machine-readable output.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+
+    def __iter__(self):
+        f_read = self.f.read
+        data = b''
+        offset = 0 # file offset of the start of data
+        while 1:
+            new = f_read(self.chunk_size)
+            self.bytes_read += len(new)
+            data += new
+            pos = 0
+            while 1:
+                pos += fixed_records(data, pos) * FIXED_SIZE
+                if pos + 26 > len(data):
+                    break
+                ts, code, oidlen = HEADER.unpack_from(data, pos)
+                if ts == 0:
+                    print("Skipping 8 bytes at offset", offset + pos,
+                          file=sys.stderr)
+                    pos += 8
+                    continue
+                if pos + 26 + oidlen > len(data):
+                    break
+                pos += 26 + oidlen
+            if pos:
+                yield data[:pos]
+                data = data[pos:]
+                offset += pos
+            if not new:
+                break
+
+class TraceStats(object):
+    """Statistics gathered from a trace, or a chunk of one.
+
+    Statistics for consecutive chunks can be combined with update.
+    """
+
+    def __init__(self):
+        self.bycode = {}     # map code to count of occurrences
+        self.records = 0     # number of trace records read
+        self.versions = 0    # number of trace records with versions
+        self.datarecords = 0 # number of records with dlen set
+        self.datasize = 0    # sum of dlen across records with dlen set
+        self.oids = {}       # map oid to number of times it was loaded
+        self.bysize = {}     # map data size to number of loads
+        self.bysizew = {}    # map data size to number of writes
+        self.total_loads = 0
+        self.t0 = None       # first timestamp seen
+        self.te = None       # most recent timestamp seen
+        # [ts//interval, first ts, last ts, map code to count,
+        #  ts of the restart ending the interval or None]
+        self.intervals = []
+
+    def update(self, other):
+        self.records += other.records
+        self.versions += other.versions
+        self.datarecords += other.datarecords
+        self.datasize += other.datasize
+        self.total_loads += other.total_loads
+        if self.t0 is None:
+            self.t0 = other.t0
+        if other.te is not None:
+            self.te = other.te
+        _add_counts(self.bycode, other.bycode)
+        _add_counts(self.oids, other.oids)
+        for mine, theirs in ((self.bysize, other.bysize),
+                             (self.bysizew, other.bysizew)):
+            for dlen, d in six.iteritems(theirs):
+                _add_counts(mine.setdefault(dlen, {}), d)
+        intervals = other.intervals
+        if self.intervals and intervals:
+            last = self.intervals[-1]
+            first = intervals[0]
+            if last[4] is None and last[0] == first[0]:
+                # The interval spans the chunk boundary.
+                last[2] = first[2]
+                _add_counts(last[3], first[3])
+                last[4] = first[4]
+                intervals = intervals[1:]
+        self.intervals.extend(intervals)
+
+def _add_counts(mine, theirs):
+    for k, n in six.iteritems(theirs):
+        mine[k] = mine.get(k, 0) + n
+
+def analyze_chunk(data, interval, load_histogram=False, size_histogram=False):
+    """Compute TraceStats for a chunk of a trace.
+
+    This runs in worker processes, so only gathers the per-oid data
+    needed by the requested histograms.
+    """
+    stats = TraceStats()
+    bycode = stats.bycode
+    oids = stats.oids
+    bysize = stats.bysize
+    bysizew = stats.bysizew
+    records = versions = datarecords = datasize = total_loads = 0
+    current = None
+    byinterval = None
+    ts = None
+    for ts, code, oidlen, start_tid, end_tid, oid in iter_records(data):
+        records += 1
+        if stats.t0 is None:
+            stats.t0 = ts
+        if current is None or ts // interval != current[0]:
+            current = [ts // interval, ts, ts, {}, None]
+            stats.intervals.append(current)
+            byinterval = current[3]
+        current[2] = ts
+        dlen, code = (code & 0x7fffff00) >> 8, code & 0xff
+        if dlen:
+            datarecords += 1
+            datasize += dlen
+        if code & 0x80:
+            versions += 1
+        code &= 0x7e
+        bycode[code] = bycode.get(code, 0) + 1
+        byinterval[code] = byinterval.get(code, 0) + 1
+        if dlen and size_histogram:
+            if code & 0x70 == 0x20: # All loads
+                bysize[dlen] = d = bysize.get(dlen) or {}
+                d[oid] = d.get(oid, 0) + 1
+            elif code & 0x70 == 0x50: # All stores
+                bysizew[dlen] = d = bysizew.get(dlen) or {}
+                d[oid] = d.get(oid, 0) + 1
+        if code & 0x70 == 0x20:
+            if load_histogram:
+                oids[oid] = oids.get(oid, 0) + 1
+            total_loads += 1
+        elif code == 0x00:    # restart
+            current[4] = ts
+            current = [ts // interval, ts, ts, {}, None]
+            stats.intervals.append(current)
+            byinterval = current[3]
+    stats.te = ts
+    stats.records = records
+    stats.versions = versions
+    stats.datarecords = datarecords
+    stats.datasize = datasize
+    stats.total_loads = total_loads
+    return stats
+
+def print_stats(options, stats, end_pos, seconds):
+    records = stats.records
+    bycode = stats.bycode
+
     # Print statistics
     if options.dostats:
         print()
         print("Read %s trace records (%s bytes) in %.1f seconds" % (
-            addcommas(records), addcommas(end_pos), rte-rt0))
-        print("Versions:   %s records used a version" % addcommas(versions))
-        print("First time: %s" % ctime(t0))
-        print("Last time:  %s" % ctime(te))
-        print("Duration:   %s seconds" % addcommas(te-t0))
+            addcommas(records), addcommas(end_pos), seconds))
+        print("Versions:   %s records used a version" % addcommas(stats.versions))
+        print("First time: %s" % ctime(stats.t0))
+        print("Last time:  %s" % ctime(stats.te))
+        print("Duration:   %s seconds" % addcommas(stats.te-stats.t0))
         print("Data recs:  %s (%.1f%%), average size %d bytes" % (
-            addcommas(datarecords),
-            100.0 * datarecords / records,
-            datasize / datarecords))
+            addcommas(stats.datarecords),
+            100.0 * stats.datarecords / records,
+            stats.datasize / stats.datarecords))
         print("Hit rate:   %.1f%% (load hits / loads)" % hitrate(bycode))
         print()
         codes = sorted(bycode.keys())
@@ -253,6 +566,8 @@ def main(args=None):
 
     # Print histogram.
     if options.print_histogram:
+        oids = stats.oids
+        total_loads = stats.total_loads
         print()
         print("Histogram of object load frequency")
         total = len(oids)
@@ -276,8 +591,54 @@ def main(args=None):
         print()
         print("Histograms of object sizes")
         print()
-        dumpbysize(bysizew, "written", "writes")
-        dumpbysize(bysize, "loaded", "loads")
+        dumpbysize(stats.bysizew, "written", "writes")
+        dumpbysize(stats.bysize, "loaded", "loads")
+
+def write_json(options, stats, end_pos, out=None):
+    summary = dict(
+        records=stats.records,
+        bytes=end_pos,
+        versions=stats.versions,
+        first_time=stats.t0,
+        last_time=stats.te,
+        duration=stats.te - stats.t0,
+        data_records=stats.datarecords,
+        average_size=(stats.datasize // stats.datarecords
+                      if stats.datarecords else 0),
+        hit_rate=hitrate(stats.bycode),
+        codes=dict(("%02x" % code, count)
+                   for code, count in stats.bycode.items()),
+        intervals=[dict(zip(interval_columns, row))
+                   for row in interval_rows(stats)],
+        )
+    if options.print_histogram:
+        summary['load_histogram'] = [
+            dict(loads=loads, objects=count)
+            for loads, count in histogram(stats.oids)]
+    if options.print_size_histogram:
+        summary['size_histograms'] = dict(
+            (how, [dict(size=size, objects=len(d), count=sum(d.values()))
+                   for size, d in sorted(bysize.items())])
+            for how, bysize in (('written', stats.bysizew),
+                                ('loaded', stats.bysize)))
+    json.dump(summary, out or sys.stdout, indent=2, sort_keys=True)
+    print(file=out or sys.stdout)
+
+def write_csv(stats, out=None):
+    writer = csv.writer(out or sys.stdout, lineterminator='\n')
+    writer.writerow(interval_columns)
+    for row in interval_rows(stats):
+        writer.writerow(['' if v is None else v for v in row])
+
+interval_columns = ('start', 'end', 'loads', 'hits', 'invalidations',
+                    'writes', 'hit_rate', 'restart')
+
+def interval_rows(stats):
+    for interval, h0, he, byinterval, restart in stats.intervals:
+        loads, hits, invals, writes = interval_counts(byinterval)
+        yield (h0, he, loads, hits, invals, writes,
+               100.0 * hits / loads if loads else None,
+               restart is not None)
 
 def dumpbysize(bysize, how, how2):
     print()
@@ -292,7 +653,7 @@ def dumpbysize(bysize, how, how2):
                                 len(bysize.get(size, "")),
                                 loads))
 
-def dumpbyinterval(byinterval, h0, he):
+def interval_counts(byinterval):
     loads = hits = invals = writes = 0
     for code in byinterval:
         if code & 0x20:
@@ -305,7 +666,10 @@ def dumpbyinterval(byinterval, h0, he):
         elif code & 0x10:
             if code != 0x10:
                 invals += byinterval[code]
+    return loads, hits, invals, writes
 
+def dumpbyinterval(byinterval, h0, he):
+    loads, hits, invals, writes = interval_counts(byinterval)
     if loads:
         hr = "%5.1f%%" % (100.0 * hits / loads)
     else:
@@ -62,8 +62,10 @@ class WorkerThread(TestThread):
         # coordinate the action of multiple threads that all call
         # vote().  This method sends the vote call, then sets the
         # event saying vote was called, then waits for the vote
-        # response.
+        # response.  Like tpc_vote, it first sends any stores the
+        # storage has batched.
 
+        self.storage._flush_stores(self.trans)
         future = self.storage._server.call_future('vote', id(self.trans))
         self.ready.set()
         future.result(9)
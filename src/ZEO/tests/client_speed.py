@@ -0,0 +1,89 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Measure the rate of calls made through a client's networking thread
+
+usage: python -m ZEO.tests.client_speed [options]
+
+Application threads call a client storage's ClientRunner, which runs
+the calls in the client's event-loop thread and waits for their
+results.  By default, the calls are loads of an object that's in the
+client cache, so no messages are sent and the rate reflects the cost
+of getting calls to the loop thread and results back.
+
+Options:
+
+    -n n       The number of calls made by each thread.  The default
+               is 10000.
+
+    -t n       The number of application threads.  The default is 1.
+
+    -r         Make calls to the server (lastTransaction) rather than
+               loads from the cache.
+"""
+from __future__ import print_function
+
+import getopt
+import sys
+import threading
+import time
+
+from ZODB.utils import maxtid, z64
+
+import ZEO
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 'n:t:r')
+    count, nthreads, remote = 10000, 1, False
+    for o, v in opts:
+        if o == '-n':
+            count = int(v)
+        elif o == '-t':
+            nthreads = int(v)
+        elif o == '-r':
+            remote = True
+
+    addr, stop = ZEO.server()
+    db = ZEO.DB(addr)
+    try:
+        with db.transaction() as conn:
+            conn.root.x = 1
+        runner = db.storage._server
+        if remote:
+            call = lambda: runner.call('lastTransaction')
+        else:
+            call = lambda: runner.load_before(z64, maxtid)
+
+        def run():
+            for i in range(count):
+                call()
+
+        threads = [threading.Thread(target=run) for i in range(nthreads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        print("%-9s %3d threads: %9.0f calls/s" % (
+            'server' if remote else 'cache', nthreads,
+            count * nthreads / elapsed))
+    finally:
+        db.close()
+        stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Measure the speed of the low-level ZEO network protocol
+
+usage: python -m ZEO.tests.protocol_speed [options]
+
+Sized messages are fed to a protocol in chunks, as a transport
+would, and the rate at which they're received is reported.
+
+Options:
+
+    -s size    The size of messages, in bytes.  The default is 1MB.
+
+    -n n       The number of messages.  The default is 100.
+
+    -c size    The size of the chunks messages are received in.  The
+               default is 256KB, the most asyncio reads at a time.
+
+    -r n       The number of repetitions.  The best time is reported.
+"""
+from __future__ import print_function
+
+import getopt
+import struct
+import sys
+import time
+
+from ZEO.asyncio.base import Protocol
+
+def messages(size, count):
+    message = b'x' * size
+    return b''.join([struct.pack(">I", size) + message] * count)
+
+def receiver(count):
+    protocol = Protocol(None, None)
+    received = []
+    protocol.message_received = received.append
+    return protocol, received
+
+def data_received(data, chunk_size, count):
+    protocol, received = receiver(count)
+    data_received = protocol.data_received
+    for i in range(0, len(data), chunk_size):
+        data_received(data[i:i+chunk_size])
+    return received
+
+def buffer_updated(data, chunk_size, count):
+    # Like a transport for a buffered protocol, which reads into
+    # buffers provided by the protocol.
+    protocol, received = receiver(count)
+    get_buffer = protocol.get_buffer
+    buffer_updated = protocol.buffer_updated
+    pos, end = 0, len(data)
+    while pos < end:
+        buf = get_buffer(chunk_size)
+        n = min(len(buf), chunk_size, end - pos)
+        buf[:n] = data[pos:pos+n]
+        buffer_updated(n)
+        pos += n
+    return received
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = getopt.getopt(args, 's:n:c:r:')
+    size, count, chunk_size, repeat = 1 << 20, 100, 1 << 18, 3
+    for o, v in opts:
+        if o == '-s':
+            size = int(v)
+        elif o == '-n':
+            count = int(v)
+        elif o == '-c':
+            chunk_size = int(v)
+        elif o == '-r':
+            repeat = int(v)
+
+    data = messages(size, count)
+    tests = [data_received]
+    if hasattr(Protocol, 'get_buffer'):
+        tests.append(buffer_updated)
+    for test in tests:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            received = test(data, chunk_size, count)
+            elapsed = time.time() - start
+            assert len(received) == count
+            assert all(len(message) == size for message in received)
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-15s %6d messages of %8d bytes in %7d byte chunks: "
+              "%9.1f MB/s, %9.0f messages/s" % (
+                  test.__name__, count, size, chunk_size,
+                  len(data) / best / (1 << 20), count / best))
+
+if __name__ == '__main__':
+    main()
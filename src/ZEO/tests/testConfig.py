@@ -15,6 +15,7 @@
 import unittest
 
 
+import ZEO.cache
 from zope.testing import setupstack
 from ZODB.config import storageFromString
 
@@ -57,6 +58,24 @@ class ZEOConfigTestBase(setupstack.TestCase):
         connected=True,
         cache_size=20 * (1<<20),
         cache_path=None,
+        cache_segments=1,
+        cache_shared=False,
+        cache_policy='circular',
+        cache_warmup=0,
+        cache_warmup_rate=1000,
+        cache_compact_interval=0,
+        cache_mmap=False,
+        cache_l1_size=0,
+        cache_admission_small=None,
+        cache_compress=False,
+        cache_compress_threshold=256,
+        cache_noncurrent_size=None,
+        cache_compact_index=False,
+        store_batch_count=1000,
+        store_batch_size=1<<20,
+        reference_prefetch_depth=0,
+        reference_prefetch_budget=1<<20,
+        connections=1,
         blob_dir=None,
         shared_blob_dir=False,
         blob_cache_size=None,
@@ -74,6 +93,47 @@ class ZEOConfigTestBase(setupstack.TestCase):
         self.assertEqual(client._cache.maxsize, cache_size)
 
         self.assertEqual(client._cache.path, cache_path)
+        self.assertEqual(
+            len(getattr(client._cache, 'segments', [client._cache])),
+            cache_segments)
+        self.assertEqual(
+            isinstance(client._cache, ZEO.cache.SharedClientCache),
+            bool(cache_shared and cache_path))
+        if not cache_shared:
+            for segment in getattr(client._cache, 'segments',
+                                   [client._cache]):
+                self.assertIsInstance(
+                    segment.policy,
+                    ZEO.cache.eviction_policies[cache_policy])
+                self.assertEqual(segment.use_mmap, cache_mmap)
+                self.assertEqual(segment.l1_size,
+                                 cache_l1_size // cache_segments)
+                self.assertEqual(
+                    getattr(segment.admission, 'small', None),
+                    cache_admission_small)
+                self.assertEqual(segment.compress, cache_compress)
+                self.assertEqual(segment.compress_threshold,
+                                 cache_compress_threshold)
+                self.assertEqual(
+                    segment.noncurrent_size,
+                    cache_noncurrent_size and
+                    cache_noncurrent_size // cache_segments)
+                self.assertEqual(
+                    isinstance(segment.current, ZEO.cache.PackedIndex),
+                    cache_compact_index)
+        self.assertEqual(client._warmup_size, cache_warmup)
+        self.assertEqual(
+            client._warmup_batch_size / client._warmup_interval,
+            cache_warmup_rate)
+        self.assertEqual(client._cache_compact_interval,
+                         cache_compact_interval)
+        self.assertEqual(client._store_batch_count, store_batch_count)
+        self.assertEqual(client._store_batch_size, store_batch_size)
+        self.assertEqual(client._reference_prefetch_depth,
+                         reference_prefetch_depth)
+        self.assertEqual(client._reference_prefetch_budget,
+                         reference_prefetch_budget)
+        self.assertEqual(client._server.client.connections, connections)
         self.assertEqual(client.blob_dir, blob_dir)
         self.assertEqual(client.shared_blob_dir, shared_blob_dir)
         self.assertEqual(client._blob_cache_size, blob_cache_size)
@@ -104,6 +164,23 @@ class ZEOConfigTest(ZEOConfigTestBase):
         for name, value in dict(
             cache_size=4200,
             cache_path='test',
+            cache_segments=4,
+            cache_policy='2q',
+            cache_warmup=1000,
+            cache_warmup_rate=50,
+            cache_compact_interval=2.5,
+            cache_mmap=True,
+            cache_l1_size=4200,
+            cache_admission_small=4200,
+            cache_compress=True,
+            cache_compress_threshold=1000,
+            cache_noncurrent_size=4200,
+            cache_compact_index=True,
+            store_batch_count=1,
+            store_batch_size=4200,
+            reference_prefetch_depth=2,
+            reference_prefetch_budget=4200,
+            connections=3,
             blob_dir='blobs',
             blob_cache_size=424242,
             read_only=True,
@@ -120,6 +197,25 @@ class ZEOConfigTest(ZEOConfigTestBase):
         self.test_default_zeo_config(blob_cache_size=424242,
                                      blob_cache_size_check=50)
 
+    def test_shared_cache(self):
+        self.test_default_zeo_config(cache_path='test', cache_shared=True)
+
+    def test_segmented_cache_budgets(self):
+        # Byte budgets are divided among segments, like the cache size.
+        self.test_default_zeo_config(cache_segments=4, cache_l1_size=4000,
+                                     cache_noncurrent_size=4000)
+
+    def test_replicas(self):
+        addr, stop = self.start_server()
+        replica_addr, replica_stop = self.start_server()
+        client = self.start_client(
+            addr, settings='\nreplica %s:%s\n' % replica_addr)
+        self._client_assertions(client, addr)
+        self.assertEqual(client._server.client.replicas, [replica_addr])
+        client.close()
+        replica_stop()
+        stop()
+
 def test_suite():
     suite = unittest.makeSuite(ZEOConfigTest)
     suite.layer = threaded_server_tests
@@ -1001,6 +1001,226 @@ def test_prefetch(self):
     >>> conn.close()
     """
 
+def test_cache_warmup():
+    """The most frequently loaded objects can be loaded at startup
+
+    >>> import ZEO
+    >>> addr, stop = start_server()
+    >>> conn = ZEO.connection(addr)
+    >>> root = conn.root()
+    >>> cls = root.__class__
+    >>> for i in range(20):
+    ...     root[i] = cls()
+    >>> conn.transaction_manager.commit()
+    >>> oids = [root[i]._p_oid for i in range(20)]
+    >>> conn.close()
+
+    When a client with warm-up enabled is closed, it records the
+    objects it loaded most:
+
+    >>> storage = ZEO.client(addr, cache='cache', cache_warmup=5)
+    >>> for i, oid in enumerate(oids):
+    ...     for _ in range(i):
+    ...         _ = storage.load(oid)
+    >>> storage.close()
+    >>> from ZEO.ClientStorage import read_hot_oids
+    >>> read_hot_oids('cache.hot', 5) == oids[:-6:-1]
+    True
+
+    The next time it connects, it loads them in the background, even
+    if its cache was lost:
+
+    >>> os.remove('cache')
+    >>> os.remove('cache.index')
+    >>> storage = ZEO.client(addr, cache='cache', cache_warmup=5,
+    ...                      cache_warmup_rate=2)
+    >>> from zope.testing.wait import wait
+    >>> wait(lambda : len(storage._cache) == 5)
+    >>> sorted(oid for oid, tid in storage._cache.contents()) == oids[-5:]
+    True
+
+    If it isn't used much, the objects that were hot last time are
+    remembered.  (Loads are counted without taking the lock used to
+    save the counts.)
+
+    >>> import threading
+    >>> with storage._load_counts_lock:
+    ...     thread = threading.Thread(target=storage.load, args=(oids[0],))
+    ...     thread.start()
+    ...     thread.join(10)
+    >>> thread.is_alive()
+    False
+    >>> storage.close()
+    >>> read_hot_oids('cache.hot', 5) == [oids[0]] + oids[:-5:-1]
+    True
+    """
+
+def test_store_batching():
+    """Stores made while committing are sent to the server in batches
+
+    >>> import ZEO
+    >>> addr, stop = start_server()
+    >>> db = ZEO.DB(addr, store_batch_count=10)
+    >>> storage = db.storage
+    >>> messages = []
+    >>> async_ = storage._async
+    >>> def record(method, *args):
+    ...     messages.append(
+    ...         (method, len(args[0])) if method == 'storeMany' else method)
+    ...     return async_(method, *args)
+    >>> storage._async = record
+
+    >>> conn = db.open()
+    >>> root = conn.root()
+    >>> cls = root.__class__
+    >>> for i in range(25):
+    ...     root[i] = cls()
+    >>> conn.transaction_manager.commit()
+    >>> messages
+    ['tpc_begin', ('storeMany', 10), ('storeMany', 10), ('storeMany', 6)]
+
+    Batches are also sent when they reach a size limit:
+
+    >>> del messages[:]
+    >>> storage._store_batch_size = 1
+    >>> for i in range(3):
+    ...     root[i].x = i
+    >>> conn.transaction_manager.commit()
+    >>> messages
+    ['tpc_begin', ('storeMany', 1), ('storeMany', 1), ('storeMany', 1)]
+
+    The data were stored:
+
+    >>> conn2 = db.open(transaction.TransactionManager())
+    >>> root2 = conn2.root()
+    >>> len(root2), root2[2].x
+    (25, 2)
+
+    >>> db.close()
+    """
+
+def test_reference_prefetch():
+    """Objects referenced by objects loaded from the server can be prefetched
+
+    >>> import ZEO
+    >>> addr, stop = start_server()
+    >>> conn = ZEO.connection(addr)
+    >>> root = conn.root()
+    >>> cls = root.__class__
+    >>> root.x = cls()
+    >>> for i in range(10):
+    ...     root.x[i] = cls()
+    >>> conn.transaction_manager.commit()
+    >>> conn.close()
+
+    Loading the root object prefetches the object it references and
+    the objects that object references:
+
+    >>> db = ZEO.DB(addr, reference_prefetch_depth=2)
+    >>> storage = db.storage
+    >>> from zope.testing.wait import wait
+    >>> wait(lambda : storage.reference_prefetch_stats()['prefetched'] == 11)
+    >>> loads = storage.server_status()['loads']
+
+    So using them doesn't require loads from the server:
+
+    >>> conn = db.open()
+    >>> for ob in conn.root().x.values():
+    ...     ob._p_activate()
+    >>> storage.server_status()['loads'] == loads
+    True
+    >>> sorted(storage.reference_prefetch_stats().items())
+    [('hits', 11), ('pending', 0), ('prefetched', 11), ('wasted', 0)]
+
+    >>> db.close()
+    """
+
+def test_multiple_connections():
+    """Clients can make several connections and spread loads over them
+
+    >>> import ZEO
+    >>> addr, stop = start_server()
+    >>> db = ZEO.DB(addr, connections=3)
+    >>> storage = db.storage
+    >>> from zope.testing.wait import wait
+    >>> wait(lambda : len(storage._server.client.secondaries) == 2)
+    >>> wait(lambda : storage.server_status()['connections'] == 3)
+
+    >>> conn = db.open()
+    >>> root = conn.root()
+    >>> cls = root.__class__
+    >>> for i in range(10):
+    ...     root[i] = cls()
+    >>> conn.transaction_manager.commit()
+    >>> oids = [root[i]._p_oid for i in range(10)]
+    >>> storage._cache.clear()
+    >>> loads = storage.server_status()['loads']
+    >>> for oid in oids:
+    ...     _ = storage.load(oid)
+    >>> storage.server_status()['loads'] - loads
+    10
+
+    Changes made by other clients are seen:
+
+    >>> db2 = ZEO.DB(addr)
+    >>> with db2.transaction() as conn2:
+    ...     conn2.root()[1].x = 1
+    >>> wait(lambda : storage.lastTransaction() == db2.storage.lastTransaction())
+    >>> conn.sync()
+    >>> root[1].x
+    1
+
+    >>> db2.close()
+    >>> db.close()
+    """
+
+def test_async_client_storage():
+    """Asyncio applications can use storages run in their event loops
+
+    >>> from ZEO.asyncio.compat import asyncio
+    >>> from ZEO.asyncio.storage import AsyncClientStorage
+    >>> addr, stop = start_server()
+    >>> loop = asyncio.new_event_loop()
+    >>> run = loop.run_until_complete
+    >>> storage = AsyncClientStorage(addr, loop=loop)
+    >>> run(storage.wait())
+
+    >>> oid = run(storage.new_oids())[0]
+    >>> txn = TransactionMetaData()
+    >>> run(storage.tpc_begin(txn))
+    >>> storage.store(oid, z64, b'data', txn)
+    >>> run(storage.tpc_vote(txn))
+    >>> tid = run(storage.tpc_finish(txn))
+    >>> run(storage.load_before(oid)) == (b'data', tid, None)
+    True
+
+    We're told about changes made by other clients:
+
+    >>> invalidated = []
+    >>> class Listener(object):
+    ...     def invalidate(self, tid, oids):
+    ...         invalidated.append((tid, oids))
+    >>> storage.registerDB(Listener())
+
+    >>> db = ZEO.DB(addr)
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> tid = db.storage.lastTransaction()
+    >>> for i in range(100):
+    ...     if storage.last_transaction() == tid:
+    ...         break
+    ...     run(asyncio.sleep(.01, loop=loop))
+    >>> invalidated[-1] == (tid, [z64])
+    True
+    >>> run(storage.load_before(z64)) == db.storage.loadBefore(z64, maxtid)
+    True
+
+    >>> storage.close()
+    >>> run(asyncio.sleep(.01, loop=loop)) # let the connection close
+    >>> loop.close()
+    >>> db.close()
+    """
+
 def client_has_newer_data_than_server():
     """It is bad if a client has newer data than the server.
 
@@ -491,10 +491,66 @@ ZEOStorage as closed and see if trying to get a lock cleans it up:
     >>> logging.getLogger('ZEO').removeHandler(handler)
     """
 
+def load_before_many_replies_for_each_object():
+    r"""
+loadBeforeMany loads several objects in one request.  It's called
+asynchronously, and sends a reply for each object, as if to a
+loadBefore call with the (oid, tid) pair as its message id:
+
+    >>> server = ZEO.tests.servertesting.StorageServer()
+    >>> zs = ZEO.tests.servertesting.client(server)
+    >>> zs.get_info()['supports_load_before_many']
+    True
+    >>> db = ZODB.DB(server.storages['1'])
+    >>> transport = zs.connection.loop.transport
+    >>> _ = transport.pop()
+
+    >>> z64, maxtid = ZODB.utils.z64, ZODB.utils.maxtid
+    >>> one = ZODB.utils.p64(1)
+    >>> zs.loadBeforeMany([(z64, maxtid), (one, maxtid)])
+    >>> from ZEO.asyncio.marshal import pickle_decode
+    >>> for message in transport.pop()[1::2]: # (after message sizes)
+    ...     msgid, flag, name, result = pickle_decode(message)
+    ...     print(msgid == (z64, maxtid), msgid == (one, maxtid), flag,
+    ...           name, result[1] == db.storage.lastTransaction(),
+    ...           result[0])
+    True False 0 .reply True ...
+    False True 2 .reply False ZODB.POSException.POSKeyError
+
+    >>> db.close()
+    """
+
+def store_many_is_logged_as_one_record():
+    r"""
+storeMany stores several objects in one request.  The stores are
+written to the commit log as a single record and applied at vote:
+
+    >>> server = ZEO.tests.servertesting.StorageServer()
+    >>> zs = ZEO.tests.servertesting.client(server)
+    >>> zs.get_info()['supports_store_many']
+    True
+    >>> zs.tpc_begin('0', '', '', {})
+    >>> z64, p64 = ZODB.utils.z64, ZODB.utils.p64
+    >>> zs.storeMany([(p64(i), z64, str(i).encode()) for i in (1, 2, 3)],
+    ...              '0')
+    >>> zs.storea(p64(4), z64, b'4', '0')
+    >>> zs.txnlog.stores, zs.txnlog.records
+    (4, 2)
+    >>> _ = zs.vote('0')
+    >>> zs.tpc_finish('0').set_sender(0, zs.connection)
+    >>> storage = server.storages['1']
+    >>> ([storage.load(p64(i))[0] for i in (1, 2, 3, 4)] ==
+    ...  [b'1', b'2', b'3', b'4'])
+    True
+    >>> zs.stats.stores
+    4
+    """
+
 def test_suite():
     return unittest.TestSuite((
         doctest.DocTestSuite(
             setUp=ZODB.tests.util.setUp, tearDown=setupstack.tearDown,
+            optionflags=doctest.ELLIPSIS,
             checker=renormalizing.RENormalizing([
                 (re.compile('\d+/test-addr'), ''),
                 (re.compile("'lock_time': \d+.\d+"), 'lock_time'),
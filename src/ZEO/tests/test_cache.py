@@ -14,20 +14,28 @@
 """Basic unit tests for a client cache."""
 from __future__ import print_function
 
-from ZODB.utils import p64, repr_to_oid
+from ZODB.utils import p64, maxtid, repr_to_oid
 import doctest
 import os
 import re
 import string
 import struct
+import subprocess
 import sys
 import tempfile
 import unittest
+import mock
+import six
 import ZEO.cache
 import ZODB.tests.util
 import zope.testing.setupstack
 import zope.testing.renormalizing
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import ZEO.cache
 from ZODB.utils import p64, u64, z64
 
@@ -109,6 +117,202 @@ class CacheTests(ZODB.tests.util.TestCase):
         self.assertEqual(self.cache.loadBefore(n1, n4),
                          (data1, n3, n4))
 
+    def test_invalidate_many(self):
+        cache = self.cache
+        for i in range(1, 6):
+            cache.store(oid(i), n1, None, b'data')
+        cache.store(oid(7), n1, n2, b'old')
+        cache.invalidate_many([oid(4), oid(2), oid(6), oid(7), oid(2)], n3)
+        for i in (2, 4):
+            self.assertEqual(cache.load(oid(i)), None)
+            self.assertEqual(cache.loadBefore(oid(i), n3), (b'data', n1, n3))
+        for i in (1, 3, 5):
+            self.assertEqual(cache.load(oid(i)), (b'data', n1))
+        self.assertEqual(cache.loadBefore(oid(7), n2), (b'old', n1, n2))
+
+        cache.invalidate_many(iter([oid(1), oid(5)]), None)
+        self.assertEqual(cache.load(oid(1)), None)
+        self.assertEqual(cache.loadBefore(oid(1), n3), None)
+        self.assertEqual(len(cache), 4)
+
+    def test_current_and_noncurrent_stats(self):
+        cache = self.cache
+        overhead = ZEO.cache.allocated_record_overhead
+        # (Random data, so that the sizes don't change if it's compressed.)
+        d10, d20, d30, d40 = [os.urandom(n) for n in (10, 20, 30, 40)]
+        cache.store(n1, n1, None, d10)
+        cache.store(n2, n1, None, d20)
+        cache.invalidate(n2, n2)
+        cache.store(n2, n2, None, d30)
+        cache.store(n3, n1, n2, d40)
+        self.assertEqual(cache.load(n1), (d10, n1))
+        self.assertEqual(cache.loadBefore(n2, n2), (d20, n1, n2))
+        self.assertEqual(cache.loadBefore(n3, n2), (d40, n1, n2))
+        stats = cache.getStats()
+        self.assertEqual(stats.current_bytes, 2 * overhead + 40)
+        self.assertEqual(stats.noncurrent_bytes, 2 * overhead + 60)
+        self.assertEqual((stats.current_hits, stats.noncurrent_hits), (1, 2))
+
+        cache.invalidate(n1, None)
+        cache.invalidate(n2, n3)
+        stats = cache.getStats()
+        self.assertEqual(stats.current_bytes, 0)
+        self.assertEqual(stats.noncurrent_bytes, 3 * overhead + 90)
+
+        cache.clear()
+        stats = cache.getStats()
+        self.assertEqual((stats.current_bytes, stats.noncurrent_bytes), (0, 0))
+
+    def test_noncurrent_size(self):
+        record_size = ZEO.cache.allocated_record_overhead + 100
+        cache = ZEO.cache.ClientCache(
+            'cache', 1<<20, noncurrent_size=2 * record_size)
+        data = b'x' * 100
+        cache.store(n1, n1, n2, data)
+        cache.store(n2, n1, n2, data)
+        self.assertEqual(cache.loadBefore(n1, n2), (data, n1, n2))
+        cache.store(n3, n1, None, data)
+        cache.invalidate(n3, n2)
+
+        # n2's record was the least recently used, so it was freed.
+        self.assertEqual(cache.loadBefore(n2, n2), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (data, n1, n2))
+        self.assertEqual(cache.loadBefore(n3, n2), (data, n1, n2))
+        self.assertEqual(len(cache), 2)
+        stats = cache.getStats()
+        self.assertEqual(stats.noncurrent_bytes, 2 * record_size)
+        self.assertEqual(stats.noncurrent_evicts, 1)
+
+        # Records bigger than the budget aren't stored at all.
+        cache.store(n4, n1, n2, data * 3)
+        self.assertEqual(cache.loadBefore(n4, n2), None)
+        self.assertEqual(cache.getStats().noncurrent_evicts, 1)
+
+        # Current data isn't affected.
+        cache.store(n4, n2, None, data * 3)
+        self.assertEqual(cache.load(n4), (data * 3, n2))
+        cache.close()
+
+        # The accounting survives reopening, with or without the index
+        # snapshot, and a smaller budget takes effect right away.
+        for keep_index in (True, False):
+            if not keep_index:
+                os.remove('cache.index')
+            cache = ZEO.cache.ClientCache(
+                'cache', 1<<20, noncurrent_size=2 * record_size)
+            stats = cache.getStats()
+            self.assertEqual(stats.noncurrent_bytes, 2 * record_size)
+            self.assertEqual(stats.current_bytes, record_size + 200)
+            cache.close()
+
+        cache = ZEO.cache.ClientCache(
+            'cache', 1<<20, noncurrent_size=record_size)
+        self.assertEqual(cache.getStats().noncurrent_bytes, record_size)
+        self.assertEqual(cache.loadBefore(n1, n2), None)
+        self.assertEqual(cache.loadBefore(n3, n2), (data, n1, n2))
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+    def test_noncurrent_bytes_without_noncurrent_size(self):
+        # Without a noncurrent_size, the least-recently-used order of
+        # non-current records isn't kept, but their size is.
+        record_size = ZEO.cache.allocated_record_overhead + 100
+        data = b'x' * 100
+        cache = ZEO.cache.ClientCache('cache', 1<<20)
+        cache.store(n1, n1, n2, data)
+        cache.store(n2, n1, n2, data)
+        cache.store(n3, n1, None, data)
+        cache.invalidate(n3, n2)
+        self.assertEqual(cache._noncurrent_lru, None)
+        self.assertEqual(cache.getStats().noncurrent_bytes, 3 * record_size)
+        cache._del_noncurrent(n1, n1)
+        self.assertEqual(cache.getStats().noncurrent_bytes, 2 * record_size)
+        cache.close()
+
+        for noncurrent_size in (None, None, record_size):
+            cache = ZEO.cache.ClientCache(
+                'cache', 1<<20, noncurrent_size=noncurrent_size)
+            self.assertEqual(cache.getStats().noncurrent_bytes,
+                             record_size * (1 if noncurrent_size else 2))
+            self.assertEqual(cache.loadBefore(n3, n2), (data, n1, n2))
+            cache.close()
+
+    def test_compact(self):
+        cache = self.cache
+        data = {}
+        i = 0
+        while not cache.getStats().evicts:
+            i += 1
+            data[i] = os.urandom(8000)
+            cache.store(oid(i), n1, None, data[i])
+        for i in list(data):
+            if oid(i) not in cache.current:
+                del data[i]
+        for i in sorted(data)[1::2]:
+            cache.invalidate(oid(i), None)
+            del data[i]
+        cache.store(oid(0), n1, n2, b'old')
+        data[0] = b'old'
+
+        stats = cache.getStats()
+        self.assertTrue(stats.fragmented_bytes > 8000 * 4)
+        moved = cache.compact(1<<20)
+        self.assertTrue(moved > 0)
+        after = cache.getStats()
+        self.assertTrue(after.fragmented_bytes < stats.fragmented_bytes)
+        self.assertEqual(after.free_bytes, stats.free_bytes)
+        self.assertEqual((after.compactions, after.compacted_bytes),
+                         (1, moved))
+        self.assertEqual(cache.compact(1<<20), 0)
+
+        # The free space gathered at the current offset is used without
+        # evicting anything.
+        run = after.free_bytes - after.fragmented_bytes
+        size = 8000 + ZEO.cache.allocated_record_overhead
+        for i in range(1000, 1000 + run // size):
+            cache.store(oid(i), n1, None, os.urandom(8000))
+        self.assertEqual(cache.getStats().evicts, stats.evicts)
+
+        self.assertEqual(cache.loadBefore(oid(0), n2), (b'old', n1, n2))
+        for i, d in data.items():
+            if i:
+                self.assertEqual(cache.load(oid(i)), (d, n1))
+
+    def test_runtime_tracing(self):
+        from ZEO.scripts.cache_stats import iter_records
+        import zlib
+        cache = self.cache
+        self.assertRaises(ValueError, cache.start_trace)
+
+        # Trace records are buffered until flushed.
+        cache.start_trace(path='trace')
+        cache.store(n1, n2, None, b'data')
+        cache.load(n1)
+        self.assertEqual(os.path.getsize('trace'), 0)
+        cache.flush_trace()
+        with open('trace', 'rb') as f:
+            self.assertEqual([(r[1], r[5]) for r in iter_records(f.read())],
+                             [(0x00, b''), ((4 << 8) | 0x52, n1),
+                              ((4 << 8) | 0x22, n1)])
+
+        # When sampling, all of the operations on some of the objects
+        # are traced.
+        cache.start_trace(sample=4, path='sampled')
+        for i in range(100):
+            cache.load(oid(i))
+            cache.store(oid(i), n2, None, b'data')
+        cache.stop_trace()
+        cache.load(n1)
+        with open('sampled', 'rb') as f:
+            records = list(iter_records(f.read()))
+        self.assertEqual(records[0][1], 0x00)
+        sampled = [oid(i) for i in range(100)
+                   if (zlib.crc32(oid(i)) & 0xffffffff) % 4 == 0]
+        self.assertTrue(10 < len(sampled) < 40)
+        self.assertEqual([r[5] for r in records[1:]],
+                         [o for o in sampled for _ in range(2)])
+        self.assertEqual(os.path.getsize('trace'), 26 + 2 * 34)
+
     def testNonCurrent(self):
         data1 = b"data for n1"
         data2 = b"data for n2"
@@ -353,6 +557,867 @@ class CacheTests(ZODB.tests.util.TestCase):
         self.assertEqual(cache.loadBefore(oid, n2), (b'first', n1, n2))
         self.assertEqual(cache.loadBefore(oid, n3), (b'second', n2, None))
 
+    def test_index_snapshot(self):
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        cache.store(n1, n2, None, b'data')
+        cache.store(n1, n1, n2, b'old')
+        cache.store(n3, n3, None, b'three')
+        cache.setLastTid(n3)
+        expected = (dict(cache.current),
+                    dict((k, dict(v)) for (k, v) in cache.noncurrent.items()),
+                    cache.currentofs, len(cache))
+        cache.close()
+        self.assertTrue(os.path.exists('cache.index'))
+
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        # The snapshot is consumed when it's read
+        self.assertFalse(os.path.exists('cache.index'))
+        self.assertEqual(
+            (dict(cache.current),
+             dict((k, dict(v)) for (k, v) in cache.noncurrent.items()),
+             cache.currentofs, len(cache)),
+            expected)
+        self.assertEqual(cache.load(n1), (b'data', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'old', n1, n2))
+        cache.close()
+
+    def test_stale_index_snapshot_is_ignored(self):
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        cache.store(n1, n2, None, b'data')
+        cache.close()
+
+        # Saving a copy of the snapshot lets us try to use it after the
+        # cache file has changed.
+        with open('cache.index', 'rb') as f:
+            snapshot = f.read()
+
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        cache.invalidate(n1, None)
+        cache.store(n3, n3, None, b'three')
+        # Simulate a crash: no clean close, so no new snapshot.
+        cache.f.close()
+        cache._lock_file.close()
+        os.utime('cache', (0, 0))
+        with open('cache.index', 'wb') as f:
+            f.write(snapshot)
+
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        self.assertFalse(os.path.exists('cache.index'))
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.load(n3), (b'three', n3))
+        cache.close()
+
+class MappedCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, use_mmap=True)
+
+    def test_writes_are_visible_through_mapping(self):
+        cache = self.cache
+        self.assertTrue(isinstance(cache.f, ZEO.cache.MappedFile))
+        cache.store(n1, n1, None, b'first')
+        cache.invalidate(n1, n2)
+        cache.store(n1, n2, None, b'second')
+        self.assertEqual(cache.load(n1), (b'second', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'first', n1, n2))
+
+        # Records moved forward by load are visible too.
+        cache.rearrange = 0
+        self.assertEqual(cache.load(n1), (b'second', n2))
+        self.assertEqual(cache.load(n1), (b'second', n2))
+
+        cache.clear()
+        self.assertEqual(cache.load(n1), None)
+        cache.store(n1, n3, None, b'third')
+        self.assertEqual(cache.load(n1), (b'third', n3))
+
+    def test_reopen_mapped_file(self):
+        cache = ZEO.cache.ClientCache('cache', 1000, use_mmap=True)
+        cache.store(n1, n2, None, b'data')
+        cache.store(n1, n1, n2, b'old')
+        cache.setLastTid(n2)
+        cache.close()
+
+        cache = ZEO.cache.ClientCache('cache', 1000)
+        self.assertEqual(cache.getLastTid(), n2)
+        self.assertEqual(cache.load(n1), (b'data', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'old', n1, n2))
+        cache.close()
+
+        cache = ZEO.cache.ClientCache('cache', 1000, use_mmap=True)
+        self.assertEqual(cache.load(n1), (b'data', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'old', n1, n2))
+        cache.close()
+
+class L1CacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, l1_size=100)
+
+    def test_l1_hits_are_reported(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.load(n2), None)
+        stats = cache.getStats()
+        self.assertEqual((stats.l1_hits, stats.l1_misses), (1, 1))
+        self.assertEqual(stats.accesses, 1)
+
+        # Records loaded from the file are added to the in-memory tier.
+        cache._l1_clear()
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.getStats()[5:7], (2, 2))
+
+        cache.clearStats()
+        self.assertEqual(cache.getStats()[5:7], (0, 0))
+
+    def test_l1_is_coherent(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'first')
+        cache.invalidate(n1, n2)
+        self.assertEqual(cache.load(n1), None)
+        cache.store(n1, n2, None, b'second')
+        self.assertEqual(cache.load(n1), (b'second', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'first', n1, n2))
+        self.assertEqual(cache.loadBefore(n1, n3), (b'second', n2, None))
+        self.assertEqual(cache.loadBefore(n1, n1), None)
+
+        cache.invalidate(n1, None)
+        self.assertEqual(cache.load(n1), None)
+
+        cache.store(n1, n3, None, b'third')
+        cache.clear()
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(len(cache._l1), 0)
+
+    def test_l1_lru_eviction(self):
+        cache = self.cache
+        for i in range(1, 5):
+            cache.store(oid(i), n1, None, b'x' * 30)
+        # Only the 3 most recently used records fit in 100 bytes.
+        self.assertEqual(list(cache._l1), [oid(2), oid(3), oid(4)])
+        cache.load(oid(2))
+        cache.load(oid(1))
+        self.assertEqual(list(cache._l1), [oid(4), oid(2), oid(1)])
+        self.assertEqual(cache._l1_bytes, 90)
+
+        # Records bigger than the tier aren't kept in it.
+        cache.store(oid(5), n1, None, b'x' * 101)
+        self.assertEqual(list(cache._l1), [oid(4), oid(2), oid(1)])
+        self.assertEqual(cache.load(oid(5)), (b'x' * 101, n1))
+
+    def test_l1_hits_still_move_records_forward(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        cache.rearrange = 0
+        ofs = cache.current[n1]
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.getStats().l1_hits, 1)
+        self.assertNotEqual(cache.current[n1], ofs)
+        cache._l1_clear()
+        self.assertEqual(cache.load(n1), (b'one', n1))
+
+    def test_l1_follows_file_eviction(self):
+        cache = ZEO.cache.ClientCache(size=1000, l1_size=1000)
+        data = b'x' * 100
+        for i in range(1, 12):
+            cache.store(oid(i), n1, None, data)
+        self.assertEqual(sorted(cache._l1), sorted(cache.current))
+        self.assertTrue(oid(1) not in cache._l1)
+        self.assertEqual(cache.load(oid(1)), None)
+        cache.close()
+
+class CompressedCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, compress=True,
+                                           compress_threshold=0)
+
+    def test_compressed_records(self):
+        cache = ZEO.cache.ClientCache('cache', 1<<20, compress=True,
+                                      compress_threshold=100)
+        data = b'compressible ' * 100
+        cache.store(n1, n1, None, data)
+        cache.store(n2, n1, None, b'small ' * 10)
+        cache.store(n3, n1, None, os.urandom(1000))
+
+        def flags(oid):
+            return cache._read_header(cache.current[oid])[5]
+        self.assertEqual(flags(n1), ZEO.cache.record_compressed)
+        self.assertEqual(flags(n2), 0) # below the threshold
+        self.assertEqual(flags(n3), 0) # doesn't get smaller
+
+        self.assertEqual(cache.load(n1), (data, n1))
+        stats = cache.getStats()
+        self.assertEqual(stats.added_logical_bytes,
+                         3 * ZEO.cache.allocated_record_overhead +
+                         len(data) + 60 + 1000)
+        self.assertTrue(stats.added_bytes < stats.added_logical_bytes - 1000)
+
+        cache.invalidate(n1, n2)
+        self.assertEqual(cache.loadBefore(n1, n2), (data, n1, n2))
+
+        # Records moved forward by load stay compressed.
+        cache.store(n1, n2, None, data)
+        cache.rearrange = 0
+        ofs = cache.current[n1]
+        self.assertEqual(cache.load(n1), (data, n2))
+        self.assertNotEqual(cache.current[n1], ofs)
+        self.assertEqual(flags(n1), ZEO.cache.record_compressed)
+        self.assertEqual(cache.load(n1), (data, n2))
+        cache.close()
+
+        # Compressed records can be read without compression enabled.
+        cache = ZEO.cache.ClientCache('cache', 1<<20)
+        self.assertEqual(cache.load(n1), (data, n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (data, n1, n2))
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', 1<<20)
+        self.assertEqual(cache.load(n1), (data, n2))
+        cache.close()
+
+class CompactIndexCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, compact_index=True)
+
+    def test_packed_index(self):
+        import random
+        index = ZEO.cache.PackedIndex(delta_size=7)
+        expected = {}
+        for i in range(5000):
+            key = oid(random.randrange(300))
+            if random.random() < .6:
+                index[key] = expected[key] = random.randrange(1<<32)
+            elif key in expected:
+                del index[key]
+                del expected[key]
+            else:
+                self.assertRaises(KeyError, index.__delitem__, key)
+            self.assertEqual(index.get(key), expected.get(key))
+            self.assertEqual(key in index, key in expected)
+            self.assertEqual(len(index), len(expected))
+        self.assertEqual(list(index.items()), sorted(expected.items()))
+
+    def test_packed_noncurrent_index(self):
+        import random
+        index = ZEO.cache.PackedNoncurrentIndex(delta_size=7)
+        expected = {}
+        for i in range(5000):
+            key = random.randrange(100)
+            tid = random.randrange(10)
+            revisions = expected.setdefault(key, {})
+            if random.random() < .6:
+                if key not in index:
+                    index[key] = ZEO.cache._noncurrent_bucket_type()
+                index[key][tid] = revisions[tid] = random.randrange(1<<32)
+            elif tid in revisions:
+                del index[key][tid]
+                del revisions[tid]
+            else:
+                self.assertRaises(KeyError, index[key].__delitem__, tid)
+            if revisions:
+                self.assertEqual(index.get(key).items(),
+                                 sorted(revisions.items()))
+                self.assertEqual(index.get(key).items(None, 4),
+                                 sorted(revisions.items())[:len(
+                                     [t for t in revisions if t <= 4])])
+                self.assertEqual(tid in index[key], tid in revisions)
+            else:
+                self.assertEqual(index.get(key), None)
+
+    def test_many_objects(self):
+        cache = ZEO.cache.ClientCache('cache', 1<<20, compact_index=True)
+        for i in range(3000):
+            cache.store(oid(i), n1, None, b'data')
+        for i in range(0, 3000, 3):
+            cache.invalidate(oid(i), n2)
+        cache.setLastTid(n2)
+        self.assertEqual(len(cache), 3000)
+
+        def check(cache):
+            for i in range(3000):
+                if i % 3:
+                    self.assertEqual(cache.load(oid(i)), (b'data', n1))
+                else:
+                    self.assertEqual(cache.load(oid(i)), None)
+                    self.assertEqual(cache.loadBefore(oid(i), n2),
+                                     (b'data', n1, n2))
+        check(cache)
+        cache.close()
+
+        # The index snapshot is used when reopening.
+        cache = ZEO.cache.ClientCache('cache', 1<<20, compact_index=True)
+        check(cache)
+        cache.close()
+
+        # As is a scan of the file.
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', 1<<20, compact_index=True)
+        check(cache)
+        cache.close()
+
+class AdmissionTests(ZODB.tests.util.TestCase):
+
+    def test_sketch(self):
+        admission = ZEO.cache.TinyLFUAdmission(width=1000, sample=100)
+        self.assertEqual(admission.width, 1024)
+        for i in range(3):
+            admission.record(n1)
+        admission.record(n2)
+        self.assertEqual(admission.estimate(n1), 3)
+        self.assertEqual(admission.estimate(n2), 1)
+        self.assertEqual(admission.estimate(n3), 0)
+
+        # Counters saturate at 15
+        for i in range(20):
+            admission.record(n1)
+        self.assertEqual(admission.estimate(n1), 15)
+
+        # and are halved every `sample` accesses.
+        for i in range(100):
+            admission.record(oid(i + 100))
+        self.assertEqual(admission.estimate(n1), 7)
+        self.assertEqual(admission.estimate(n2), 0)
+
+    def test_admit(self):
+        admission = ZEO.cache.TinyLFUAdmission(small=100)
+        admission.record(n1)
+        self.assertTrue(admission.admit(n1, 99))
+        self.assertFalse(admission.admit(n1, 100))
+        admission.record(n1)
+        self.assertTrue(admission.admit(n1, 199))
+        self.assertFalse(admission.admit(n1, 200))
+        admission.record(n1)
+        self.assertTrue(admission.admit(n1, 399))
+        self.assertFalse(admission.admit(n1, 400))
+        self.assertFalse(admission.admit(n2, 1))
+
+    def test_cache_store(self):
+        cache = ZEO.cache.ClientCache(
+            size=1<<20, admission=ZEO.cache.TinyLFUAdmission(small=100))
+        cache.store(n1, n1, None, b'x' * 99)
+        cache.store(n2, n1, None, b'x' * 150)
+        self.assertEqual(cache.load(n1), (b'x' * 99, n1))
+        self.assertEqual(cache.load(n2), None)
+        self.assertEqual(cache.getStats().rejects, 1)
+
+        # The second time it's seen, the bigger object gets in.
+        cache.store(n2, n1, None, b'x' * 150)
+        self.assertEqual(cache.load(n2), (b'x' * 150, n1))
+        self.assertEqual(len(cache), 2)
+
+        # Hits count as accesses too.
+        cache.store(n3, n1, None, b'x' * 50)
+        cache.load(n3)
+        cache.invalidate(n3, n2)
+        cache.store(n3, n2, None, b'x' * 150)
+        self.assertEqual(cache.load(n3), (b'x' * 150, n2))
+        self.assertEqual(cache.loadBefore(n3, n2), (b'x' * 50, n1, n2))
+        self.assertEqual(cache.getStats().rejects, 1)
+        cache.close()
+
+    def test_simulation(self):
+        from ZEO.scripts.cache_simul import CircularCacheSimulation
+        sim = CircularCacheSimulation(
+            1<<20, .8, ZEO.cache.TinyLFUAdmission(small=100))
+        self.assertEqual(sim.extras, ("evicts", "inuse", "rejects"))
+        sim.event(1, 150, 0, 0x52, n1, n1, z64)
+        sim.event(2, 0, 0, 0x20, n1, z64, z64)
+        sim.event(3, 150, 0, 0x52, n1, n1, z64)
+        sim.event(4, 150, 0, 0x22, n1, z64, z64)
+        self.assertEqual((sim.loads, sim.hits, sim.writes, sim.rejects),
+                         (2, 1, 1, 1))
+
+class SegmentedLRUCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, policy='slru')
+
+class PolicyTests(ZODB.tests.util.TestCase):
+
+    data = b'x' * 100
+
+    def cache(self, policy):
+        # Room for 10 records, less the byte _store leaves free.
+        size = ZEO.cache.allocated_record_overhead + len(self.data)
+        cache = ZEO.cache.ClientCache(
+            size=ZEO.cache.ZEC_HEADER_SIZE + 10 * size, policy=policy)
+        self.addCleanup(cache.close)
+        return cache
+
+    def store(self, cache, oids):
+        for i in oids:
+            cache.store(oid(i), n1, None, self.data)
+
+    def cached(self, cache):
+        result = []
+        for o, ofs in cache.current.items():
+            self.assertEqual(cache.load(o), (self.data, n1))
+            result.append(u64(o))
+        return sorted(result)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ZEO.cache.ClientCache(policy='mru')
+
+    def test_circular(self):
+        cache = self.cache('circular')
+        self.store(cache, range(1, 10))
+        cache.load(oid(2))
+        self.store(cache, range(10, 13))
+        self.assertEqual(self.cached(cache), list(range(5, 13)))
+
+    def test_segmented_lru(self):
+        cache = self.cache('slru')
+        self.store(cache, range(1, 10))
+        cache.load(oid(1))
+        cache.load(oid(3))
+        self.store(cache, range(10, 15))
+
+        # 1 and 3 were used, so they were kept, and moved ahead of the
+        # records that were evicted in their place.
+        self.assertEqual(sorted(u64(o) for o in cache.current),
+                         [1, 3] + list(range(9, 15)))
+
+        # Keeping them demoted them, so they're evicted next time
+        # around if they haven't been used since.
+        cache.load(oid(3))
+        self.store(cache, range(15, 22))
+        self.assertEqual(self.cached(cache), [3] + list(range(15, 22)))
+
+    def test_segmented_lru_protected_size(self):
+        policy = ZEO.cache.SegmentedLRUPolicy(1000)
+        for o in b'abcab':
+            policy.accessed(o, 300, False)
+        self.assertEqual(list(policy._protected), list(b'ab'))
+        self.assertEqual(policy._protected_bytes, 600)
+        self.assertFalse(policy.keep(b'c'[0], 300))
+        self.assertTrue(policy.keep(b'a'[0], 300))
+        self.assertEqual(list(policy._protected), list(b'b'))
+
+    def test_2q(self):
+        cache = self.cache('2q')
+        self.store(cache, range(1, 10))
+        for i in range(1, 10):
+            cache.load(oid(i))
+        self.store(cache, range(10, 13))
+
+        # New records are evicted however often they've been used.
+        self.assertEqual(sorted(u64(o) for o in cache.current),
+                         list(range(5, 13)))
+
+        # Their oids are remembered, though, so when they're read
+        # again, they're hot, and kept if they're used.
+        self.store(cache, [1, 2])
+        cache.load(oid(1))
+        self.store(cache, range(13, 22))
+        self.assertEqual(self.cached(cache), [1] + list(range(15, 22)))
+
+        # Invalidated hot objects stay hot.
+        cache.invalidate(oid(1), n2)
+        cache.store(oid(1), n2, None, self.data)
+        self.assertEqual(cache.policy._hot, {oid(1): False})
+
+    def test_simulation(self):
+        from ZEO.scripts.cache_simul import simulations
+        results = {}
+        for name, simclass in simulations.items():
+            sim = simclass(ZEO.cache.ZEC_HEADER_SIZE + 10 * 143, .8)
+            for i in range(1, 4):
+                sim.event(i, 100, 0, 0x52, oid(i), n1, z64)
+            sim.event(4, 100, 0, 0x22, oid(1), z64, z64)
+            sim.event(5, 100, 0, 0x22, oid(3), z64, z64)
+            for i in range(4, 15):
+                sim.event(i + 2, 100, 0, 0x52, oid(i), n1, z64)
+            results[name] = sorted(u64(o) for o in sim.current), sim.kept
+        self.assertEqual(results, {
+            'circular': (list(range(7, 15)), 0),
+            'slru': ([1, 3] + list(range(9, 15)), 2),
+            '2q': (list(range(7, 15)), 0),
+            })
+
+@unittest.skipUnless(numpy, "numpy isn't installed")
+class HitRateCurveTests(ZODB.tests.util.TestCase):
+
+    # (code, dlen, oid)
+    events = [
+        (0x52, 100, 1),
+        (0x52, 100, 2),
+        (0x22, 100, 1),
+        (0x22, 100, 1),
+        (0x1c, 0, 1),
+        (0x20, 0, 1),
+        (0x22, 100, 2),
+        ]
+
+    def test_lru_hit_rates(self):
+        from ZEO.scripts.cache_simul import lru_hit_rates
+        code, dlen, oid = [numpy.array(a, numpy.int64)
+                           for a in zip(*self.events)]
+        record = ZEO.cache.allocated_record_overhead + 100
+        # The loads hit with room for 2 records, 1 record, never (the
+        # data cached before the invalidation can't be used), and 2
+        # records and an empty one (the one loaded after the
+        # invalidation, which wasn't stored).
+        sizes = [record, 2 * record,
+                 2 * record + ZEO.cache.allocated_record_overhead]
+        self.assertEqual(
+            lru_hit_rates(code, dlen, oid.astype(numpy.uint64), sizes),
+            (4, [1, 2, 3]))
+
+    def test_read_trace_arrays(self):
+        from ZEO.scripts.cache_simul import read_trace_arrays
+        import io
+        trace = b''.join(
+            struct.pack(">iiH8s8s", 1000 + i, (dlen << 8) | code, 8,
+                        n1, z64) + oid(o)
+            for i, (code, dlen, o) in enumerate(self.events))
+        # A misaligned record is skipped, as when simulating.
+        for data in (trace, b'\0' * 8 + trace):
+            code, dlen, oids = read_trace_arrays(io.BytesIO(data))
+            self.assertEqual(list(zip(code, dlen, oids)), self.events)
+
+class TraceStatsTests(ZODB.tests.util.TestCase):
+
+    def trace(self):
+        def record(ts, code, dlen=0, o=None):
+            o = b'' if o is None else oid(o)
+            return struct.pack(">iiH8s8s", ts, (dlen << 8) | code, len(o),
+                               n1, z64) + o
+        return b''.join([
+            record(960, 0x00),
+            record(970, 0x52, 1, 1),
+            record(980, 0x22, 1, 1),
+            b'\0' * 8, # misaligned
+            record(1030, 0x20, 0, 2),
+            record(1040, 0x1c, 0, 1),
+            record(1050, 0x00),
+            record(1060, 0x52, 2, 2),
+            ])
+
+    def test_chunks(self):
+        from ZEO.scripts.cache_stats import (
+            read_chunks, analyze_chunk, TraceStats)
+        import io
+        data = self.trace()
+        for chunk_size in (1, 34, 50, len(data)):
+            chunks = read_chunks(io.BytesIO(data), chunk_size)
+            stats = TraceStats()
+            with mock.patch('sys.stderr', new=six.StringIO()) as stderr:
+                for chunk in chunks:
+                    stats.update(analyze_chunk(chunk, 60, True, True))
+            self.assertEqual(stderr.getvalue(),
+                             "Skipping 8 bytes at offset 94\n")
+            self.assertEqual(chunks.bytes_read, len(data))
+            self.assertEqual(stats.records, 7)
+            self.assertEqual((stats.t0, stats.te), (960, 1060))
+            self.assertEqual(stats.bycode,
+                             {0x00: 2, 0x52: 2, 0x22: 1, 0x20: 1, 0x1c: 1})
+            self.assertEqual(stats.oids, {oid(1): 1, oid(2): 1})
+            self.assertEqual(stats.bysizew, {1: {oid(1): 1}, 2: {oid(2): 1}})
+            # Intervals are split at restarts, and merged across chunks.
+            self.assertEqual(stats.intervals, [
+                [16, 960, 960, {0x00: 1}, 960],
+                [16, 960, 980, {0x52: 1, 0x22: 1}, None],
+                [17, 1030, 1050, {0x20: 1, 0x1c: 1, 0x00: 1}, 1050],
+                [17, 1050, 1060, {0x52: 1}, None],
+                ])
+
+    def test_machine_readable_output(self):
+        import ZEO.scripts.cache_stats
+        import json
+        with open('trace', 'wb') as f:
+            f.write(self.trace())
+        main = ZEO.scripts.cache_stats.main
+        with mock.patch('sys.stderr'):
+            with mock.patch('sys.stdout', new=six.StringIO()) as stdout:
+                main('-f json -j 2 -i 1 -s trace'.split())
+            summary = json.loads(stdout.getvalue())
+            with mock.patch('sys.stdout', new=six.StringIO()) as stdout:
+                main('-f csv -i 1 trace'.split())
+            rows = stdout.getvalue().splitlines()
+        self.assertEqual(summary['records'], 7)
+        self.assertEqual(summary['codes']['52'], 2)
+        self.assertEqual(summary['hit_rate'], 50.0)
+        self.assertEqual(summary['size_histograms']['written'],
+                         [dict(size=1, objects=1, count=1),
+                          dict(size=2, objects=1, count=1)])
+        self.assertEqual(summary['intervals'][1], dict(
+            start=960, end=980, loads=1, hits=1, invalidations=0, writes=1,
+            hit_rate=100.0, restart=False))
+        self.assertEqual(rows, [
+            'start,end,loads,hits,invalidations,writes,hit_rate,restart',
+            '960,960,0,0,0,0,,True',
+            '960,980,1,1,0,1,100.0,False',
+            '1030,1050,1,0,1,0,0.0,True',
+            '1050,1060,0,0,0,1,,False',
+            ])
+
+class SegmentedCacheTests(ZODB.tests.util.TestCase):
+
+    def test_objects_are_spread_over_segments(self):
+        cache = ZEO.cache.SegmentedClientCache(size=4000, segments=4)
+        self.assertEqual(cache.maxsize, 4000)
+        for i in range(8):
+            cache.store(oid(i), n1, None, ('data%d' % i).encode())
+        self.assertEqual(len(cache), 8)
+        self.assertEqual([len(segment) for segment in cache.segments],
+                         [2, 2, 2, 2])
+        self.assertEqual(sorted(cache.contents()),
+                         [(oid(i), n1) for i in range(8)])
+
+        cache.setLastTid(n2)
+        self.assertEqual(cache.getLastTid(), n2)
+        self.assertEqual([segment.getLastTid() for segment in cache.segments],
+                         [n2] * 4)
+        self.assertRaises(ValueError, cache.setLastTid, n1)
+
+        cache.invalidate_many([oid(5), oid(3)], n3)
+        cache.store(oid(5), n3, None, b'new')
+        self.assertEqual(cache.load(oid(5)), (b'new', n3))
+        self.assertEqual(cache.loadBefore(oid(5), n3), (b'data5', n1, n3))
+        self.assertEqual(cache.load(oid(6)), (b'data6', n1))
+        self.assertEqual(cache.load(oid(9)), None)
+
+        stats = cache.getStats()
+        self.assertEqual((stats.adds, stats.accesses), (9, 3))
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.load(oid(6)), None)
+        cache.close()
+
+    def test_reopen(self):
+        cache = ZEO.cache.SegmentedClientCache('cache', 4000, segments=2)
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        cache.setLastTid(n2)
+        cache.close()
+        self.assertTrue(os.path.exists('cache.0-2'))
+        self.assertTrue(os.path.exists('cache.1-2'))
+
+        # A different number of segments doesn't reuse the files.
+        cache = ZEO.cache.SegmentedClientCache('cache', 4000, segments=3)
+        self.assertEqual(cache.load(n1), None)
+        cache.close()
+
+        cache = ZEO.cache.SegmentedClientCache('cache', 4000, segments=2)
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.load(n2), (b'two', n1))
+        self.assertEqual(cache.getLastTid(), n2)
+
+        # If a segment missed the last setLastTid, the cache is
+        # only as current as its oldest segment.
+        cache.segments[0].setLastTid(n3)
+        cache.close()
+        cache = ZEO.cache.SegmentedClientCache('cache', 4000, segments=2)
+        self.assertEqual(cache.getLastTid(), n2)
+        cache.setLastTid(n4)
+        self.assertEqual([segment.getLastTid() for segment in cache.segments],
+                         [n4, n4])
+        cache.close()
+
+    def test_threads(self):
+        import threading
+        cache = ZEO.cache.SegmentedClientCache(size=1<<20, segments=4)
+        for i in range(100):
+            cache.store(oid(i), n1, None, b'x' * i)
+        errors = []
+        def load():
+            try:
+                for _ in range(10):
+                    for i in range(100):
+                        assert cache.load(oid(i)) == (b'x' * i, n1)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=load) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        cache.close()
+
+class SharedCacheTests(ZODB.tests.util.TestCase):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        if ZEO.cache.fcntl is None:
+            self.skipTest("Shared caches require fcntl")
+
+    def test_records_are_shared(self):
+        a = ZEO.cache.SharedClientCache('cache', 4000)
+        b = ZEO.cache.SharedClientCache('cache', 4000)
+        a.setLastTid(n2)
+        b.setLastTid(n2)
+        a.store(n1, n1, None, b'one')
+        self.assertEqual(b.load(n1), (b'one', n1))
+        self.assertEqual(b.loadBefore(n1, n3), (b'one', n1, None))
+        b.store(n2, n1, n2, b'two')
+        self.assertEqual(a.loadBefore(n2, n2), (b'two', n1, n2))
+        self.assertEqual(sorted(a.contents()), [(n1, n1)])
+        self.assertEqual(len(a), 2)
+
+        # A process that opens the file later starts out knowing what
+        # the file knows.
+        c = ZEO.cache.SharedClientCache('cache', 1000)
+        self.assertEqual(c.maxsize, 4000)
+        self.assertEqual(c.getLastTid(), n2)
+        self.assertEqual(c.load(n1), (b'one', n1))
+
+        # Data dropped by one process is dropped for all of them.
+        c.invalidate(n1, None)
+        self.assertEqual(a.load(n1), None)
+        self.assertEqual(len(a), 1)
+        for cache in a, b, c:
+            cache.close()
+
+    def test_processes_with_different_last_tids(self):
+        a = ZEO.cache.SharedClientCache('cache', 4000)
+        b = ZEO.cache.SharedClientCache('cache', 4000)
+        a.setLastTid(n2)
+        b.setLastTid(n2)
+        a.store(n1, n1, None, b'one')
+
+        # a sees a transaction that changes the object before b does.
+        a.invalidate(n1, n3)
+        a.store(n1, n3, None, b'three')
+        a.setLastTid(n3)
+        self.assertEqual(a.load(n1), (b'three', n3))
+
+        # b still gets the data that's current for it.
+        self.assertEqual(b.load(n1), (b'one', n1))
+        self.assertEqual(b.loadBefore(n1, n3), (b'one', n1, n3))
+
+        # b's idea of current data may be out of date, so it isn't
+        # stored, but data that isn't current is.
+        b.store(n2, n1, None, b'two')
+        self.assertEqual(a.load(n2), None)
+        b.store(n2, n1, n2, b'two')
+        self.assertEqual(a.loadBefore(n2, n2), (b'two', n1, n2))
+
+        # When b catches up, it doesn't apply the invalidation again.
+        b.invalidate(n1, n3)
+        b.setLastTid(n3)
+        self.assertEqual(b.load(n1), (b'three', n3))
+        self.assertEqual(b.loadBefore(n1, n3), (b'one', n1, n3))
+
+        # Whoever gets to a transaction first applies it.
+        b.invalidate(n1, n4)
+        b.setLastTid(n4)
+        self.assertEqual(b.load(n1), None)
+        self.assertEqual(a.load(n1), (b'three', n3))
+        a.invalidate(n1, n4)
+        a.setLastTid(n4)
+        self.assertEqual(a.load(n1), None)
+        self.assertEqual(a.loadBefore(n1, n4), (b'three', n3, n4))
+        a.close()
+        b.close()
+
+    def test_load_before_maxtid(self):
+        # Clients load current data with loadBefore(oid, maxtid),
+        # which gets the data current as of the process's last tid.
+        a = ZEO.cache.SharedClientCache('cache', 4000)
+        b = ZEO.cache.SharedClientCache('cache', 4000)
+        a.setLastTid(n2)
+        b.setLastTid(n2)
+        a.store(n1, n1, None, b'one')
+        self.assertEqual(a.loadBefore(n1, maxtid), (b'one', n1, None))
+        self.assertEqual(b.loadBefore(n1, maxtid), (b'one', n1, None))
+        self.assertEqual(b.getStats().current_hits, 1)
+
+        # a sees a transaction that changes the object before b does.
+        a.invalidate(n1, n3)
+        a.store(n1, n3, None, b'three')
+        a.setLastTid(n3)
+        self.assertEqual(a.loadBefore(n1, maxtid), (b'three', n3, None))
+        self.assertEqual(b.loadBefore(n1, maxtid), (b'one', n1, n3))
+
+        # A process ahead of the file doesn't use its current records.
+        b.clear()
+        a.store(n1, n3, None, b'three')
+        self.assertEqual(a.load(n1), None)
+        self.assertEqual(a.loadBefore(n1, maxtid), None)
+        a.close()
+        b.close()
+
+    def test_process_ahead_of_the_file_doesnt_use_current_data(self):
+        a = ZEO.cache.SharedClientCache('cache', 4000)
+        b = ZEO.cache.SharedClientCache('cache', 4000)
+        a.setLastTid(n2)
+        b.setLastTid(n2)
+        a.store(n1, n1, None, b'one')
+
+        # b verifies its cache after missing transactions, but doesn't
+        # know what changed, so it clears it, which clears the file.
+        b.clear()
+        self.assertEqual(a.load(n1), None)
+        a.store(n1, n1, None, b'one')
+        self.assertEqual(a.load(n1), None)
+        b.setLastTid(n4)
+        self.assertEqual(b.getLastTid(), n4)
+
+        # a is now behind the file, and b is in step with it.
+        a.store(n1, n1, None, b'one')
+        self.assertEqual(b.load(n1), None)
+        b.store(n1, n1, None, b'one')
+        self.assertEqual(b.load(n1), (b'one', n1))
+        self.assertEqual(a.load(n1), (b'one', n1))
+        a.close()
+        b.close()
+
+    def test_wrapping_around(self):
+        a = ZEO.cache.SharedClientCache('cache', 1000)
+        b = ZEO.cache.SharedClientCache('cache', 1000)
+        a.setLastTid(n1)
+        b.setLastTid(n1)
+        for i in range(50):
+            writer = (a, b)[i % 2]
+            writer.store(oid(i), n1, None, ('data%d' % i).encode())
+            for cache in a, b:
+                for j in range(max(0, i - 10), i + 1):
+                    self.assertEqual(cache.load(oid(j)),
+                                     (('data%d' % j).encode(), n1))
+
+        # A process that's been lapped by others reads the whole file.
+        for i in range(50, 100):
+            a.store(oid(i), n1, None, ('data%d' % i).encode())
+        self.assertEqual(b.load(oid(99)), (b'data99', n1))
+        self.assertEqual(b.load(oid(30)), None)
+        self.assertEqual(sorted(a.contents()), sorted(b.contents()))
+        a.close()
+        b.close()
+
+    def test_other_process(self):
+        cache = ZEO.cache.SharedClientCache('cache', 4000)
+        cache.setLastTid(n1)
+        cache.store(n1, n1, None, b'one')
+        subprocess.check_call([sys.executable, '-c', """
+import ZEO.cache
+from ZODB.utils import p64
+cache = ZEO.cache.SharedClientCache('cache', 4000)
+assert cache.load(p64(1)) == (b'one', p64(1))
+cache.invalidate(p64(1), p64(2))
+cache.store(p64(1), p64(2), None, b'two')
+cache.setLastTid(p64(2))
+cache.close()
+"""])
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        cache.invalidate(n1, n2)
+        cache.setLastTid(n2)
+        self.assertEqual(cache.load(n1), (b'two', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        cache.close()
+
 def kill_does_not_cause_cache_corruption():
     r"""
 
@@ -989,6 +2054,29 @@ Check to make sure the cache analysis scripts work.
     --------------------------------------------------------------------------
     Jul 11 12:15 3:00:01    9820    1694    169   9108   17.3%    8388    99.3
 
+The simulation can also model an admission filter.  Here, objects of
+1KB or more must have been used more than once to be admitted:
+
+    >>> ZEO.scripts.cache_simul.main('-s 1 -a 1 cache.trace'.split())
+    CircularCacheSimulation, cache size 1,048,576 bytes
+      START TIME   DUR.   LOADS    HITS INVALS WRITES HITRATE  EVICTS   INUSE REJECTS
+    Jul 11 12:11   3:17     180       0      1     91    0.0%       0     5.7     106
+    Jul 11 12:15  14:59     818      51      4    342    6.2%       0    27.4     451
+    Jul 11 12:30  14:59     818      90      6    345   11.0%       0    50.0     342
+    Jul 11 12:45  14:59     818     147      7    279   18.0%       0    68.6     314
+    Jul 11 13:00  14:59     818     173     23    294   21.1%       0    91.1     267
+    Jul 11 13:15  14:59     818     223     23    340   27.3%     312    99.1     216
+    Jul 11 13:30  14:59     819     190     23    423   23.2%     551    99.4     177
+    Jul 11 13:45  14:59     818     173     19    473   21.1%     530    99.0     176
+    Jul 11 14:00  14:59     818     189     17    477   23.1%     494    99.2     145
+    Jul 11 14:15  14:59     818     179     20    553   21.9%     595    99.5     109
+    Jul 11 14:30  14:59     818     183     23    535   22.4%     538    99.2     108
+    Jul 11 14:45  14:59     819     176     18    581   21.5%     583    99.1      94
+    Jul 11 15:00  14:59     818     194     20    581   23.7%     583    99.0      77
+    Jul 11 15:15      1       2       1      0      1   50.0%       1    99.0       0
+    --------------------------------------------------------------------------
+    Jul 11 13:15 2:00:01    6548    1508    163   3964   23.0%    4187    99.0    1102
+
 Cleanup:
 
     >>> del os.environ["ZEO_CACHE_TRACE"]
@@ -1098,6 +2186,17 @@ An attempt to open a bad cache file will cause it to be dropped and recreated.
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(CacheTests))
+    suite.addTest(unittest.makeSuite(MappedCacheTests))
+    suite.addTest(unittest.makeSuite(L1CacheTests))
+    suite.addTest(unittest.makeSuite(CompressedCacheTests))
+    suite.addTest(unittest.makeSuite(CompactIndexCacheTests))
+    suite.addTest(unittest.makeSuite(AdmissionTests))
+    suite.addTest(unittest.makeSuite(SegmentedLRUCacheTests))
+    suite.addTest(unittest.makeSuite(PolicyTests))
+    suite.addTest(unittest.makeSuite(HitRateCurveTests))
+    suite.addTest(unittest.makeSuite(TraceStatsTests))
+    suite.addTest(unittest.makeSuite(SegmentedCacheTests))
+    suite.addTest(unittest.makeSuite(SharedCacheTests))
     suite.addTest(
         doctest.DocTestSuite(
             setUp=zope.testing.setupstack.setUpDirectory,
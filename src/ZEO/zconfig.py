@@ -63,6 +63,9 @@ class ClientStorageConfig(object):
 
         addresses = [server.address for server in config.server]
         options = {}
+        if config.replica:
+            options['replicas'] = [
+                replica.address for replica in config.replica]
         if config.blob_cache_size is not None:
             options['blob_cache_size'] = config.blob_cache_size
         if config.blob_cache_size_check is not None:
@@ -82,6 +85,24 @@ class ClientStorageConfig(object):
             storage=config.storage,
             cache_size=config.cache_size,
             cache=config.cache_path,
+            cache_segments=config.cache_segments,
+            cache_shared=config.cache_shared,
+            cache_policy=config.cache_policy,
+            cache_warmup=config.cache_warmup,
+            cache_warmup_rate=config.cache_warmup_rate,
+            cache_compact_interval=config.cache_compact_interval,
+            cache_mmap=config.cache_mmap,
+            cache_l1_size=config.cache_l1_size,
+            cache_admission_small=config.cache_admission_small,
+            cache_compress=config.cache_compress,
+            cache_compress_threshold=config.cache_compress_threshold,
+            cache_noncurrent_size=config.cache_noncurrent_size,
+            cache_compact_index=config.cache_compact_index,
+            store_batch_count=config.store_batch_count,
+            store_batch_size=config.store_batch_size,
+            reference_prefetch_depth=config.reference_prefetch_depth,
+            reference_prefetch_budget=config.reference_prefetch_budget,
+            connections=config.connections,
             name=config.name,
             read_only=config.read_only,
             read_only_fallback=config.read_only_fallback,